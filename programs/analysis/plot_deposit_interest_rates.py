@@ -1,12 +1,19 @@
+import os
+import sys
+
 import pandas as pd
 import matplotlib.pyplot as plt
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "clean"))
+from panel_store import load_frame
 
-def main() -> None:
-    df = pd.read_csv("data/processed/deposit_interest_rate.csv")
 
-    # Ensure time axis parses as datetime for correct ordering
-    df['rssd9999'] = pd.to_datetime(df['rssd9999'], errors='coerce')
+def main() -> None:
+    # Memory-mapped Arrow copy of data/processed/deposit_interest_rate.csv; rssd9999 loads as datetime
+    df = load_frame("deposit_interest_rate", columns=[
+        'rssd9001', 'rssd9999', 'interest_rate_on_deposit', 'interest_rate_on_interest_bearing_deposit',
+        'average_deposit', 'average_interest_bearing_deposit',
+    ])
 
     # Restrict analysis period to start at 2021-01-01
     x_start = pd.Timestamp('2021-01-01')
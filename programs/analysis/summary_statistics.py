@@ -1,8 +1,18 @@
 import pandas as pd
 import numpy as np
 import os
-
-df = pd.read_csv("data/working/working_panel.csv")
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "clean"))
+from panel_store import load_frame
+
+# Memory-mapped Arrow copy of data/working/working_panel.csv (see programs/clean/panel_store.py)
+df = load_frame("working_panel", columns=[
+    "Bank ID", "Date", "ASSET",
+    "sophistication_index_z", "branch_density_z", "hhi_z", "metro_dummy", "log_median_hh_income_z",
+    "d_average_deposit", "d_average_interest_bearing_deposit", "d_core_deposit", "d_total_loans",
+    "d_total_loans_not_for_sale", "d_single_family_loans", "d_multifamily_loans", "d_C&I",
+])
 
 # First Paragraph
 # Filter to 2022Q1 (quarter end date 2022-03-31)
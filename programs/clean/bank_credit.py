@@ -1,40 +1,66 @@
-import pandas as pd
-import numpy as np
+"""
+Builds bank-quarter QoQ loan growth and the small business lending flag.
 
-rcon1 = pd.read_csv("data/raw/rcon_credit_1.csv", parse_dates=["rssd9999"])
-# Ensure consistent date format for merge key
-rcon1['rssd9999'] = pd.to_datetime(rcon1['rssd9999'], errors='coerce').dt.normalize()
+How to run:
+  python programs/clean/bank_credit.py
+  python programs/clean/bank_credit.py --by-quarter --workers 8   # full history, out of core
+  python programs/clean/bank_credit.py --update                   # append a new quarter
 
-# De-dupe by keys, keeping the latest submission by date
-rcon1['rssdsubmissiondate'] = pd.to_datetime(rcon1['rssdsubmissiondate'], errors='coerce')
-rcon1.sort_values(['rssd9001', 'rssd9999', 'rssd9050', 'rssdsubmissiondate'], inplace=True)
-rcon1 = rcon1.drop_duplicates(subset=['rssd9001', 'rssd9999', 'rssd9050'], keep='last')
-rcon1.drop(columns=['rssdsubmissiondate'], inplace=True)
+--update appends only the quarters missing from the output, e.g. after a new release has been
+appended to the raw extracts; lags come from the stored partitions of earlier quarters.
+--by-quarter processes each rssd9999 quarter independently (with the quarter before it) from
+the quarter-partitioned Call Report cache; output rows are then in quarter order.
+"""
+import argparse
 
-rcon2 = pd.read_csv("data/raw/rcon_credit_2.csv", parse_dates=["rssd9999"])
-rcon2['rssd9999'] = pd.to_datetime(rcon2['rssd9999'], errors='coerce').dt.normalize()
-rcon2['rssdsubmissiondate'] = pd.to_datetime(rcon2['rssdsubmissiondate'], errors='coerce')
-rcon2.sort_values(['rssd9001', 'rssd9999', 'rssd9050', 'rssdsubmissiondate'], inplace=True)
-rcon2 = rcon2.drop_duplicates(subset=['rssd9001', 'rssd9999', 'rssd9050'], keep='last')
-rcon2.drop(columns=['rssdsubmissiondate'], inplace=True)
+from call_report import load_call_report, run_by_quarter, update_by_quarter, write_output
+from panel_cube import PanelCube
 
-# Merge on rssd9001 and rssd9999 after de-duplication (column exists in both)
-df = rcon1.merge(rcon2, on=["rssd9001", "rssd9050", "rssd9999"], how="left")
-df.drop(columns=['rcon5569', 'rcon5573', 'rcon5567', 'rcon5575', 'rcon5571', 'rcon5565'], inplace=True)
+OUTPUT_CSV = "data/processed/bank_credit.csv"
+SOURCES = ["rcon_credit_1", "rcon_credit_2"]
+LAGS = 1  # QoQ growth needs the previous quarter only
 
-df.rename(columns={'rcon3465': 'single_family_loans', 'rcon1460': 'multifamily_loans', 'rcon2122': 'total_loans', 'rcon1766':'C&I', 'rconb528':'total_loans_not_for_sale', 'rcon6999':'small_buz_lending_flag'}, inplace=True)
 
-df['multifamily_loans'] = df['multifamily_loans'].fillna(0)
+def build(rcon1, rcon2):
+    # Merge on rssd9001 and rssd9999 after de-duplication (column exists in both)
+    # (the unused rcon5565-rcon5575 items are not loaded; see call_report.SOURCES)
+    df = rcon1.merge(rcon2, on=["rssd9001", "rssd9050", "rssd9999"], how="left")
 
-# Ensure chronological order for QoQ computations
-df.sort_values(['rssd9001', 'rssd9999', 'rssd9050'], inplace=True)
+    df.rename(columns={'rcon3465': 'single_family_loans', 'rcon1460': 'multifamily_loans', 'rcon2122': 'total_loans', 'rcon1766':'C&I', 'rconb528':'total_loans_not_for_sale', 'rcon6999':'small_buz_lending_flag'}, inplace=True)
 
-# Compute QoQ pct change for requested variables
-qoq_cols = ['single_family_loans', 'multifamily_loans', 'total_loans', 'total_loans_not_for_sale', 'C&I']
-for col in qoq_cols:
-    prev = df.groupby('rssd9001')[col].shift(1)
-    df[f'd_{col}'] = np.where(prev != 0, (df[col] - prev) / prev, np.nan)
+    df['multifamily_loans'] = df['multifamily_loans'].fillna(0)
 
-df.drop(columns=['single_family_loans', 'multifamily_loans', 'total_loans', 'total_loans_not_for_sale', 'C&I'], inplace=True)
+    # Chronological order for the output
+    df.sort_values(['rssd9001', 'rssd9999', 'rssd9050'], inplace=True)
 
-df.to_csv("data/processed/bank_credit.csv", index=False)
\ No newline at end of file
+    # Compute QoQ pct change for requested variables (previous calendar quarter; NaN across gaps)
+    cube = PanelCube.from_frame(df)
+    qoq_cols = ['single_family_loans', 'multifamily_loans', 'total_loans', 'total_loans_not_for_sale', 'C&I']
+    for col in qoq_cols:
+        df[f'd_{col}'] = cube.growth(df[col])
+
+    df.drop(columns=['single_family_loans', 'multifamily_loans', 'total_loans', 'total_loans_not_for_sale', 'C&I'], inplace=True)
+    return df
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Build bank credit growth from the Call Report extracts.")
+    ap.add_argument("--by-quarter", action="store_true", help="Process quarter partitions out of core.")
+    ap.add_argument("--update", action="store_true",
+                    help="Append only quarters missing from the output (after a new Call Report release).")
+    ap.add_argument("--workers", type=int, default=1, help="Processes for --by-quarter / --update.")
+    args = ap.parse_args()
+
+    if args.update:
+        update_by_quarter(build, SOURCES, OUTPUT_CSV, lags=LAGS, workers=args.workers)
+        return
+    if args.by_quarter:
+        run_by_quarter(build, SOURCES, OUTPUT_CSV, lags=LAGS, workers=args.workers)
+        return
+    # Parsed once, de-duplicated to the latest submission per (rssd9001, rssd9999, rssd9050) and cached
+    df = build(*[load_call_report(name) for name in SOURCES])
+    write_output(df, OUTPUT_CSV)
+
+
+if __name__ == "__main__":
+    main()
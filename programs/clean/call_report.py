@@ -0,0 +1,496 @@
+"""
+Shared loader for the raw FFIEC Call Report extracts (rcon_*.csv / riad*.csv).
+
+Each extract is parsed once with explicit dtypes and only the columns the clean scripts
+use, de-duplicated to the latest submission per key, and stored as Parquet under
+data/cache/call_report/. The cache file is keyed by a SHA-256 of the source CSV and of
+the loader spec, so editing a raw file or a source definition below triggers a re-parse
+and everything else is a Parquet read.
+
+Usage (from a clean script):
+    from call_report import load_call_report
+    rcon1 = load_call_report("rcon_control_1")
+
+Columns returned: the key columns (rssd9001 and rssd9050 as nullable Int64, rssd9999 as a
+normalized datetime) plus every rcon*/riad* item as float64 (flags in FLAG_ITEMS as Int64).
+rssdsubmissiondate is used for de-duplication and dropped.
+
+Full-history runs can go out of core instead: partition_call_report() streams an extract in
+chunks into one deduplicated Parquet file per rssd9999 quarter, and run_by_quarter() applies a
+clean script's transform to each quarter in parallel, reading only that quarter and the `lags`
+quarters before it, so peak memory tracks a few quarters rather than the whole history.
+When a new quarter is released, update_by_quarter() parses only the bytes appended to the raw
+CSV and appends only the quarters the processed output is missing.
+
+To fill the cache ahead of several scripts that share extracts (the pipeline runner does this):
+    python programs/clean/call_report.py [extract ...] [--workers N]
+
+Set CALL_REPORT_NO_CACHE=1 to bypass the cache (parse the CSV every time). To run on an
+earlier vintage of the filings instead of the latest submission, pass vintage= or set
+CALL_REPORT_VINTAGE ("original" or an as-of date); see call_report_store.py.
+"""
+import argparse
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+from panel_store import TableWriter, publish
+
+RAW_DIR = "data/raw"
+CACHE_DIR = "data/cache/call_report"
+
+BANK_QUARTER = ("rssd9001", "rssd9999")
+BANK_QUARTER_CERT = ("rssd9001", "rssd9999", "rssd9050")
+SUBMISSION_DATE = "rssdsubmissiondate"
+ITEM_PREFIXES = ("rcon", "riad")
+# Items that are flags rather than amounts: read as nullable integers so they stay 0/1 in outputs
+FLAG_ITEMS = ("rcon6999",)
+
+PARTITION_CHUNK_ROWS = 500_000
+UNDATED = "undated"  # partition for rows whose rssd9999 does not parse
+
+# Bump when the parse / de-dup logic changes in a way the spec below does not capture
+LOADER_VERSION = 3
+
+# Non-item columns the clean scripts carry through when an extract has them
+KEEP_COLUMNS = ("rssdfininstfilingtype",)
+
+
+class CallReportSource(NamedTuple):
+    path: str
+    keys: tuple
+    exclude: tuple = ()  # items present in the extract that no clean script uses
+
+
+SOURCES = {
+    "rcon_credit_1": CallReportSource(f"{RAW_DIR}/rcon_credit_1.csv", BANK_QUARTER_CERT,
+                                      ("rcon5569", "rcon5573", "rcon5567", "rcon5575", "rcon5571", "rcon5565")),
+    "rcon_credit_2": CallReportSource(f"{RAW_DIR}/rcon_credit_2.csv", BANK_QUARTER_CERT,
+                                      ("rcon5569", "rcon5573", "rcon5567", "rcon5575", "rcon5571", "rcon5565")),
+    "rcon_control_1": CallReportSource(f"{RAW_DIR}/rcon_control_1.csv", BANK_QUARTER),
+    "rcon_control_2": CallReportSource(f"{RAW_DIR}/rcon_control_2.csv", BANK_QUARTER),
+    "riad_control": CallReportSource(f"{RAW_DIR}/riad_control.csv", BANK_QUARTER),
+    "riad": CallReportSource(f"{RAW_DIR}/riad.csv", BANK_QUARTER_CERT),
+    "rcon_deposit": CallReportSource(f"{RAW_DIR}/rcon_deposit.csv", BANK_QUARTER_CERT),
+}
+
+
+def _wanted(src: CallReportSource, col: str) -> bool:
+    return (col in src.keys or col == SUBMISSION_DATE or col in KEEP_COLUMNS
+            or (col.startswith(ITEM_PREFIXES) and col not in src.exclude))
+
+
+def _read_options(src: CallReportSource) -> dict:
+    """read_csv usecols / dtype for an extract (items float64, flags, id keys and KEEP_COLUMNS Int64, dates as text)."""
+    header = pd.read_csv(src.path, nrows=0).columns
+    dtype = {c: "Int64" if c in FLAG_ITEMS else "float64" for c in header if c.startswith(ITEM_PREFIXES)}
+    dtype.update({k: "Int64" for k in src.keys if k != "rssd9999"})
+    dtype.update({c: "Int64" for c in KEEP_COLUMNS if c in header})
+    dtype.update({"rssd9999": str, SUBMISSION_DATE: str})
+    return {"usecols": lambda c: _wanted(src, c), "dtype": {c: t for c, t in dtype.items() if _wanted(src, c)}}
+
+
+def _parse_dates(df: pd.DataFrame) -> pd.DataFrame:
+    df["rssd9999"] = pd.to_datetime(df["rssd9999"], errors="coerce").dt.normalize()
+    if SUBMISSION_DATE in df.columns:
+        df[SUBMISSION_DATE] = pd.to_datetime(df[SUBMISSION_DATE], errors="coerce")
+    return df
+
+
+def _latest_submission(df: pd.DataFrame, src: CallReportSource, keep_submission: bool = False) -> pd.DataFrame:
+    if SUBMISSION_DATE in df.columns:
+        df = df.sort_values([*src.keys, SUBMISSION_DATE])
+        df = df.drop_duplicates(subset=list(src.keys), keep="last")
+        if not keep_submission:
+            df = df.drop(columns=[SUBMISSION_DATE])
+    return df.reset_index(drop=True)
+
+
+def parse_call_report(src: CallReportSource, dedup: bool = True) -> pd.DataFrame:
+    """Parse one extract from CSV and (unless dedup=False) keep the latest submission per key."""
+    df = _parse_dates(pd.read_csv(src.path, **_read_options(src)))
+    return _latest_submission(df, src) if dedup else df.reset_index(drop=True)
+
+
+def source_hash(src: CallReportSource) -> str:
+    h = hashlib.sha256(json.dumps([LOADER_VERSION, FLAG_ITEMS, src._asdict()], sort_keys=True).encode("utf-8"))
+    with open(src.path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()[:16]
+
+
+def _temp_beside(path: str) -> str:
+    """A new empty temp file in path's directory, unique to this process (hidden, .tmp suffix)."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".", suffix=".tmp")
+    os.close(fd)
+    return tmp
+
+
+def _write_parquet(df: pd.DataFrame, path: str) -> None:
+    """df to `path` via a temp file unique to this process, so concurrent writers never share one."""
+    tmp = _temp_beside(path)
+    try:
+        df.to_parquet(tmp, index=False)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def load_call_report(name: str, cache_dir: str = CACHE_DIR, vintage: str = None) -> pd.DataFrame:
+    """Deduplicated extract `name` (a key of SOURCES), served from the Parquet cache when current."""
+    src = SOURCES[name]
+    vintage = vintage or os.environ.get("CALL_REPORT_VINTAGE") or "latest"
+    if vintage != "latest":
+        from call_report_store import CallReportStore
+        store = CallReportStore()
+        try:
+            return store.vintage(name, vintage)
+        finally:
+            store.close()
+
+    if os.environ.get("CALL_REPORT_NO_CACHE", "").strip().lower() in ("1", "true", "yes"):
+        return parse_call_report(src)
+
+    path = os.path.join(cache_dir, f"{name}-{source_hash(src)}.parquet")
+    if os.path.exists(path):
+        return pd.read_parquet(path)
+
+    df = parse_call_report(src)
+    os.makedirs(cache_dir, exist_ok=True)
+    _write_parquet(df, path)
+    # Drop superseded versions of this extract
+    for old in os.listdir(cache_dir):
+        if old.startswith(f"{name}-") and old.endswith(".parquet") and os.path.join(cache_dir, old) != path:
+            os.remove(os.path.join(cache_dir, old))
+    print(f"Cached {name}: {len(df):,} rows -> {path}")
+    return df
+
+
+# -- quarter partitions ------------------------------------------------------
+def quarter_label(dates) -> pd.Series:
+    """'YYYYQn' per report date; UNDATED where missing."""
+    d = pd.to_datetime(pd.Series(dates), errors="coerce")
+    label = d.dt.year.astype("Int64").astype(str) + "Q" + d.dt.quarter.astype("Int64").astype(str)
+    return label.where(d.notna(), UNDATED)
+
+
+def _previous_quarters(label: str, lags: int) -> list:
+    """Labels of `label` and the `lags` calendar quarters before it, oldest first."""
+    if label == UNDATED:
+        return [label]
+    y, q = int(label[:4]), int(label[-1])
+    n = y * 4 + q - 1
+    return [f"{m // 4}Q{m % 4 + 1}" for m in range(n - lags, n + 1)]
+
+
+def _dedup_quarter(name: str, spill_dir: str, out_path: str) -> int:
+    parts = [pd.read_parquet(os.path.join(spill_dir, f)) for f in sorted(os.listdir(spill_dir))]
+    # The submission date stays in the partition so appended amendments can be folded in later
+    df = _latest_submission(pd.concat(parts, ignore_index=True), SOURCES[name], keep_submission=True)
+    _write_parquet(df, out_path)
+    shutil.rmtree(spill_dir)
+    return len(df)
+
+
+def _spec_hash(src: CallReportSource) -> str:
+    """Hash of the loader spec alone (the quarter partitions track file contents in a manifest)."""
+    return hashlib.sha256(json.dumps([LOADER_VERSION, FLAG_ITEMS, src._asdict()], sort_keys=True)
+                          .encode("utf-8")).hexdigest()[:16]
+
+
+def _spill(chunks, spill: str, tag: str) -> None:
+    for i, chunk in enumerate(chunks):
+        chunk = _parse_dates(chunk)
+        for label, part in chunk.groupby(quarter_label(chunk["rssd9999"]).to_numpy()):
+            os.makedirs(os.path.join(spill, label), exist_ok=True)
+            part.to_parquet(os.path.join(spill, label, f"part-{tag}-{i:05d}.parquet"), index=False)
+
+
+def _hash_into(h, f, n: int = None) -> bytes:
+    """Feed the next n bytes of f (all of it if n is None) into h; returns the last byte read."""
+    last = b""
+    while n is None or n > 0:
+        block = f.read(1 << 20 if n is None else min(1 << 20, n))
+        if not block:
+            break
+        h.update(block)
+        last = block[-1:]
+        if n is not None:
+            n -= len(block)
+    return last
+
+
+def _write_manifest(path: str, st, h) -> None:
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"bytes": st.st_size, "mtime_ns": st.st_mtime_ns, "sha": h.hexdigest()}, f)
+    os.replace(path + ".tmp", path)
+
+
+def partition_call_report(name: str, cache_dir: str = CACHE_DIR, workers: int = 1) -> dict:
+    """
+    {quarter label: Parquet path} for extract `name`, one deduplicated file per rssd9999 quarter.
+
+    Built on first use without holding the extract in memory: the CSV is read in chunks of
+    PARTITION_CHUNK_ROWS and each chunk is spilled by quarter; every quarter is then
+    de-duplicated on its own (the keys include rssd9999, so no key spans two quarters).
+
+    manifest.json records how many bytes of the CSV have been ingested and their SHA-256.
+    When a new release only appends rows (the usual case for a new quarter), only the
+    appended bytes are parsed and only the quarters they touch are rebuilt; any other change
+    to the file triggers a full rebuild.
+    """
+    src = SOURCES[name]
+    root = os.path.join(cache_dir, f"{name}-{_spec_hash(src)}.quarters")
+    manifest_path = os.path.join(root, "manifest.json")
+    spill = root + ".spill"
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = None
+
+    st = os.stat(src.path)
+    if manifest and (manifest["bytes"], manifest["mtime_ns"]) == (st.st_size, st.st_mtime_ns):
+        return _quarter_paths(root)
+
+    # Does the file still start with exactly the bytes already ingested?
+    h, appended, tail = hashlib.sha256(), False, None
+    with open(src.path, "rb") as f:
+        if manifest and st.st_size >= manifest["bytes"]:
+            last = _hash_into(h, f, manifest["bytes"])
+            appended = h.hexdigest() == manifest["sha"] and last in (b"", b"\n")
+        if appended:
+            tail = f.read()
+            h.update(tail)
+        else:
+            f.seek(0)
+            h = hashlib.sha256()
+            _hash_into(h, f)
+    if appended and not tail:  # same contents, new mtime
+        _write_manifest(manifest_path, st, h)
+        return _quarter_paths(root)
+
+    shutil.rmtree(spill, ignore_errors=True)
+    if appended:
+        # Mark dirty first: a crash part-way leaves no manifest and forces a full rebuild
+        os.remove(manifest_path)
+        with open(src.path, "rb") as f:
+            header = f.readline()
+        _spill(pd.read_csv(io.BytesIO(header + tail), chunksize=PARTITION_CHUNK_ROWS, **_read_options(src)),
+               spill, "new")
+        labels = sorted(os.listdir(spill)) if os.path.isdir(spill) else []
+        for q in labels:  # fold the quarter's existing partition in ahead of the new rows
+            old = os.path.join(root, f"{q}.parquet")
+            if os.path.exists(old):
+                os.replace(old, os.path.join(spill, q, "part-base.parquet"))
+    else:
+        shutil.rmtree(root, ignore_errors=True)
+        _spill(pd.read_csv(src.path, chunksize=PARTITION_CHUNK_ROWS, **_read_options(src)), spill, "csv")
+        labels = sorted(os.listdir(spill)) if os.path.isdir(spill) else []
+
+    os.makedirs(root, exist_ok=True)
+    jobs = [(name, os.path.join(spill, q), os.path.join(root, f"{q}.parquet")) for q in labels]
+    if workers <= 1 or len(jobs) <= 1:
+        rows = sum(_dedup_quarter(*job) for job in jobs)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            rows = sum(pool.map(_dedup_quarter, *zip(*jobs)))
+    shutil.rmtree(spill, ignore_errors=True)
+    _write_manifest(manifest_path, st, h)
+
+    for old in os.listdir(cache_dir):
+        if old.startswith(f"{name}-") and old.endswith(".quarters") and os.path.join(cache_dir, old) != root:
+            shutil.rmtree(os.path.join(cache_dir, old), ignore_errors=True)
+    verb = "Appended to" if appended else "Partitioned"
+    print(f"{verb} {name}: {rows:,} rows in {len(labels)} quarters -> {root}")
+    return _quarter_paths(root)
+
+
+def _quarter_paths(root: str) -> dict:
+    return {f[:-len(".parquet")]: os.path.join(root, f) for f in sorted(os.listdir(root)) if f.endswith(".parquet")}
+
+
+def _read_window(paths: dict, labels: list) -> pd.DataFrame:
+    hit = [paths[q] for q in labels if q in paths]
+    if not hit:  # extract has no rows in the window: empty frame with its schema
+        df = pq.read_schema(next(iter(paths.values()))).empty_table().to_pandas()
+    else:
+        df = pd.concat([pd.read_parquet(p) for p in hit], ignore_index=True)
+    return df.drop(columns=[SUBMISSION_DATE], errors="ignore")
+
+
+def _window_job(transform, paths: list, label: str, lags: int) -> pd.DataFrame:
+    labels = _previous_quarters(label, lags)
+    out = transform(*[_read_window(p, labels) for p in paths])
+    return out[(quarter_label(out["rssd9999"]) == label).to_numpy()]
+
+
+def iter_quarters(transform, names: list, labels: list = None, lags: int = 1, workers: int = 1):
+    """
+    Yield (quarter, transform output rows for that quarter) in quarter order.
+
+    For each quarter (default: every quarter of the first extract), `transform` (a module-level
+    function, so it can run on a process pool) gets every extract in `names` restricted to that
+    quarter and the `lags` quarters before it, and only its output rows for that quarter are
+    kept. That matches the full-history result as long as no output depends on more than
+    `lags` earlier quarters.
+    """
+    paths = [partition_call_report(n, workers=workers) for n in names]
+    labels = list(paths[0]) if labels is None else list(labels)
+    args = ([transform] * len(labels), [paths] * len(labels), labels, [lags] * len(labels))
+    if workers <= 1 or len(labels) <= 1:
+        yield from zip(labels, map(_window_job, *args))
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        yield from zip(labels, pool.map(_window_job, *args))
+
+
+def _quarters_path(out_csv: str) -> str:
+    return out_csv + ".quarters.json"
+
+
+def written_quarters(out_csv: str) -> list:
+    """
+    Quarters already in a processed output: from its sidecar while that still describes the
+    file (same size), else by scanning rssd9999.
+    """
+    try:
+        with open(_quarters_path(out_csv), "r", encoding="utf-8") as f:
+            sidecar = json.load(f)
+        if sidecar["bytes"] == os.path.getsize(out_csv):
+            return sidecar["quarters"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    if not os.path.exists(out_csv):
+        return []
+    return sorted(quarter_label(pd.read_csv(out_csv, usecols=["rssd9999"])["rssd9999"]).unique())
+
+
+def record_quarters(out_csv: str, labels) -> None:
+    """Write the quarters in `out_csv` to its sidecar (read by written_quarters / --update)."""
+    with open(_quarters_path(out_csv) + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"bytes": os.path.getsize(out_csv), "quarters": sorted(set(labels))}, f)
+    os.replace(_quarters_path(out_csv) + ".tmp", _quarters_path(out_csv))
+
+
+def write_output(df: pd.DataFrame, out_csv: str) -> None:
+    """to_csv for a processed bank-quarter output, keeping its quarter sidecar and Arrow copy in step."""
+    df.to_csv(out_csv, index=False)
+    publish(df, out_csv)
+    record_quarters(out_csv, quarter_label(df["rssd9999"]).unique())
+
+
+def run_by_quarter(transform, names: list, out_csv: str, lags: int = 1, workers: int = 1) -> int:
+    """
+    Write transform(*extracts) to `out_csv` one quarter at a time (see iter_quarters).
+    Rows come out in quarter order (sorted as the transform sorts within each quarter).
+    """
+    tmp = _temp_beside(out_csv)
+    rows, labels = 0, []
+    arrow = TableWriter(out_csv)
+    try:
+        with open(tmp, "w", encoding="utf-8", newline="") as f:
+            for i, (label, out) in enumerate(iter_quarters(transform, names, lags=lags, workers=workers)):
+                out.to_csv(f, index=False, header=(i == 0))
+                arrow.write(out)
+                rows += len(out)
+                labels.append(label)
+        # Published together once every quarter is written; a sidecar left behind by a crash in
+        # between no longer matches the CSV's size, so written_quarters rescans instead
+        arrow.close()
+        os.replace(tmp, out_csv)
+    except BaseException:
+        arrow.discard()
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    record_quarters(out_csv, labels)
+    print(f"Wrote {rows:,} rows in {len(labels)} quarters -> {out_csv}")
+    return rows
+
+
+def new_quarters(names: list, out_csv: str, workers: int = 1) -> list:
+    """Quarters of the first extract that `out_csv` does not contain yet."""
+    done = set(written_quarters(out_csv))
+    return [q for q in partition_call_report(names[0], workers=workers) if q not in done]
+
+
+def update_by_quarter(transform, names: list, out_csv: str, lags: int = 1, workers: int = 1) -> int:
+    """
+    Append the quarters `out_csv` is missing (typically a newly released one), computing their
+    lags from the stored partitions of the quarters before them. Earlier rows are left as they
+    are, so an amended old quarter still needs a full run.
+    """
+    if not os.path.exists(out_csv):
+        return run_by_quarter(transform, names, out_csv, lags, workers)
+    todo = new_quarters(names, out_csv, workers)
+    columns = list(pd.read_csv(out_csv, nrows=0).columns)
+    done = written_quarters(out_csv)
+    rows = 0
+    # New rows go onto a copy that replaces the output at the end, so a failed run leaves it as it was
+    arrow = TableWriter(out_csv, append=True)
+    tmp = _temp_beside(out_csv)
+    try:
+        shutil.copyfile(out_csv, tmp)
+        with open(tmp, "a", encoding="utf-8", newline="") as f:
+            for label, out in iter_quarters(transform, names, todo, lags, workers):
+                out[columns].to_csv(f, index=False, header=False)
+                arrow.write(out[columns])
+                rows += len(out)
+        arrow.close()
+        os.replace(tmp, out_csv)
+    except BaseException:
+        arrow.discard()
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    record_quarters(out_csv, [*done, *todo])
+    print(f"Appended {rows:,} rows for {len(todo)} new quarter(s) {', '.join(todo) or '-'} -> {out_csv}")
+    return rows
+
+
+def _cache_one(name: str, cache_dir: str) -> int:
+    return len(load_call_report(name, cache_dir))
+
+
+def cache_call_reports(names: list = None, cache_dir: str = CACHE_DIR, workers: int = 1) -> list:
+    """
+    Parse and cache each extract in `names` (default: all) that is not cached yet, up to
+    `workers` at a time; returns the names that were parsed. Run before clean scripts that
+    share an extract, so they start from a warm cache instead of each writing it.
+    """
+    todo = [n for n in (names or SOURCES)
+            if not os.path.exists(os.path.join(cache_dir, f"{n}-{source_hash(SOURCES[n])}.parquet"))]
+    if workers <= 1 or len(todo) <= 1:
+        for name in todo:
+            _cache_one(name, cache_dir)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(_cache_one, todo, [cache_dir] * len(todo)))
+    return todo
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Parse and cache Call Report extracts.")
+    ap.add_argument("names", nargs="*", help=f"Extracts to cache (default: all). One of {list(SOURCES)}.")
+    ap.add_argument("--workers", type=int, default=1, help="Extracts to parse at once.")
+    args = ap.parse_args()
+    unknown = [n for n in args.names if n not in SOURCES]
+    if unknown:
+        ap.error(f"unknown extract(s) {unknown}")
+    if not cache_call_reports(args.names, workers=args.workers):
+        print("Call Report cache is up to date")
+
+
+if __name__ == "__main__":
+    main()
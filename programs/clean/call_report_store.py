@@ -0,0 +1,165 @@
+"""
+Amendment-aware SQLite store for the Call Report extracts.
+
+load_call_report() keeps only the latest submission per bank-quarter. This store keeps every
+submission of every extract in data/cache/call_report.sqlite, one table per extract, indexed on
+(keys..., rssdsubmissiondate, seq), where seq is the row's position in the source file. A
+vintage is then a single grouped walk of that index rather than a re-sort of the history:
+
+  latest               latest submission per key (what load_call_report returns)
+  original             first submission per key
+  YYYY-MM-DD           latest submission filed on or before that date
+
+Ties on submission date resolve by file order exactly as the sort + drop_duplicates did. Rows
+without a parseable submission date sort after every dated filing (as NaT did in the sort),
+so they count toward "latest" but never toward an as-of date.
+
+Clean scripts pick up a vintage through load_call_report(name, vintage=...) or by setting
+CALL_REPORT_VINTAGE, e.g. to re-run the pipeline on the original filings:
+  CALL_REPORT_VINTAGE=original python programs/clean/deposit_interest_rate.py
+
+How to run:
+  python programs/clean/call_report_store.py                 # ingest / refresh every extract
+  python programs/clean/call_report_store.py --restatements  # count restated bank-quarters
+"""
+import argparse
+import os
+import sqlite3
+import time
+
+import pandas as pd
+
+from call_report import FLAG_ITEMS, ITEM_PREFIXES, SOURCES, SUBMISSION_DATE, parse_call_report, source_hash
+
+STORE_PATH = "data/cache/call_report.sqlite"
+
+SUBMISSION_FMT = "%Y-%m-%dT%H:%M:%S"
+UNDATED = "9999-12-31T23:59:59"  # sorts after every real filing
+SEQ_WIDTH = 12
+
+
+class CallReportStore:
+    def __init__(self, path: str = STORE_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.con = sqlite3.connect(path)
+        self.con.execute(
+            "CREATE TABLE IF NOT EXISTS sources (name TEXT PRIMARY KEY, sha TEXT, rows INTEGER, ingested_at REAL)"
+        )
+
+    def close(self) -> None:
+        self.con.close()
+
+    # -- ingestion ---------------------------------------------------------
+    def ingest(self, name: str, force: bool = False) -> bool:
+        """Load every submission of extract `name`; skipped if the source is unchanged. Returns True if loaded."""
+        src = SOURCES[name]
+        sha = source_hash(src)
+        row = self.con.execute("SELECT sha FROM sources WHERE name = ?", (name,)).fetchone()
+        if row is not None and row[0] == sha and not force:
+            return False
+
+        df = parse_call_report(src, dedup=False)
+        df.insert(0, "seq", range(len(df)))
+        df["rssd9999"] = df["rssd9999"].dt.strftime("%Y-%m-%d")
+        if SUBMISSION_DATE in df.columns:
+            df[SUBMISSION_DATE] = df[SUBMISSION_DATE].dt.strftime(SUBMISSION_FMT).fillna(UNDATED)
+        else:
+            df[SUBMISSION_DATE] = UNDATED
+
+        # Load a staging table first (to_sql commits as it goes), then swap it in, index it and
+        # record the source in one transaction, so readers see the old extract or the new one
+        staging = f"{name}_staging_{os.getpid()}"
+        cols = ", ".join(f'"{c}"' for c in (*src.keys, SUBMISSION_DATE, "seq"))
+        try:
+            df.to_sql(staging, self.con, if_exists="replace", index=False, chunksize=50_000,
+                      dtype={"seq": "INTEGER PRIMARY KEY"})
+            self.con.execute("BEGIN IMMEDIATE")
+            with self.con:
+                self.con.execute(f'DROP TABLE IF EXISTS "{name}"')
+                self.con.execute(f'ALTER TABLE "{staging}" RENAME TO "{name}"')
+                self.con.execute(f'CREATE INDEX "{name}_vintage" ON "{name}" ({cols})')
+                self.con.execute("INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?)",
+                                 (name, sha, len(df), time.time()))
+        except BaseException:
+            self.con.rollback()
+            self.con.execute(f'DROP TABLE IF EXISTS "{staging}"')
+            self.con.commit()
+            raise
+        print(f"Ingested {name}: {len(df):,} submissions")
+        return True
+
+    # -- queries -----------------------------------------------------------
+    def vintage(self, name: str, vintage="latest", keep_submission: bool = False) -> pd.DataFrame:
+        """One row per key for `vintage` ('latest', 'original' or an as-of date)."""
+        self.ingest(name)
+        keys = SOURCES[name].keys
+        # Pick the winning seq per key from the index: submission date, then file order
+        tag = f"{SUBMISSION_DATE} || printf('%0{SEQ_WIDTH}d', seq)"
+        params = ()
+        if vintage == "latest":
+            pick, where = f"MAX({tag})", ""
+        elif vintage == "original":
+            pick, where = f"MIN({tag})", ""
+        else:
+            pick, where = f"MAX({tag})", f"WHERE {SUBMISSION_DATE} <= ?"
+            params = (pd.Timestamp(vintage).normalize().strftime("%Y-%m-%d") + "T23:59:59",)
+        group = ", ".join(f'"{k}"' for k in keys)
+        sql = (f'SELECT * FROM "{name}" WHERE seq IN ('
+               f'SELECT CAST(substr({pick}, -{SEQ_WIDTH}) AS INTEGER) FROM "{name}" {where} GROUP BY {group}) '
+               f'ORDER BY {group}')
+        return self._frame(name, pd.read_sql_query(sql, self.con, params=params), keep_submission)
+
+    def history(self, name: str, rssd9001=None) -> pd.DataFrame:
+        """Every submission (optionally for one bank), in key and filing order."""
+        self.ingest(name)
+        group = ", ".join(f'"{k}"' for k in SOURCES[name].keys)
+        where, params = ("WHERE rssd9001 = ?", (int(rssd9001),)) if rssd9001 is not None else ("", ())
+        sql = f'SELECT * FROM "{name}" {where} ORDER BY {group}, {SUBMISSION_DATE}, seq'
+        return self._frame(name, pd.read_sql_query(sql, self.con, params=params), keep_submission=True)
+
+    def restatements(self, name: str) -> int:
+        """Number of keys with more than one submission."""
+        self.ingest(name)
+        group = ", ".join(f'"{k}"' for k in SOURCES[name].keys)
+        sql = f'SELECT COUNT(*) FROM (SELECT 1 FROM "{name}" GROUP BY {group} HAVING COUNT(*) > 1)'
+        return self.con.execute(sql).fetchone()[0]
+
+    @staticmethod
+    def _frame(name: str, df: pd.DataFrame, keep_submission: bool) -> pd.DataFrame:
+        # Restore the dtypes load_call_report returns
+        df = df.drop(columns=["seq"])
+        df["rssd9999"] = pd.to_datetime(df["rssd9999"], errors="coerce")
+        for c in df.columns:
+            if c in SOURCES[name].keys and c != "rssd9999" or c in FLAG_ITEMS:
+                df[c] = df[c].astype("Int64")
+            elif c.startswith(ITEM_PREFIXES):
+                df[c] = df[c].astype("float64")
+        if keep_submission:
+            sub = df[SUBMISSION_DATE].where(df[SUBMISSION_DATE] != UNDATED)
+            df[SUBMISSION_DATE] = pd.to_datetime(sub, format=SUBMISSION_FMT)
+        else:
+            df = df.drop(columns=[SUBMISSION_DATE])
+        return df
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Build / inspect the amendment-aware Call Report store.")
+    ap.add_argument("names", nargs="*", default=list(SOURCES), help="Extracts (default: all).")
+    ap.add_argument("--store", default=STORE_PATH)
+    ap.add_argument("--force", action="store_true", help="Re-ingest even if the source is unchanged.")
+    ap.add_argument("--restatements", action="store_true", help="Report restated keys per extract.")
+    args = ap.parse_args()
+
+    store = CallReportStore(args.store)
+    try:
+        for name in args.names:
+            if not store.ingest(name, force=args.force):
+                print(f"{name}: up to date")
+            if args.restatements:
+                print(f"{name}: {store.restatements(name):,} keys with amended filings")
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,89 +1,115 @@
+"""
+Builds bank-quarter controls: Call Report ratios plus deposit-weighted county exposures.
+
+How to run:
+  python programs/clean/control.py
+  python programs/clean/control.py --update   # append a new quarter
+
+--update computes the Call Report ratios only for quarters missing from the output, then
+re-merges the (SOD-based) exposures and re-standardizes log income over the full sample, the
+one step that depends on every row.
+"""
+import argparse
+import os
+
 import pandas as pd
 import numpy as np
 
-rcon1 = pd.read_csv("data/raw/rcon_control_1.csv", parse_dates=["rssd9999"])
-# De-dupe by keys, keeping the latest submission by date
-rcon1['rssdsubmissiondate'] = pd.to_datetime(rcon1['rssdsubmissiondate'], errors='coerce')
-rcon1.sort_values(['rssd9001', 'rssd9999', 'rssdsubmissiondate'], inplace=True)
-rcon1 = rcon1.drop_duplicates(subset=['rssd9001', 'rssd9999'], keep='last')
-rcon1.drop(columns=['rssdsubmissiondate'], inplace=True)
-
-rcon2 = pd.read_csv("data/raw/rcon_control_2.csv", parse_dates=["rssd9999"])
-rcon2['rssdsubmissiondate'] = pd.to_datetime(rcon2['rssdsubmissiondate'], errors='coerce')
-rcon2.sort_values(['rssd9001', 'rssd9999', 'rssdsubmissiondate'], inplace=True)
-rcon2 = rcon2.drop_duplicates(subset=['rssd9001', 'rssd9999'], keep='last')
-rcon2.drop(columns=['rssdsubmissiondate'], inplace=True)
-
-riad = pd.read_csv("data/raw/riad_control.csv", parse_dates=["rssd9999"])
-riad['rssdsubmissiondate'] = pd.to_datetime(riad['rssdsubmissiondate'], errors='coerce')
-riad.sort_values(['rssd9001', 'rssd9999', 'rssdsubmissiondate'], inplace=True)
-riad = riad.drop_duplicates(subset=['rssd9001', 'rssd9999'], keep='last')
-riad.drop(columns=['rssdsubmissiondate'], inplace=True)
-
-df = rcon1.merge(rcon2, on=["rssd9001", "rssd9999"], how="left")
-df = df.merge(riad, on=["rssd9001", "rssd9999"], how="left")
-
-df['ROA'] = df['riad4340'] / df['rcon2170']
-df['core_deposit_share'] = (df['rcon2210'] + df['rcon0352'] + df['rcon6810'] + df['rconj473'] + df['rcon6648']) / df['rcon2170']
-df['wholesale_share'] = (df['rcon3353'] + df['rcon3200'] + df['rconj474'] + df['rcon3190']) / df['rcon2170']
-df['asset_to_equity'] = df['rcon2170'] / df['rcon3210']
-df['log_asset'] = np.log(df['rcon2170'])
-
-df = df[['rssd9001', 'rssd9999', 'ROA', 'core_deposit_share', 'wholesale_share', 'asset_to_equity', 'log_asset']]
-
-
-# Calculate bank deposit-weighted county-level household income and urban dummy
-acs = pd.read_csv("data/raw/ACS.csv")
-sod = pd.read_csv("data/raw/SOD.csv")
-
-# Keep only necessary SOD columns and construct branch weights
-sod_w = sod[['YEAR', 'RSSDID', 'DEPDOM', 'DEPSUMBR', 'STCNTYBR', 'METROBR']].copy()
-sod_w['fips'] = sod_w['STCNTYBR'].astype(str).str.zfill(5)
-# Avoid divide-by-zero; weights where DEPDOM <= 0 will propagate as NaN and be dropped in sums
-sod_w['weight'] = sod_w['DEPSUMBR'] / sod_w['DEPDOM']
-
-# Ensure ACS FIPS standardized
-acs_w = acs[['fips', 'median_hh_income']].copy()
-acs_w['fips'] = acs_w['fips'].astype(str).str.zfill(5)
-
-# Deposit-weighted METROBR per (YEAR, RSSDID)
-metro = sod_w.dropna(subset=['weight', 'METROBR']).copy()
-metro['w_var'] = metro['weight'] * metro['METROBR']
-metro_agg = (
-    metro.groupby(['YEAR', 'RSSDID'], as_index=False)
-    .agg(sum_w=('weight', 'sum'), sum_wy=('w_var', 'sum'))
-)
-metro_agg['deposit_weighted_metrobr'] = (metro_agg['sum_wy'] / metro_agg['sum_w']).where(metro_agg['sum_w'] > 0)
-metro_agg = metro_agg[['YEAR', 'RSSDID', 'deposit_weighted_metrobr']]
-
-# Deposit-weighted county median household income per (YEAR, RSSDID)
-sod_acs = sod_w.merge(acs_w, on='fips', how='left')
-income = sod_acs.dropna(subset=['weight', 'median_hh_income']).copy()
-income['w_var'] = income['weight'] * income['median_hh_income']
-income_agg = (
-    income.groupby(['YEAR', 'RSSDID'], as_index=False)
-    .agg(sum_w=('weight', 'sum'), sum_wy=('w_var', 'sum'))
-)
-income_agg['deposit_weighted_median_hh_income'] = (income_agg['sum_wy'] / income_agg['sum_w']).where(income_agg['sum_w'] > 0)
-income_agg = income_agg[['YEAR', 'RSSDID', 'deposit_weighted_median_hh_income']]
-
-# Combine and keep the most recent SOD YEAR per bank
-exposures = metro_agg.merge(income_agg, on=['YEAR', 'RSSDID'], how='outer')
-exposures.sort_values(['RSSDID', 'YEAR'], inplace=True)
-latest_exposures = exposures.groupby('RSSDID', as_index=False).tail(1)
-latest_exposures.rename(columns={'RSSDID': 'rssd9001'}, inplace=True)
-
-# Merge deposit-weighted exposures onto bank-quarter controls (repeat across quarters)
-df = df.merge(
-    latest_exposures[['rssd9001', 'deposit_weighted_metrobr', 'deposit_weighted_median_hh_income']],
-    on='rssd9001',
-    how='left'
-)
-
-df['log_median_hh_income'] = np.log(df['deposit_weighted_median_hh_income'])
-df['log_median_hh_income_z'] = (df['log_median_hh_income'] - df['log_median_hh_income'].mean()) / df['log_median_hh_income'].std()
-df.drop(columns=['deposit_weighted_median_hh_income'], inplace=True)
-
-df.rename(columns={'deposit_weighted_metrobr': 'metro_dummy'}, inplace=True)
-
-df.to_csv("data/processed/controls.csv", index=False)
\ No newline at end of file
+from call_report import iter_quarters, load_call_report, new_quarters, write_output
+from deposit_matrix import DepositMatrix
+from geo import fips_code
+from sod_store import read_sod
+
+OUTPUT_CSV = "data/processed/controls.csv"
+SOURCES = ["rcon_control_1", "rcon_control_2", "riad_control"]
+RATIO_COLUMNS = ['rssd9001', 'rssd9999', 'ROA', 'core_deposit_share', 'wholesale_share', 'asset_to_equity', 'log_asset']
+
+
+def build(rcon1, rcon2, riad):
+    df = rcon1.merge(rcon2, on=["rssd9001", "rssd9999"], how="left")
+    df = df.merge(riad, on=["rssd9001", "rssd9999"], how="left")
+
+    df['ROA'] = df['riad4340'] / df['rcon2170']
+    df['core_deposit_share'] = (df['rcon2210'] + df['rcon0352'] + df['rcon6810'] + df['rconj473'] + df['rcon6648']) / df['rcon2170']
+    df['wholesale_share'] = (df['rcon3353'] + df['rcon3200'] + df['rconj474'] + df['rcon3190']) / df['rcon2170']
+    df['asset_to_equity'] = df['rcon2170'] / df['rcon3210']
+    df['log_asset'] = np.log(df['rcon2170'])
+
+    return df[RATIO_COLUMNS]
+
+
+def exposures(acs, sod, years):
+    # Bank deposit-weighted county-level household income and urban dummy per (YEAR, RSSDID),
+    # from the per-year bank x county deposit matrices (weights = DEPSUMBR / DEPDOM, renormalized
+    # over branches/counties where the variable is known)
+
+    # County income keyed by integer FIPS
+    income = pd.Series(acs['median_hh_income'].to_numpy(), index=fips_code(acs['fips']))
+
+    frames = []
+    for year, m in years.items():
+        frames.append(pd.DataFrame({
+            # METROBR is per branch: pass the year's rows in store order
+            'deposit_weighted_metrobr': m.branch_exposure(sod.loc[sod['YEAR'] == year, 'METROBR']),
+            'deposit_weighted_median_hh_income': m.exposure(income),
+        }).reset_index().assign(YEAR=year))
+    exposures = pd.concat(frames, ignore_index=True)
+    # Bank-years where neither exposure is defined do not count as the bank's latest year
+    exposures = exposures.dropna(subset=['deposit_weighted_metrobr', 'deposit_weighted_median_hh_income'], how='all')
+
+    # Keep the most recent SOD YEAR per bank
+    exposures.sort_values(['RSSDID', 'YEAR'], inplace=True)
+    latest_exposures = exposures.groupby('RSSDID', as_index=False).tail(1)
+    latest_exposures.rename(columns={'RSSDID': 'rssd9001'}, inplace=True)
+    return latest_exposures
+
+
+def finish(df, latest_exposures):
+    # Merge deposit-weighted exposures onto bank-quarter controls (repeat across quarters)
+    df = df.merge(
+        latest_exposures[['rssd9001', 'deposit_weighted_metrobr', 'deposit_weighted_median_hh_income']],
+        on='rssd9001',
+        how='left'
+    )
+
+    # Full-sample standardization: recomputed over every row, including on --update
+    df['log_median_hh_income'] = np.log(df['deposit_weighted_median_hh_income'])
+    df['log_median_hh_income_z'] = (df['log_median_hh_income'] - df['log_median_hh_income'].mean()) / df['log_median_hh_income'].std()
+    df.drop(columns=['deposit_weighted_median_hh_income'], inplace=True)
+
+    df.rename(columns={'deposit_weighted_metrobr': 'metro_dummy'}, inplace=True)
+    return df
+
+
+def build_panel(extracts=None, update=False, workers=1):
+    """
+    The full controls panel. extracts: {name: frame} for SOURCES (default: load_call_report);
+    update: reuse the ratios already in OUTPUT_CSV and compute only its missing quarters (a full
+    build if there is no OUTPUT_CSV yet).
+    """
+    if update and os.path.exists(OUTPUT_CSV):
+        todo = new_quarters(SOURCES, OUTPUT_CSV, workers=workers)
+        existing = pd.read_csv(OUTPUT_CSV, usecols=RATIO_COLUMNS, parse_dates=['rssd9999'])
+        new = [out for _, out in iter_quarters(build, SOURCES, todo, lags=0, workers=workers)]
+        df = pd.concat([existing, *new], ignore_index=True)
+        print(f"Appending {sum(len(n) for n in new):,} rows for {len(todo)} new quarter(s) {', '.join(todo) or '-'}")
+    else:
+        extracts = extracts or {}
+        df = build(*[extracts[name] if name in extracts else load_call_report(name) for name in SOURCES])
+
+    acs = pd.read_csv("data/raw/ACS.csv")
+    sod = read_sod(['YEAR', 'METROBR'])
+    return finish(df, exposures(acs, sod, DepositMatrix.cached()))
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Build bank-quarter controls.")
+    ap.add_argument("--update", action="store_true",
+                    help="Compute ratios only for quarters missing from the output (after a new Call Report release).")
+    ap.add_argument("--workers", type=int, default=1, help="Processes for --update.")
+    args = ap.parse_args()
+    write_output(build_panel(update=args.update, workers=args.workers), OUTPUT_CSV)
+
+
+if __name__ == "__main__":
+    main()
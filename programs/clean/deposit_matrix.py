@@ -0,0 +1,180 @@
+"""
+Per-year bank × county deposit matrices from the FDIC Summary of Deposits (SOD).
+
+A DepositMatrix holds one SOD YEAR as a sparse (banks × counties) matrix of branch deposits
+(DEPSUMBR summed per bank and county). It is built once per SOD year and cached. Each
+deposit-weighted bank exposure is then a single sparse product, and each county market
+statistic is a column reduction, so a new deposit-weighted county characteristic takes one line:
+
+    years = DepositMatrix.cached()                            # {YEAR: DepositMatrix}
+    m = years[2021]
+    m.exposure(acs.set_index('fips')['median_hh_income'])     # fips-indexed county variable
+    m.exposure(m.county_hhi())                                # bank-weighted county deposit HHI
+    m.group_shares(division_of_county, DIVISION_NAMES)        # share of DEPDOM per group of counties
+    m.branch_exposure(read_sod(['METROBR'], years=[2021])['METROBR'])  # branch variable, that year's rows
+
+Branch weights are DEPSUMBR / DEPDOM, renormalized over the counties (or branches) where the
+variable is known. DEPDOM cancels in that ratio, so an exposure is Σ deposits · x / Σ deposits.
+Banks whose DEPDOM is missing or not positive get NaN. Counties are integer FIPS codes (geo.py);
+county inputs may be indexed by integer or 5-digit string FIPS. Results are indexed by RSSDID in
+ascending order.
+
+`python programs/clean/deposit_matrix.py` ingests the SOD and fills the cache ahead of the
+scripts that read it (the pipeline runner does this before control and instruments).
+"""
+import argparse
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from geo import fips_code
+from sod_store import SOD_PATH, STORE_DIR, read_sod, year_hashes
+
+CACHE_DIR = "data/cache/deposit_matrix"
+SOD_COLUMNS = ['YEAR', 'RSSDID', 'DEPDOM', 'DEPSUMBR', 'STCNTYBR']
+MATRIX_VERSION = 2  # part of the cache key; bump when the stored arrays change
+
+
+class DepositMatrix:
+    # Arrays that define a matrix; everything else is derived from them
+    FIELDS = ('banks', 'counties', 'rows', 'bank_pos', 'county_pos', 'deposits', 'depdom')
+
+    def __init__(self, year, banks, counties, rows, bank_pos, county_pos, deposits, depdom):
+        self.year = int(year)
+        self.banks, self.counties = np.asarray(banks), np.asarray(counties)
+        # Per branch: position among the YEAR's SOD rows, bank and county position, DEPSUMBR (NaN kept)
+        self.rows, self.bank_pos, self.county_pos, self.deposits = rows, bank_pos, county_pos, deposits
+        self.depdom = depdom                     # per bank (first non-missing branch value)
+        self.valid = depdom > 0
+        shape = (len(self.banks), len(self.counties))
+        # Duplicate (bank, county) pairs are summed; missing DEPSUMBR counts as 0, as groupby.sum did
+        self.matrix = sp.csr_matrix((np.nan_to_num(deposits), (bank_pos, county_pos)), shape=shape)
+        self.branch_counts = sp.csr_matrix((np.ones(len(bank_pos)), (bank_pos, county_pos)), shape=shape)
+        self.branches = np.bincount(bank_pos, minlength=shape[0])
+        self._bank_index = pd.Index(self.banks, name='RSSDID')
+
+    @classmethod
+    def from_sod(cls, sod: pd.DataFrame) -> dict:
+        """{YEAR: DepositMatrix} from SOD branch rows (needs the SOD_COLUMNS)."""
+        known = sod['RSSDID'].notna().to_numpy()
+        rssd = sod['RSSDID'].to_numpy(dtype='int64', na_value=-1)
+        fips = fips_code(sod['STCNTYBR'])
+        deposits = sod['DEPSUMBR'].to_numpy(dtype='float64', na_value=np.nan)
+        depdom = sod['DEPDOM'].to_numpy(dtype='float64', na_value=np.nan)
+        years = {}
+        for year, idx in sorted(sod.groupby('YEAR').indices.items()):
+            rows = np.flatnonzero(known[idx])
+            idx = idx[rows]
+            banks, bank_pos = np.unique(rssd[idx], return_inverse=True)
+            counties, county_pos = np.unique(fips[idx], return_inverse=True)
+            bank_depdom = pd.Series(depdom[idx]).groupby(bank_pos).first().reindex(range(len(banks)))
+            years[int(year)] = cls(year, banks, counties, rows, bank_pos, county_pos,
+                                   deposits[idx], bank_depdom.to_numpy(dtype='float64'))
+        return years
+
+    @classmethod
+    def cached(cls, years=None, sod_path=SOD_PATH, store_dir=STORE_DIR, cache_dir=CACHE_DIR) -> dict:
+        """
+        {YEAR: DepositMatrix} for `years` (default: every SOD year), one npz per year keyed by
+        the content hash of that year's SOD partition. Only missing years are built, reading
+        only their partitions, so a new SOD release leaves earlier years untouched.
+        """
+        hashes = year_hashes(sod_path, store_dir)
+        wanted = sorted(hashes if years is None else set(years) & set(hashes))
+        paths = {y: os.path.join(cache_dir, f"{y}-{hashes[y][:16]}-v{MATRIX_VERSION}.npz") for y in wanted}
+        out, missing = {}, [y for y in wanted if not os.path.exists(paths[y])]
+        if missing:
+            os.makedirs(cache_dir, exist_ok=True)
+            built = cls.from_sod(read_sod(SOD_COLUMNS, years=missing, sod_path=sod_path, store_dir=store_dir))
+            for y, m in built.items():
+                # Via a temp file unique to this process; hidden, so the cleanup below never sees it
+                fd, tmp = tempfile.mkstemp(dir=cache_dir, prefix=".", suffix=".tmp")
+                try:
+                    with os.fdopen(fd, "wb") as f:
+                        np.savez(f, **{k: getattr(m, k) for k in cls.FIELDS})
+                    os.replace(tmp, paths[y])
+                except BaseException:
+                    os.remove(tmp)
+                    raise
+                for old in os.listdir(cache_dir):  # earlier contents of the same year
+                    if old.startswith(f"{y}-") and old.endswith(".npz") and os.path.join(cache_dir, old) != paths[y]:
+                        os.remove(os.path.join(cache_dir, old))
+            out.update(built)
+        for y in wanted:
+            if y not in out:
+                z = np.load(paths[y], allow_pickle=False)
+                out[y] = cls(y, *(z[k] for k in cls.FIELDS))
+        return dict(sorted(out.items()))
+
+    # -- county side ---------------------------------------------------------
+    @staticmethod
+    def _by_code(county_values) -> pd.Series:
+        s = pd.Series(county_values)
+        return s.set_axis(fips_code(s.index))
+
+    def county_vector(self, county_values) -> np.ndarray:
+        """A FIPS-indexed Series aligned with the matrix columns (NaN for counties it lacks)."""
+        return self._by_code(county_values).reindex(self.counties).to_numpy(dtype='float64', na_value=np.nan)
+
+    def county_hhi(self) -> pd.Series:
+        """Deposit HHI per county on [0, 1]: Σ_banks (bank deposits / county deposits)²."""
+        total = np.asarray(self.matrix.sum(axis=0)).ravel()
+        sq = np.asarray(self.matrix.multiply(self.matrix).sum(axis=0)).ravel()
+        with np.errstate(divide="ignore", invalid="ignore"):
+            hhi = np.where(total > 0, sq / total ** 2, np.nan)
+        return pd.Series(hhi, index=pd.Index(self.counties, name='fips'), name='county_deposit_hhi')
+
+    # -- bank side -----------------------------------------------------------
+    def _per_bank(self, num, den, name) -> pd.Series:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            out = np.where(self.valid & (den > 0), num / den, np.nan)
+        return pd.Series(out, index=self._bank_index, name=name)
+
+    def exposure(self, county_values, name=None) -> pd.Series:
+        """Deposit-weighted mean of a county variable per bank, over counties where it is known."""
+        x = self.county_vector(county_values)
+        known = ~np.isnan(x)
+        return self._per_bank(self.matrix @ np.where(known, x, 0.0), self.matrix @ known.astype('float64'), name)
+
+    def branch_exposure(self, branch_values, name=None) -> pd.Series:
+        """Deposit-weighted mean of a branch variable given for every SOD row of the matrix's YEAR."""
+        v = pd.Series(branch_values).to_numpy(dtype='float64', na_value=np.nan)[self.rows]
+        known = ~np.isnan(v) & ~np.isnan(self.deposits)
+        d = np.where(known, self.deposits, 0.0)
+        n = len(self.banks)
+        num = np.bincount(self.bank_pos, weights=d * np.where(known, v, 0.0), minlength=n)
+        return self._per_bank(num, np.bincount(self.bank_pos, weights=d, minlength=n), name)
+
+    def group_shares(self, county_groups, groups) -> pd.DataFrame:
+        """
+        Share of each bank's DEPDOM held in each group of counties (county_groups: fips-indexed
+        labels such as census division; one column per entry of groups). As with the pivot this
+        replaces, a bank whose DEPDOM is not positive gets 0s, and a bank with no branch in a
+        labelled county gets NaN.
+        """
+        col = pd.Index(list(groups)).get_indexer(self._by_code(county_groups).reindex(self.counties))
+        hit = col >= 0
+        g = sp.csr_matrix((np.ones(int(hit.sum())), (np.flatnonzero(hit), col[hit])),
+                          shape=(len(self.counties), len(groups)))
+        deposits = (self.matrix @ g).toarray()
+        reached = np.asarray((self.branch_counts @ g).sum(axis=1)).ravel() > 0
+        with np.errstate(divide="ignore", invalid="ignore"):
+            shares = np.where(self.valid[:, None], deposits / self.depdom[:, None], 0.0)
+        shares[~reached] = np.nan
+        return pd.DataFrame(shares, index=self._bank_index, columns=list(groups))
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Build and cache the per-year SOD deposit matrices.")
+    ap.add_argument("--sod", default=SOD_PATH)
+    ap.add_argument("--store", default=STORE_DIR)
+    args = ap.parse_args()
+    for year, m in DepositMatrix.cached(sod_path=args.sod, store_dir=args.store).items():
+        print(f"  {year}: {len(m.banks):,} banks x {len(m.counties):,} counties, {m.matrix.nnz:,} bank-county cells")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,47 @@
 import pandas as pd
 import numpy as np
 
-df = pd.read_csv("data/raw/ffr_upper_limit.csv")
+from panel_store import publish
 
-df.rename(columns={'date': 'Date'}, inplace=True)
+RAW_CSV = "data/raw/ffr_upper_limit.csv"
+OUTPUT_CSV = "data/processed/ffr_quarterly.csv"
 
-df['Date'] = pd.to_datetime(df['Date'], errors='coerce')
-df = df.dropna(subset=['Date']).copy()
-df.sort_values('Date', inplace=True)
 
-# Resample to quarter-end using the last available daily value in the quarter
-q = (
-    df.set_index('Date')
-      .resample('Q')
-      .last()
-      .reset_index()
-)
+def build(df=None):
+    """Quarterly FFR upper limit with its changes, 2022Q1-2024Q2 (df: the raw daily series)."""
+    df = pd.read_csv(RAW_CSV) if df is None else df.copy()
 
-# Quarter-over-quarter change in the FFR upper limit (level differences, in p.p.)
-q['d_ffr'] = q['ffr_upper'].diff()
+    df.rename(columns={'date': 'Date'}, inplace=True)
 
-# Keep only quarters from 2022Q1 to 2024Q2 (inclusive)
-q = q[(q['Date'] >= pd.Timestamp('2022-01-01')) & (q['Date'] <= pd.Timestamp('2024-06-30'))].copy()
+    df['Date'] = pd.to_datetime(df['Date'], errors='coerce')
+    df = df.dropna(subset=['Date']).copy()
+    df.sort_values('Date', inplace=True)
 
-# Cumulative change since 2022Q1
-base = q['ffr_upper'].iloc[0] if len(q) else np.nan
-q['cum_d_ffr'] = q['ffr_upper'] - base + 0.25
+    # Resample to quarter-end using the last available daily value in the quarter
+    q = (
+        df.set_index('Date')
+          .resample('Q')
+          .last()
+          .reset_index()
+    )
 
-q.to_csv("data/processed/ffr_quarterly.csv", index=False)
+    # Quarter-over-quarter change in the FFR upper limit (level differences, in p.p.)
+    q['d_ffr'] = q['ffr_upper'].diff()
+
+    # Keep only quarters from 2022Q1 to 2024Q2 (inclusive)
+    q = q[(q['Date'] >= pd.Timestamp('2022-01-01')) & (q['Date'] <= pd.Timestamp('2024-06-30'))].copy()
+
+    # Cumulative change since 2022Q1
+    base = q['ffr_upper'].iloc[0] if len(q) else np.nan
+    q['cum_d_ffr'] = q['ffr_upper'] - base + 0.25
+    return q
+
+
+def main():
+    q = build()
+    q.to_csv(OUTPUT_CSV, index=False)
+    publish(q, OUTPUT_CSV)
+
+
+if __name__ == "__main__":
+    main()
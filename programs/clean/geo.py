@@ -0,0 +1,130 @@
+"""
+Integer county FIPS codes and state lookups shared by the clean stage.
+
+A county is an integer code, state * 1000 + county (1001 is Autauga County, AL), with -1 for a
+missing or unparseable code. Geographic joins are then integer joins, and state attributes are
+NumPy arrays indexed by state code, so mapping millions of rows is one array index:
+
+    code = fips_code(sod['STCNTYBR'])      # '01001', 1001, 1001.0 -> 1001
+    state_usps(code)                       # 'AL'
+    census_division(code)                  # 'East South Central'
+    fips_str(code)                         # '01001', for CSV outputs and string-keyed inputs
+
+Five-character strings appear only at the edges, for the CSVs other stages read.
+"""
+import numpy as np
+import pandas as pd
+
+# State (USPS) -> Census Division name
+STATE_TO_CENSUS_DIVISION = {
+    # 1) New England
+    "CT": "New England", "ME": "New England", "MA": "New England",
+    "NH": "New England", "RI": "New England", "VT": "New England",
+    # 2) Middle Atlantic
+    "NJ": "Middle Atlantic", "NY": "Middle Atlantic", "PA": "Middle Atlantic",
+    # 3) East North Central
+    "IL": "East North Central", "IN": "East North Central", "MI": "East North Central",
+    "OH": "East North Central", "WI": "East North Central",
+    # 4) West North Central
+    "IA": "West North Central", "KS": "West North Central", "MN": "West North Central",
+    "MO": "West North Central", "NE": "West North Central", "ND": "West North Central",
+    "SD": "West North Central",
+    # 5) South Atlantic (includes DC)
+    "DE": "South Atlantic", "DC": "South Atlantic", "FL": "South Atlantic",
+    "GA": "South Atlantic", "MD": "South Atlantic", "NC": "South Atlantic",
+    "SC": "South Atlantic", "VA": "South Atlantic", "WV": "South Atlantic",
+    # 6) East South Central
+    "AL": "East South Central", "KY": "East South Central",
+    "MS": "East South Central", "TN": "East South Central",
+    # 7) West South Central
+    "AR": "West South Central", "LA": "West South Central",
+    "OK": "West South Central", "TX": "West South Central",
+    # 8) Mountain
+    "AZ": "Mountain", "CO": "Mountain", "ID": "Mountain", "MT": "Mountain",
+    "NV": "Mountain", "NM": "Mountain", "UT": "Mountain", "WY": "Mountain",
+    # 9) Pacific
+    "AK": "Pacific", "CA": "Pacific", "HI": "Pacific", "OR": "Pacific", "WA": "Pacific",
+}
+DIVISION_NAMES = [
+    "New England",
+    "Middle Atlantic",
+    "East North Central",
+    "West North Central",
+    "South Atlantic",
+    "East South Central",
+    "West South Central",
+    "Mountain",
+    "Pacific",
+]
+# Two-character codes per division
+DIVISION_CODE_MAP = {
+    "New England": "NE",
+    "Middle Atlantic": "MA",
+    "East North Central": "EC",
+    "West North Central": "WC",
+    "South Atlantic": "SA",
+    "East South Central": "ES",
+    "West South Central": "WS",
+    "Mountain": "MT",
+    "Pacific": "PC",
+}
+# FIPS state code -> USPS
+STATE_FIPS_TO_USPS = {
+    1: "AL", 2: "AK", 4: "AZ", 5: "AR", 6: "CA",
+    8: "CO", 9: "CT", 10: "DE", 11: "DC", 12: "FL",
+    13: "GA", 15: "HI", 16: "ID", 17: "IL", 18: "IN",
+    19: "IA", 20: "KS", 21: "KY", 22: "LA", 23: "ME",
+    24: "MD", 25: "MA", 26: "MI", 27: "MN", 28: "MS",
+    29: "MO", 30: "MT", 31: "NE", 32: "NV", 33: "NH",
+    34: "NJ", 35: "NM", 36: "NY", 37: "NC", 38: "ND",
+    39: "OH", 40: "OK", 41: "OR", 42: "PA", 44: "RI",
+    45: "SC", 46: "SD", 47: "TN", 48: "TX", 49: "UT",
+    50: "VT", 51: "VA", 53: "WA", 54: "WV", 55: "WI",
+    56: "WY",
+    # Territories (not mapped to divisions; their division is NaN)
+    60: "AS", 66: "GU", 69: "MP", 72: "PR", 78: "VI",
+}
+
+# Lookup arrays indexed by state code (0-99); NaN / -1 where a code has no state or division
+STATE_USPS = np.full(100, np.nan, dtype=object)
+STATE_USPS[list(STATE_FIPS_TO_USPS)] = list(STATE_FIPS_TO_USPS.values())
+STATE_DIVISION = np.full(100, -1, dtype=np.int8)
+for _state, _usps in STATE_FIPS_TO_USPS.items():
+    if _usps in STATE_TO_CENSUS_DIVISION:
+        STATE_DIVISION[_state] = DIVISION_NAMES.index(STATE_TO_CENSUS_DIVISION[_usps])
+DIVISION_NAME = np.array(DIVISION_NAMES + [np.nan], dtype=object)   # DIVISION_NAME[-1] is NaN
+
+
+def fips_code(values) -> np.ndarray:
+    """County FIPS (strings, integers or floats) as int32 codes; -1 where missing or not a code."""
+    x = pd.to_numeric(pd.Series(values), errors="coerce").to_numpy(dtype="float64", na_value=np.nan)
+    ok = (x >= 0) & (x < 100_000) & (x == np.floor(x))
+    return np.where(ok, x, -1).astype(np.int32)
+
+
+def fips_str(codes) -> np.ndarray:
+    """Five-character FIPS strings for integer codes (NaN for -1)."""
+    codes = np.asarray(codes)
+    uniq, inv = np.unique(codes, return_inverse=True)
+    text = np.array([f"{c:05d}" if c >= 0 else np.nan for c in uniq.tolist()], dtype=object)
+    return text[inv]
+
+
+def state_code(codes) -> np.ndarray:
+    codes = np.asarray(codes)
+    return np.where(codes >= 0, codes // 1000, -1)
+
+
+def state_usps(codes) -> np.ndarray:
+    s = state_code(codes)
+    return np.where(s >= 0, STATE_USPS[np.clip(s, 0, 99)], np.nan)
+
+
+def division_index(codes) -> np.ndarray:
+    """Census division per county as an index into DIVISION_NAMES; -1 for none."""
+    s = state_code(codes)
+    return np.where(s >= 0, STATE_DIVISION[np.clip(s, 0, 99)], -1)
+
+
+def census_division(codes) -> np.ndarray:
+    return DIVISION_NAME[division_index(codes)]
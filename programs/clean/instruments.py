@@ -1,8 +1,13 @@
 """Builds a bank-level panel combining county sophistication and deposit concentration measures.
 
+How to run
+  python programs/clean/instruments.py
+  python programs/clean/instruments.py --update   # after a new SOD release: only new/changed years
+
 Inputs
 - data/raw/SOD.csv: FDIC SOD extract with at least YEAR, RSSDID, NAMEFULL, ASSET, BKCLASS,
   DEPDOM (bank total domestic deposits), DEPSUMBR (branch deposits), STCNTYBR (county FIPS).
+  Read through the YEAR-partitioned store in data/cache/sod (see sod_store.py).
 - data/processed/sophistication_index.csv: county-level sophistication index with 'fips'.
 
 Output
@@ -12,11 +17,25 @@ Output
 Notes
 - Branch weights use DEPSUMBR / DEPDOM and are renormalized when some counties lack an index.
 - County HHI is on [0, 1] (not multiplied by 10,000).
+- Exposures come from a per-year sparse bank x county deposit matrix cached under
+  data/cache/deposit_matrix (see deposit_matrix.py); each is one matrix-vector product.
+- Unstandardized bank rows are cached per SOD YEAR in data/cache/instruments. --update recomputes
+  only years whose SOD partition (or the sophistication index) changed, then z-scores all years.
 - The retained 'fips' in the final dataframe corresponds to an arbitrary branch; drop if undesired.
 """
+import argparse
+import hashlib
+import os
+import tempfile
+
 import pandas as pd
 import numpy as np
 
+from deposit_matrix import DepositMatrix
+from geo import DIVISION_CODE_MAP, DIVISION_NAMES, census_division, fips_code, fips_str, state_usps
+from panel_store import publish
+from sod_store import read_sod, year_hashes
+
 # Build a bank-level dataset with:
 # - County sophistication index merged by county FIPS (from precomputed file)
 # - Bank-level weighted sophistication index (weights = branch deposits / bank total deposits)
@@ -24,243 +43,117 @@ import numpy as np
 # - Bank-level exposure to county HHI (deposit-weighted average of county HHIs across a bank's footprint)
 # - Bank-level branch density (number of branches per $1B of DEPDOM)
 
-# State (USPS) -> Census Division name
-STATE_TO_CENSUS_DIVISION = {
-    # 1) New England
-    "CT": "New England", "ME": "New England", "MA": "New England",
-    "NH": "New England", "RI": "New England", "VT": "New England",
-    # 2) Middle Atlantic
-    "NJ": "Middle Atlantic", "NY": "Middle Atlantic", "PA": "Middle Atlantic",
-    # 3) East North Central
-    "IL": "East North Central", "IN": "East North Central", "MI": "East North Central",
-    "OH": "East North Central", "WI": "East North Central",
-    # 4) West North Central
-    "IA": "West North Central", "KS": "West North Central", "MN": "West North Central",
-    "MO": "West North Central", "NE": "West North Central", "ND": "West North Central",
-    "SD": "West North Central",
-    # 5) South Atlantic (includes DC)
-    "DE": "South Atlantic", "DC": "South Atlantic", "FL": "South Atlantic",
-    "GA": "South Atlantic", "MD": "South Atlantic", "NC": "South Atlantic",
-    "SC": "South Atlantic", "VA": "South Atlantic", "WV": "South Atlantic",
-    # 6) East South Central
-    "AL": "East South Central", "KY": "East South Central",
-    "MS": "East South Central", "TN": "East South Central",
-    # 7) West South Central
-    "AR": "West South Central", "LA": "West South Central",
-    "OK": "West South Central", "TX": "West South Central",
-    # 8) Mountain
-    "AZ": "Mountain", "CO": "Mountain", "ID": "Mountain", "MT": "Mountain",
-    "NV": "Mountain", "NM": "Mountain", "UT": "Mountain", "WY": "Mountain",
-    # 9) Pacific
-    "AK": "Pacific", "CA": "Pacific", "HI": "Pacific", "OR": "Pacific", "WA": "Pacific",
-}
-DIVISION_NAMES = [
-    "New England",
-    "Middle Atlantic",
-    "East North Central",
-    "West North Central",
-    "South Atlantic",
-    "East South Central",
-    "West South Central",
-    "Mountain",
-    "Pacific",
-]
-# FIPS (2-digit string) -> USPS
-STATE_FIPS_TO_USPS = {
-    "01": "AL", "02": "AK", "04": "AZ", "05": "AR", "06": "CA",
-    "08": "CO", "09": "CT", "10": "DE", "11": "DC", "12": "FL",
-    "13": "GA", "15": "HI", "16": "ID", "17": "IL", "18": "IN",
-    "19": "IA", "20": "KS", "21": "KY", "22": "LA", "23": "ME",
-    "24": "MD", "25": "MA", "26": "MI", "27": "MN", "28": "MS",
-    "29": "MO", "30": "MT", "31": "NE", "32": "NV", "33": "NH",
-    "34": "NJ", "35": "NM", "36": "NY", "37": "NC", "38": "ND",
-    "39": "OH", "40": "OK", "41": "OR", "42": "PA", "44": "RI",
-    "45": "SC", "46": "SD", "47": "TN", "48": "TX", "49": "UT",
-    "50": "VT", "51": "VA", "53": "WA", "54": "WV", "55": "WI",
-    "56": "WY",
-    # Territories (not mapped to divisions; will become NaN and be ignored)
-    "60": "AS", "66": "GU", "69": "MP", "72": "PR", "78": "VI",
-}
-
-sod = pd.read_csv("data/raw/SOD.csv")
-sophistication_index = pd.read_csv("data/processed/sophistication_index.csv")
-
-# Keep only the columns required for this build (helps memory and ensures consistent inputs).
-sod_mask = ['YEAR', 'RSSDID', 'NAMEFULL', 'ASSET', 'BKCLASS', 'DEPDOM', 'DEPSUMBR', 'STCNTYBR']
-sod = sod[sod_mask]
-
-sod['STCNTYBR'] = sod['STCNTYBR'].astype(str).str.zfill(5)  # standardize county FIPS format
-sod.rename(columns={'STCNTYBR': 'fips'}, inplace=True)      # use a consistent 'fips' column
-
-# Map branches to census divisions via state inferred from FIPS.
-sod['state_fips'] = sod['fips'].str[:2]
-sod['state_usps'] = sod['state_fips'].map(STATE_FIPS_TO_USPS)
-sod['census_division'] = sod['state_usps'].map(STATE_TO_CENSUS_DIVISION)
-
-# Branch weight = branch deposits / bank total domestic deposits.
-# Summing weights across all branches of a bank yields ~1. For banks with missing or zero DEPDOM,
-# weights will be NaN/inf and naturally drop out of later averages via the renormalization step.
-sod['weight'] = sod['DEPSUMBR'] / sod['DEPDOM']
-
-# Ensure FIPS is standardized to 5 digits in both sources and merge the county sophistication index.
-sophistication_index['fips'] = sophistication_index['fips'].astype(str).str.zfill(5)
-sod = sod.merge(sophistication_index[['fips', 'sophistication_index']], on='fips', how='left')
-
-# Bank-level branch density BEFORE HHI: branches per $1B of DEPDOM.
-# Count branches per (YEAR, RSSDID) and divide by bank DEPDOM (in billions).
-branch_count = (
-    sod.groupby(['YEAR', 'RSSDID'])
-    .size()
-    .reset_index(name='branch_count')
-)
-
-# DEPDOM in SOD is bank-level total domestic deposits (same for all branches of a bank-year),
-# so we can safely take .first().
-bank_depdom = sod.groupby(['YEAR', 'RSSDID'], as_index=False)['DEPDOM'].first()
-
-branch_density_df = branch_count.merge(bank_depdom, on=['YEAR', 'RSSDID'], how='left')
-
-# Convert DEPDOM to billions of dollars
-branch_density_df['DEPDOM_bil'] = branch_density_df['DEPDOM'] / 1_000_000_000
-
-# Branches per $1B of DEPDOM
-branch_density_df['branch_density'] = np.where(
-    branch_density_df['DEPDOM'] > 0,
-    branch_density_df['branch_count'] / branch_density_df['DEPDOM_bil'],
-    np.nan,
-)
-
-branch_density_df['branch_density'] = np.log(branch_density_df['branch_density'] + 1)
-
-# Division deposit shares per bank-year: % of bank deposits in each census division (0–1).
-# We compute as sum(DEPSUMBR in division) / DEPDOM for the bank-year.
-division_deposits = (
-    sod.dropna(subset=['census_division'])
-    .groupby(['YEAR', 'RSSDID', 'census_division'], as_index=False)['DEPSUMBR']
-    .sum()
-    .rename(columns={'DEPSUMBR': 'division_deposits'})
-)
-division_share = division_deposits.merge(bank_depdom, on=['YEAR', 'RSSDID'], how='left')
-division_share['division_share'] = (
-    (division_share['division_deposits'] / division_share['DEPDOM']).where(division_share['DEPDOM'] > 0)
-)
-division_pivot = (
-    division_share.pivot(index=['YEAR', 'RSSDID'], columns='census_division', values='division_share')
-    .fillna(0)
-    .reset_index()
-)
-# Ensure all 9 divisions are present as columns; if absent, create with 0.
-for div_name in DIVISION_NAMES:
-    if div_name not in division_pivot.columns:
-        division_pivot[div_name] = 0.0
-# Rename columns to two-character codes per division
-DIVISION_CODE_MAP = {
-    "New England": "NE",
-    "Middle Atlantic": "MA",
-    "East North Central": "EC",
-    "West North Central": "WC",
-    "South Atlantic": "SA",
-    "East South Central": "ES",
-    "West South Central": "WS",
-    "Mountain": "MT",
-    "Pacific": "PC",
-}
-division_pivot = division_pivot.rename(columns=DIVISION_CODE_MAP)
-
-# Compute bank-level weighted sophistication index (by YEAR, RSSDID).
-# We weight county sophistication by the bank's deposit distribution. Because some counties can
-# be missing an index, we divide by the sum of weights with non-missing sophistication to re-scale.
-valid = sod.dropna(subset=['sophistication_index']).copy()
-valid['weighted_sophistication_component'] = valid['sophistication_index'] * valid['weight']
-bank_agg = (
-    valid.groupby(['YEAR', 'RSSDID'], as_index=False)
-    .agg(
-        bank_weight_sum=('weight', 'sum'),
-        bank_weighted_sum=('weighted_sophistication_component', 'sum'),
-    )
-)
-bank_agg['bank_weighted_sophistication_index'] = (
-    bank_agg['bank_weighted_sum'] / bank_agg['bank_weight_sum']
-).where(bank_agg['bank_weight_sum'] > 0)
-
-# County-level deposit HHI using branch deposits within each county-year.
-# HHI_county = sum_banks ( (bank deposits in county / total county deposits)^2 ), on [0, 1].
-# 1) Sum branch deposits to bank-by-county totals
-county_bank = (
-    sod.groupby(['YEAR', 'fips', 'RSSDID'], as_index=False)['DEPSUMBR']
-    .sum()
-    .rename(columns={'DEPSUMBR': 'bank_county_deposits'})
-)
-# 2) County total deposits (sum of all branches in county)
-county_total = (
-    sod.groupby(['YEAR', 'fips'], as_index=False)['DEPSUMBR']
-    .sum()
-    .rename(columns={'DEPSUMBR': 'county_total_deposits'})
-)
-# 3) Market shares and HHI per county
-shares = county_bank.merge(county_total, on=['YEAR', 'fips'], how='left')
-shares['county_share'] = shares['bank_county_deposits'] / shares['county_total_deposits']
-shares['sq_share'] = shares['county_share'] ** 2
-county_hhi = (
-    shares.groupby(['YEAR', 'fips'], as_index=False)['sq_share']
-    .sum()
-    .rename(columns={'sq_share': 'county_deposit_hhi'})
-)
-
-# Bank-level exposure to county HHI: deposit-weighted average of county HHIs across a bank's footprint.
-# The weight per county is the bank's total branch-deposit share in that county (summing branch weights).
-bank_county_weight = (
-    sod.groupby(['YEAR', 'RSSDID', 'fips'], as_index=False)['weight']
-    .sum()
-    .rename(columns={'weight': 'bank_county_weight'})
-)
-bank_hhi = bank_county_weight.merge(county_hhi, on=['YEAR', 'fips'], how='left')
-bank_hhi['weighted_hhi_component'] = bank_hhi['bank_county_weight'] * bank_hhi['county_deposit_hhi']
-bank_hhi = (
-    bank_hhi.groupby(['YEAR', 'RSSDID'], as_index=False)
-    .agg(sum_w=('bank_county_weight', 'sum'), sum_ws=('weighted_hhi_component', 'sum'))
-)
-bank_hhi['bank_weighted_county_deposit_hhi'] = (
-    bank_hhi['sum_ws'] / bank_hhi['sum_w']
-).where(bank_hhi['sum_w'] > 0)
-
-# Build bank-level dataframe: one row per (YEAR, RSSDID), dropping branch-only columns.
-# We keep the first occurrence for identifier columns (e.g., NAMEFULL, ASSET, BKCLASS, DEPDOM).
-# Any 'fips' retained here corresponds to one arbitrary branch row and is not bank-level.
-df_base = sod.drop(columns=['DEPSUMBR', 'weight'])
-df = (
-    df_base.sort_values(['YEAR', 'RSSDID'])
-    .drop_duplicates(['YEAR', 'RSSDID'])
-)
-df = df.merge(
-    bank_agg[['YEAR', 'RSSDID', 'bank_weighted_sophistication_index']],
-    on=['YEAR', 'RSSDID'],
-    how='left'
-)
-df = df.merge(
-    bank_hhi[['YEAR', 'RSSDID', 'bank_weighted_county_deposit_hhi']],
-    on=['YEAR', 'RSSDID'],
-    how='left'
-)
-df = df.merge(
-    branch_density_df[['YEAR', 'RSSDID', 'branch_density']],
-    on=['YEAR', 'RSSDID'],
-    how='left'
-)
-df = df.merge(
-    division_pivot[['YEAR', 'RSSDID'] + list(DIVISION_CODE_MAP.values())],
-    on=['YEAR', 'RSSDID'],
-    how='left'
-)
-
-df.drop(columns=['sophistication_index'], inplace=True)
-
-# Standardize SI and HHI across all bank-year observations (z-scores).
-# Columns are renamed to *_z and then z-scored. If a series is constant (std=0), the result is NaN.
-df.rename(columns={'bank_weighted_sophistication_index': 'sophistication_index_z', 'bank_weighted_county_deposit_hhi': 'hhi_z', 'branch_density': 'branch_density_z'}, inplace=True)
-df['sophistication_index_z'] = (df['sophistication_index_z'] - df['sophistication_index_z'].mean()) / df['sophistication_index_z'].std()
-df['hhi_z'] = (df['hhi_z'] - df['hhi_z'].mean()) / df['hhi_z'].std()
-df['branch_density_z'] = (df['branch_density_z'] - df['branch_density_z'].mean()) / df['branch_density_z'].std()
-
-# Write the final panel.
-df.to_csv("data/processed/instruments.csv", index=False)
\ No newline at end of file
+# Read only the columns required for this build from the YEAR-partitioned SOD store
+# (sod_store.py; ingested from data/raw/SOD.csv on first use). Branch deposits are read by
+# DepositMatrix.cached().
+sod_mask = ['YEAR', 'RSSDID', 'NAMEFULL', 'ASSET', 'BKCLASS', 'DEPDOM', 'STCNTYBR']
+SOPHISTICATION_CSV = "data/processed/sophistication_index.csv"
+OUTPUT_CSV = "data/processed/instruments.csv"
+# Unstandardized bank rows per SOD YEAR; bump CACHE_VERSION when build_year() changes
+CACHE_DIR = "data/cache/instruments"
+CACHE_VERSION = 2
+Z_COLUMNS = {'bank_weighted_sophistication_index': 'sophistication_index_z',
+             'bank_weighted_county_deposit_hhi': 'hhi_z', 'branch_density': 'branch_density_z'}
+
+
+def build_year(sod, m, county_sophistication):
+    """Bank rows for one SOD YEAR (sod: that year's rows, m: its DepositMatrix), not yet z-scored."""
+    # Census division of every county in the matrix, via the state part of its FIPS code.
+    county_division = pd.Series(census_division(m.counties), index=m.counties)
+
+    # Bank-level exposures from the bank x county deposit matrix
+    # (weights = branch deposits / bank total domestic deposits, see deposit_matrix.py):
+    # - sophistication: deposit-weighted county index, renormalized over counties that have one
+    # - county deposit HHI: sum over banks of squared county deposit shares, on [0, 1]; the bank
+    #   exposure is its deposit-weighted average across the bank's footprint
+    # - branch density: log(1 + branches per $1B of DEPDOM)
+    # - division shares: sum(DEPSUMBR in division) / DEPDOM, 0-1 per census division
+    bank = pd.DataFrame({
+        'bank_weighted_sophistication_index': m.exposure(county_sophistication),
+        'bank_weighted_county_deposit_hhi': m.exposure(m.county_hhi()),
+    })
+    with np.errstate(divide='ignore', invalid='ignore'):
+        bank['branch_density'] = np.log(np.where(m.valid, m.branches / (m.depdom / 1_000_000_000), np.nan) + 1)
+    bank = bank.join(m.group_shares(county_division, DIVISION_NAMES).rename(columns=DIVISION_CODE_MAP))
+
+    # Build bank-level dataframe: one row per RSSDID, dropping branch-only columns.
+    # We keep the first occurrence for identifier columns (e.g., NAMEFULL, ASSET, BKCLASS, DEPDOM).
+    # Any 'fips' retained here corresponds to one arbitrary branch row and is not bank-level.
+    df = sod[sod_mask].sort_values('RSSDID', kind='stable').drop_duplicates('RSSDID')
+    code = fips_code(df.pop('STCNTYBR'))
+    df['fips'] = fips_str(code)                                 # 5-digit county FIPS, as before
+    df['state_fips'] = df['fips'].str[:2]
+    df['state_usps'] = state_usps(code)
+    df['census_division'] = census_division(code)
+    return df.merge(bank.reset_index(), on='RSSDID', how='left')
+
+
+def standardize(df):
+    # Standardize SI and HHI across all bank-year observations (z-scores).
+    # Columns are renamed to *_z and then z-scored. If a series is constant (std=0), the result is NaN.
+    df = df.rename(columns=Z_COLUMNS)
+    for col in Z_COLUMNS.values():
+        df[col] = (df[col] - df[col].mean()) / df[col].std()
+    return df
+
+
+def _year_cache(year, partition_sha, inputs_sha):
+    key = hashlib.sha256(f"{CACHE_VERSION}|{partition_sha}|{inputs_sha}".encode("utf-8")).hexdigest()[:16]
+    return os.path.join(CACHE_DIR, f"{year}-{key}.parquet")
+
+
+def build_panel(sophistication_index=None, update=False):
+    """
+    The standardized bank-year panel. sophistication_index: the county index frame (default:
+    read from SOPHISTICATION_CSV); update: reuse cached years whose inputs are unchanged.
+    """
+    # County-level inputs, indexed by integer county FIPS.
+    if sophistication_index is None:
+        sophistication_index = pd.read_csv(SOPHISTICATION_CSV)
+    county_sophistication = pd.Series(sophistication_index['sophistication_index'].to_numpy(),
+                                      index=fips_code(sophistication_index['fips']))
+
+    # Per-year bank rows are cached under the content hashes of the year's SOD partition and of
+    # the county index; --update reuses every year whose hashes are unchanged
+    inputs_sha = hashlib.sha256(pd.util.hash_pandas_object(county_sophistication).to_numpy().tobytes()).hexdigest()
+    paths = {year: _year_cache(year, sha, inputs_sha) for year, sha in year_hashes().items()}
+    todo = [year for year, path in paths.items() if not (update and os.path.exists(path))]
+    if update:
+        print(f"Reusing {len(paths) - len(todo)} cached SOD year(s); computing {len(todo)}: "
+              f"{', '.join(map(str, todo)) or '-'}")
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    sod = read_sod(sod_mask, years=todo) if todo else None
+    for year, m in DepositMatrix.cached(years=todo).items():
+        # Via a temp file unique to this process; hidden, so the cleanup below never sees it
+        fd, tmp = tempfile.mkstemp(dir=CACHE_DIR, prefix=".", suffix=".tmp")
+        os.close(fd)
+        try:
+            build_year(sod[sod['YEAR'] == year], m, county_sophistication).to_parquet(tmp, index=False)
+            os.replace(tmp, paths[year])
+        except BaseException:
+            os.remove(tmp)
+            raise
+    for old in os.listdir(CACHE_DIR):  # earlier contents of each year
+        prefix = old.split("-")[0]
+        if (old.endswith(".parquet") and prefix.isdigit() and int(prefix) in paths
+                and os.path.join(CACHE_DIR, old) != paths[int(prefix)]):
+            os.remove(os.path.join(CACHE_DIR, old))
+
+    # The cross-year standardization is the only step that needs every year; it runs on the
+    # cached raw values.
+    df = pd.concat([pd.read_parquet(paths[year]) for year in sorted(paths)], ignore_index=True)
+    return standardize(df)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Build bank-level instruments from SOD and the sophistication index.")
+    ap.add_argument("--update", action="store_true",
+                    help="Recompute only SOD years that are new or changed (after a new SOD release).")
+    args = ap.parse_args()
+    df = build_panel(update=args.update)
+    df.to_csv(OUTPUT_CSV, index=False)
+    publish(df, OUTPUT_CSV)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+"""
+Dense bank × quarter view of a bank-quarter panel for lags, diffs and growth rates.
+
+PanelCube.from_frame() maps each row of a panel onto (bank index, quarter index), where the
+quarter index counts calendar quarters from the first one in the data, so a bank that skips a
+quarter has a hole in its row of the cube rather than a neighbour. Every operation scatters a
+row-aligned series into a (banks × quarters) float array, takes a strided slice, and gathers
+the result back into row order. Lags and leads skip the float cube altogether: the cube of row
+numbers is shifted once per offset, so each lag after the first is a single gather:
+
+    cube = PanelCube.from_frame(df)                  # df: rows keyed by (rssd9001, rssd9999)
+    df['lag_x'] = cube.lag(df['x'])                  # x one quarter earlier, NaN across a gap
+    df['d_x'] = cube.diff(df['x'])                   # x - lag(x)
+    df['g_x'] = cube.growth(df['x'])                 # (x - lag) / lag, NaN when lag == 0
+    df['avg_x'] = cube.mean2(df['x'])                # (x + lag(x)) / 2
+    flows, gap = cube.ytd_to_quarterly(df[ytd_cols]) # YTD income items -> quarterly flows
+
+Cumulative, rolling and since-base quantities take a Series or a DataFrame of several columns
+and run as one pass over a (banks × quarters × columns) array. A row mask blanks rows outside a
+subsample, e.g. banks present in the panel's first quarter:
+
+    first = cube.in_quarter(0)                       # per row: bank has a row in the first quarter
+    cums = cube.cumsum(df[cols], rows=first)         # running sum, NaN counted as 0
+    cube.rolling_mean(df['x'], 4)                    # mean over the last 4 calendar quarters
+    cube.since_base(df['x'])                         # x minus the bank's first-quarter value
+
+Unlike groupby(bank).shift(1) on a sorted frame, nothing here depends on row order, and a
+missing quarter yields NaN instead of pairing the observations on either side of the gap.
+Series passed in must be aligned with the frame the cube was built from (same rows, same
+order). Rows with no bank id or date are kept but get NaN from every operation.
+
+The bank axis is the panel unit: rssd9001 by default, or several columns, e.g.
+from_frame(df, id_col=['rssd9001', 'rssd9050']) for frames keyed by bank and cert. A frame can
+still hold more than one row per (unit, quarter), as the working panel does once each bank
+carries one instrument row per SOD YEAR. Such rows are not an error. The k-th row of a unit's
+quarter (in frame order) is treated as its own unit and lags to the k-th row of the unit's
+previous quarter, so repeated blocks that keep the same order line up quarter to quarter.
+"""
+import numpy as np
+import pandas as pd
+
+
+def quarter_ordinal(dates) -> np.ndarray:
+    """Calendar quarter count (year * 4 + quarter - 1) per date; -1 where the date is missing."""
+    # A panel has few distinct dates: parse those once and broadcast back
+    codes, uniques = pd.factorize(pd.Series(dates))
+    d = pd.Series(uniques)
+    if not pd.api.types.is_datetime64_any_dtype(d):
+        d = pd.to_datetime(d, errors="coerce", format="ISO8601")
+    q = (d.dt.year * 4 + (d.dt.month - 1) // 3).fillna(-1).to_numpy(dtype=np.int64)
+    return np.where(codes >= 0, q[codes], -1)
+
+
+class PanelCube:
+    def __init__(self, bank_pos: np.ndarray, quarter_pos: np.ndarray, n_banks: int, n_quarters: int,
+                 first_quarter: int):
+        self.bank_pos = bank_pos
+        self.quarter_pos = quarter_pos
+        self.shape = (n_banks, n_quarters)
+        self.first_quarter = first_quarter
+        self.n_repeated = 0
+        self.unit_pos = bank_pos  # panel unit per row, before repeated rows are split off
+        self.placed = (bank_pos >= 0) & (quarter_pos >= 0)
+        self._bi = bank_pos[self.placed]
+        self._qi = quarter_pos[self.placed]
+        # Row number at each (bank, quarter); -1 where the panel has no row
+        self.rows = np.full(self.shape, -1, dtype=np.int64)
+        self.rows[self._bi, self._qi] = np.flatnonzero(self.placed)
+        self._neighbours = {}
+
+    @property
+    def present(self) -> np.ndarray:
+        """Presence mask: True where the panel has a row."""
+        return self.rows >= 0
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame, id_col="rssd9001", date_col: str = "rssd9999") -> "PanelCube":
+        """
+        Cube of df's rows. id_col names the panel unit: a column, or a list of columns such as
+        ['rssd9001', 'rssd9050']. Rows that repeat a (unit, quarter) are told apart by their
+        order within it (see the module docstring); cube.n_repeated counts them.
+        """
+        keys = [id_col] if isinstance(id_col, str) else list(id_col)
+        if len(keys) == 1:
+            unit = pd.factorize(df[keys[0]])[0].astype(np.int64)
+        else:
+            unit = df.groupby(keys, sort=False).ngroup().fillna(-1).to_numpy(dtype=np.int64)  # -1: a key is missing
+        q = quarter_ordinal(df[date_col])
+        dated = q >= 0
+        first = int(q[dated].min()) if dated.any() else 0
+        n_quarters = int(q[dated].max()) - first + 1 if dated.any() else 0
+        quarter_pos = np.where(dated, q - first, -1)
+        # k-th row of a (unit, quarter) in frame order; k > 0 only for repeated rows
+        slot = pd.Series(np.zeros(len(unit), dtype=np.int64)).groupby([unit, quarter_pos]).cumcount().to_numpy()
+        slot = np.where((unit >= 0) & dated, slot, 0)
+        row_unit = unit
+        if slot.any():
+            split = np.where(unit >= 0, unit * (int(slot.max()) + 1) + slot, np.nan)
+            row_unit = pd.factorize(split)[0].astype(np.int64)
+        cube = cls(row_unit, quarter_pos, int(row_unit.max()) + 1 if len(row_unit) else 0, n_quarters, first)
+        cube.n_repeated = int((slot > 0).sum())
+        cube.unit_pos = unit
+        return cube
+
+    # -- scatter / gather --------------------------------------------------
+    def to_cube(self, values) -> np.ndarray:
+        """Scatter a row-aligned series into a (banks × quarters) array, NaN where absent."""
+        v = pd.Series(values).to_numpy(dtype="float64", na_value=np.nan)
+        out = np.full(self.shape, np.nan)
+        out[self._bi, self._qi] = v[self.placed]
+        return out
+
+    def to_rows(self, cube: np.ndarray) -> np.ndarray:
+        """Gather a (banks × quarters) array back into the frame's row order."""
+        out = np.full(len(self.bank_pos), np.nan)
+        out[self.placed] = cube[self._bi, self._qi]
+        return out
+
+    def _stack(self, values):
+        """(banks × quarters × columns) array of a Series/DataFrame, NaN where absent."""
+        v = pd.DataFrame(values).to_numpy(dtype="float64", na_value=np.nan)
+        out = np.full(self.shape + (v.shape[1],), np.nan)
+        out[self._bi, self._qi] = v[self.placed]
+        return out
+
+    def _unstack(self, cube: np.ndarray, values, rows=None):
+        """Gather a stacked array back into row order, shaped like values; NaN outside rows."""
+        out = np.full((len(self.bank_pos), cube.shape[2]), np.nan)
+        out[self.placed] = cube[self._bi, self._qi]
+        if rows is not None:
+            out[~np.asarray(rows, dtype=bool)] = np.nan
+        return out if isinstance(values, pd.DataFrame) else out[:, 0]
+
+    # -- operators -----------------------------------------------------------
+    def neighbour(self, k: int = 1) -> np.ndarray:
+        """Per row, the row number k quarters earlier (k < 0: later) for the same bank, or -1."""
+        if k not in self._neighbours:
+            shifted = np.full(self.shape, -1, dtype=np.int64)
+            if k == 0:
+                shifted[:] = self.rows
+            elif 0 < k < self.shape[1]:
+                shifted[:, k:] = self.rows[:, :-k]
+            elif 0 < -k < self.shape[1]:
+                shifted[:, :k] = self.rows[:, -k:]
+            nb = np.full(len(self.bank_pos), -1, dtype=np.int64)
+            nb[self.placed] = shifted[self._bi, self._qi]
+            self._neighbours[k] = nb
+        return self._neighbours[k]
+
+    def shifted(self, values, k: int = 1) -> np.ndarray:
+        """Value k quarters earlier (k > 0) or later (k < 0) for the same bank; NaN if absent."""
+        v = pd.Series(values).to_numpy(dtype="float64", na_value=np.nan)
+        nb = self.neighbour(k)
+        return np.where(nb >= 0, v[nb], np.nan)
+
+    def lag(self, values, k: int = 1) -> np.ndarray:
+        return self.shifted(values, k)
+
+    def lead(self, values, k: int = 1) -> np.ndarray:
+        return self.shifted(values, -k)
+
+    def diff(self, values, k: int = 1) -> np.ndarray:
+        return pd.Series(values).to_numpy(dtype="float64", na_value=np.nan) - self.lag(values, k)
+
+    def growth(self, values, k: int = 1) -> np.ndarray:
+        """(x - lag) / lag, NaN where the lag is zero or missing."""
+        x = pd.Series(values).to_numpy(dtype="float64", na_value=np.nan)
+        prev = self.lag(values, k)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(prev != 0, (x - prev) / prev, np.nan)
+
+    def mean2(self, values) -> np.ndarray:
+        """Two-quarter average (x + lag(x)) / 2."""
+        x = pd.Series(values).to_numpy(dtype="float64", na_value=np.nan)
+        return (x + self.lag(values)) / 2
+
+    def ytd_to_quarterly(self, values):
+        """
+        De-accumulate year-to-date items (one column each) into quarterly flows in one pass:
+        Q1 keeps its YTD value, Q2-Q4 subtract the same bank's YTD one quarter earlier.
+
+        Returns (flows, gap): flows is an (n_rows × n_cols) float array; gap flags rows in Q2-Q4
+        whose previous-quarter filing is missing. Their flows are NaN rather than the YTD value,
+        which would cover more than one quarter. An item that is missing in the previous
+        filing likewise gives NaN for that item only.
+        """
+        x = pd.DataFrame(values).to_numpy(dtype="float64", na_value=np.nan)
+        nb = self.neighbour(1)
+        q1 = (self.first_quarter + self.quarter_pos) % 4 == 0
+        prev = x[np.where(nb >= 0, nb, 0)]
+        flows = np.where(q1[:, None], x, x - prev)
+        gap = self.placed & ~q1 & (nb < 0)
+        flows[gap | ~self.placed] = np.nan
+        return flows, gap
+
+    # -- segmented transforms ------------------------------------------------
+    def in_quarter(self, q: int = 0) -> np.ndarray:
+        """Per row: True if the row's bank has a row in quarter q of the cube (0 = first quarter)."""
+        if not 0 <= q < self.shape[1]:
+            return np.zeros(len(self.bank_pos), dtype=bool)
+        # By unit rather than cube row, so every repeated row of a bank gets the same answer
+        has = np.zeros(int(self.unit_pos.max()) + 1 if len(self.unit_pos) else 0, dtype=bool)
+        has[self.unit_pos[self.placed & (self.quarter_pos == q)]] = True
+        return self.placed & has[np.maximum(self.unit_pos, 0)]
+
+    def cumsum(self, values, rows=None):
+        """
+        Running per-bank sum over quarters, missing values counting as 0; the same as
+        groupby(bank)[col].apply(lambda s: s.fillna(0).cumsum()) on a bank/date-sorted frame.
+        """
+        x = self._stack(values)
+        return self._unstack(np.cumsum(np.nan_to_num(x, nan=0.0), axis=1), values, rows)
+
+    def rolling_sum(self, values, window: int, min_periods: int = 1, rows=None):
+        """
+        Sum over the bank's last `window` calendar quarters, NaN with fewer than min_periods
+        values; the same as groupby(bank)[col].rolling(window, min_periods).sum() on a frame
+        reindexed to every calendar quarter (so a gap counts as a missing value).
+        """
+        return self._rolling(values, window, min_periods, rows, mean=False)
+
+    def rolling_mean(self, values, window: int, min_periods: int = 1, rows=None):
+        """Mean over the bank's last `window` calendar quarters; see rolling_sum."""
+        return self._rolling(values, window, min_periods, rows, mean=True)
+
+    def _rolling(self, values, window, min_periods, rows, mean):
+        if window < 1 or min_periods < 0:
+            raise ValueError(f"window must be >= 1 and min_periods >= 0, got {window} and {min_periods}")
+        x = self._stack(values)
+        known = ~np.isnan(x)
+        x = np.where(known, x, 0.0)
+        # One shifted add per quarter in the window rather than differences of running totals,
+        # which lose the small values of a bank that once reported very large ones
+        s, n = x.copy(), known.astype(np.int64)
+        for k in range(1, min(window, x.shape[1])):
+            s[:, k:] += x[:, :-k]
+            n[:, k:] += known[:, :-k]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            out = np.where(n >= min_periods, s / n if mean else s, np.nan)
+        return self._unstack(out, values, rows)
+
+    def since_base(self, values, base=None, rows=None):
+        """
+        x minus the same bank's value in the base quarter (a date; default the cube's first
+        quarter), NaN where the bank has no value there: x - x.groupby(bank).transform(lambda
+        s: s[date == base].iloc[0] if any, else NaN).
+        """
+        q = 0 if base is None else int(quarter_ordinal([base])[0]) - self.first_quarter
+        x = self._stack(values)
+        base_values = x[:, q:q + 1] if 0 <= q < self.shape[1] else np.full_like(x[:, :1], np.nan)
+        return self._unstack(x - base_values, values, rows)
@@ -0,0 +1,147 @@
+"""
+Memory-mapped Arrow copies of the processed tables and the working panel.
+
+Every script that writes a processed CSV (or a working panel) also publishes the same frame as an
+uncompressed Arrow IPC (Feather v2) file next to it, e.g. data/working/working_panel.arrow.
+Python consumers open that file memory-mapped instead of parsing the CSV:
+
+    from panel_store import load_frame
+    df = load_frame("working_panel", columns=["Bank ID", "Date", "ASSET"])
+
+Opening maps the file without reading it. Only the buffers of the requested columns are touched,
+and numeric columns without missing values reach pandas without a copy. Several analysis
+processes that open the same file therefore share one copy in the OS page cache.
+
+Schema: date columns (DATE_COLUMNS) are stored as date32, whether the frame holds datetimes or
+'YYYY-MM-DD' text, and load as datetime64. Every other column keeps its pandas type: float64,
+int64 or string. An integer column with missing values (pandas Int64) loads as Int64 again
+rather than float64; one without loads as plain int64. The CSV is still written for the Stata
+do-files.
+"""
+import os
+import tempfile
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+# name -> CSV the table is published next to
+TABLES = {
+    "working_panel": "data/working/working_panel.csv",
+    "deposit_interest_rate": "data/processed/deposit_interest_rate.csv",
+    "bank_credit": "data/processed/bank_credit.csv",
+    "controls": "data/processed/controls.csv",
+    "instruments": "data/processed/instruments.csv",
+    "ffr_quarterly": "data/processed/ffr_quarterly.csv",
+    "sophistication_index": "data/processed/sophistication_index.csv",
+}
+DATE_COLUMNS = ("Date", "rssd9999")
+# Arrow integer types as pandas nullable dtypes, for integer columns that have nulls
+NULLABLE_INTS = {
+    pa.int8(): pd.Int8Dtype(), pa.int16(): pd.Int16Dtype(), pa.int32(): pd.Int32Dtype(), pa.int64(): pd.Int64Dtype(),
+    pa.uint8(): pd.UInt8Dtype(), pa.uint16(): pd.UInt16Dtype(), pa.uint32(): pd.UInt32Dtype(),
+    pa.uint64(): pd.UInt64Dtype(),
+}
+
+
+def arrow_path(table: str) -> str:
+    """The Arrow file for a TABLES name, or for any CSV path (same name, .arrow suffix)."""
+    return os.path.splitext(TABLES.get(table, table))[0] + ".arrow"
+
+
+def to_arrow(df: pd.DataFrame) -> pa.Table:
+    """df as an Arrow table with date columns as date32."""
+    dates = {}
+    for col in DATE_COLUMNS:
+        if col in df.columns:
+            dates[col] = pd.to_datetime(df[col]).dt.normalize().astype("datetime64[s]")
+    table = pa.Table.from_pandas(df.assign(**dates) if dates else df, preserve_index=False)
+    for col in dates:
+        i = table.schema.get_field_index(col)
+        table = table.set_column(i, pa.field(col, pa.date32()), table.column(i).cast(pa.date32()))
+    return table.replace_schema_metadata(None)
+
+
+def publish(df: pd.DataFrame, csv_path: str) -> str:
+    """Write df as the Arrow file that goes with csv_path; returns its path."""
+    path = arrow_path(csv_path)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".", suffix=".tmp")
+    os.close(fd)
+    try:
+        # Uncompressed, so readers can map the buffers directly
+        feather.write_feather(to_arrow(df), tmp, compression="uncompressed")
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    return path
+
+
+class TableWriter:
+    """
+    Publishes a table one frame at a time, for outputs written quarter by quarter. With
+    append=True the rows already published are carried over first. Call close() when done, or
+    discard() to drop what was written; the published file is untouched until close().
+    """
+
+    def __init__(self, csv_path: str, append: bool = False):
+        self.path = arrow_path(csv_path)
+        self.writer, self.schema, self.tmp = None, None, None
+        self.carried = None
+        if append:
+            # Rows published before; a CSV from before the Arrow copies existed is parsed once
+            self.carried = (open_table(csv_path) if os.path.exists(self.path)
+                            else to_arrow(pd.read_csv(csv_path)))
+
+    def _open(self, schema: pa.Schema) -> None:
+        self.schema = self.carried.schema if self.carried is not None else schema
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        fd, self.tmp = tempfile.mkstemp(dir=os.path.dirname(self.path) or ".", prefix=".", suffix=".tmp")
+        os.close(fd)
+        self.writer = pa.ipc.new_file(self.tmp, self.schema)
+        if self.carried is not None:
+            self.writer.write_table(self.carried)
+
+    def write(self, df: pd.DataFrame) -> None:
+        table = to_arrow(df)
+        if self.writer is None:
+            self._open(table.schema)
+        self.writer.write_table(table.cast(self.schema))
+
+    def close(self) -> None:
+        if self.writer is None:  # no new rows
+            self._open(pa.schema([]))
+        self.writer.close()
+        self.writer = None
+        os.replace(self.tmp, self.path)
+
+    def discard(self) -> None:
+        """Drop the rows written so far (nothing to do once close() has published them)."""
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        if self.tmp is not None and os.path.exists(self.tmp):
+            os.remove(self.tmp)
+
+
+def open_table(table: str, columns: list = None) -> pa.Table:
+    """A table memory-mapped from its Arrow file (nothing is read until a column is used)."""
+    path = arrow_path(table)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"{path} not found; rerun the script that writes {TABLES.get(table, table)}")
+    with pa.memory_map(path, "r") as source:
+        data = pa.ipc.open_file(source).read_all()
+    return data.select(columns) if columns is not None else data
+
+
+def load_frame(table: str, columns: list = None) -> pd.DataFrame:
+    """A published table as a pandas frame, reading only `columns` (default: all)."""
+    data = open_table(table, columns)
+    df = data.to_pandas(split_blocks=True, date_as_object=False)
+    # to_pandas turns an integer column with nulls into float64; the types_mapper is per type, not
+    # per column, so apply it only to those columns and leave the others zero-copy int64
+    for name, col in zip(data.column_names, data.columns):
+        if pa.types.is_integer(col.type) and col.null_count:
+            df[name] = col.to_pandas(types_mapper=NULLABLE_INTS.get)
+    return df
@@ -0,0 +1,331 @@
+"""
+Runs the clean stage as a DAG of scripts and skips stages whose inputs and code are unchanged.
+
+How to run (from the repository root):
+  python programs/clean/pipeline.py                       # bring every output up to date
+  python programs/clean/pipeline.py instruments           # one stage plus whatever it depends on
+  python programs/clean/pipeline.py --dry-run             # list what would run
+  python programs/clean/pipeline.py --force control       # rerun control even if it is up to date
+  python programs/clean/pipeline.py --jobs 2
+  python programs/clean/pipeline.py --session             # one process, frames passed in memory
+  python programs/clean/pipeline.py --session --artifacts # ... and write the intermediate CSVs too
+
+Each stage declares the files it reads and writes. A stage runs after every stage that writes
+one of its inputs, and after the stages in its `after` list. Two cache stages, call_report and
+deposit_matrix, fill the Parquet and npz caches that several scripts share, so the scripts that
+then run side by side only read them. A stage is up to date when its outputs exist and one hash
+matches the hash recorded in data/cache/pipeline.json after its last successful run. That hash
+covers the stage script, the sibling modules it imports (found by parsing the imports,
+transitively) and the contents of its inputs. An input is re-hashed only when its size or mtime
+changes. Stages whose dependencies are done run at the same time, each in its own Python
+process, up to --jobs at once.
+
+--session chains the same scripts as functions in one process instead. Each stage's frames go
+straight to the next stage, and each shared Call Report extract is loaded once. No processed
+CSV is written or re-parsed unless --artifacts is given. Only the working panel(s) are written.
+"""
+import argparse
+import ast
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import NamedTuple
+
+import bank_credit
+import control
+import deposit_interest_rate
+import ffr_clean
+import instruments
+import sophistication_index_merge
+import working_panel_merge
+from call_report import SOURCES as CALL_REPORT_SOURCES, load_call_report, write_output
+from panel_store import arrow_path, publish
+from sod_store import SOD_PATH
+from working_panel_merge import SampleSpec, as_read, build_sample, build_shared, load_specs
+
+CLEAN_DIR = os.path.dirname(os.path.abspath(__file__))
+STATE_PATH = "data/cache/pipeline.json"
+
+
+class Stage(NamedTuple):
+    script: str       # file in programs/clean, run from the repository root
+    inputs: tuple
+    outputs: tuple
+    args: tuple = ()
+    after: tuple = ()  # stages to wait for besides those that write an input (shared caches)
+
+
+def _extracts(names) -> tuple:
+    return tuple(CALL_REPORT_SOURCES[name].path for name in names)
+
+
+# Extracts and SOD matrices are cached under data/cache and shared by several scripts. The two
+# cache stages fill them once, so the scripts that run in parallel afterwards only read them.
+CALL_REPORT_NAMES = sorted(set(bank_credit.SOURCES) | set(deposit_interest_rate.SOURCES) | set(control.SOURCES))
+
+STAGES = {
+    "call_report": Stage("call_report.py", _extracts(CALL_REPORT_NAMES), (), args=tuple(CALL_REPORT_NAMES)),
+    "deposit_matrix": Stage("deposit_matrix.py", (SOD_PATH,), ()),
+    "ffr_clean": Stage("ffr_clean.py", (ffr_clean.RAW_CSV,), (ffr_clean.OUTPUT_CSV,)),
+    "bank_credit": Stage("bank_credit.py", _extracts(bank_credit.SOURCES), (bank_credit.OUTPUT_CSV,),
+                         after=("call_report",)),
+    "deposit_interest_rate": Stage("deposit_interest_rate.py", _extracts(deposit_interest_rate.SOURCES),
+                                   (deposit_interest_rate.OUTPUT_CSV,), after=("call_report",)),
+    "control": Stage("control.py", _extracts(control.SOURCES) + ("data/raw/ACS.csv", SOD_PATH),
+                     (control.OUTPUT_CSV,), after=("call_report", "deposit_matrix")),
+    "sophistication_index_merge": Stage(
+        "sophistication_index_merge.py", ("data/raw/ACS.csv", "data/raw/IRS.csv", "data/raw/HMDA.csv"),
+        tuple(sophistication_index_merge.OUTPUTS.values())),
+    "instruments": Stage("instruments.py", (SOD_PATH, instruments.SOPHISTICATION_CSV),
+                         (instruments.OUTPUT_CSV,), after=("deposit_matrix",)),
+    "working_panel_merge": Stage(
+        "working_panel_merge.py",
+        (working_panel_merge.DEPOSIT_INTEREST_RATE_CSV, working_panel_merge.BANK_CREDIT_CSV,
+         working_panel_merge.INSTRUMENTS_CSV, working_panel_merge.FFR_CSV, working_panel_merge.CONTROLS_CSV),
+        (working_panel_merge.OUTPUT_CSV,)),
+}
+
+
+def dependencies(stages: dict = STAGES) -> dict:
+    """{stage: set of stages that write one of its inputs, plus its `after` stages}."""
+    producer = {out: name for name, stage in stages.items() for out in stage.outputs}
+    return {name: ({producer[i] for i in stage.inputs if i in producer} | set(stage.after)) - {name}
+            for name, stage in stages.items()}
+
+
+def _closure(targets, deps: dict) -> list:
+    """targets plus everything upstream of them, in dependency order."""
+    order, seen = [], set()
+
+    def visit(name):
+        if name in seen:
+            return
+        seen.add(name)
+        for dep in sorted(deps[name]):
+            visit(dep)
+        order.append(name)
+
+    for name in targets:
+        visit(name)
+    return order
+
+
+def code_files(script: str) -> list:
+    """The script and every sibling module it imports, directly or indirectly."""
+    found, todo = [], [script]
+    while todo:
+        name = todo.pop()
+        if name in found:
+            continue
+        found.append(name)
+        with open(os.path.join(CLEAN_DIR, name), "r", encoding="utf-8") as f:
+            tree = ast.parse(f.read(), filename=name)
+        for node in ast.walk(tree):
+            modules = [a.name for a in node.names] if isinstance(node, ast.Import) else \
+                [node.module] if isinstance(node, ast.ImportFrom) and node.module and not node.level else []
+            for module in modules:
+                if os.path.exists(os.path.join(CLEAN_DIR, f"{module}.py")):
+                    todo.append(f"{module}.py")
+    return sorted(found)
+
+
+def _load_state() -> dict:
+    try:
+        with open(STATE_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"files": {}, "stages": {}}
+
+
+def _save_state(state: dict) -> None:
+    os.makedirs(os.path.dirname(STATE_PATH), exist_ok=True)
+    with open(STATE_PATH + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(STATE_PATH + ".tmp", STATE_PATH)
+
+
+def file_sha(path: str, state: dict) -> str:
+    """Content hash of path, reusing the recorded hash while size and mtime are unchanged."""
+    st = os.stat(path)
+    known = state["files"].get(path)
+    if known and known[:2] == [st.st_size, st.st_mtime_ns]:
+        return known[2]
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""): h.update(block)
+    state["files"][path] = [st.st_size, st.st_mtime_ns, h.hexdigest()]
+    return h.hexdigest()
+
+
+def stage_hash(name: str, state: dict) -> str:
+    stage = STAGES[name]
+    missing = [p for p in stage.inputs if not os.path.exists(p)]
+    if missing:
+        raise FileNotFoundError(f"{name}: missing input(s) {missing}")
+    parts = {"code": {f: file_sha(os.path.join(CLEAN_DIR, f), state) for f in code_files(stage.script)},
+             "inputs": {p: file_sha(p, state) for p in stage.inputs}}
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _run_script(script: str, args: tuple = ()):
+    t0 = time.perf_counter()
+    proc = subprocess.run([sys.executable, os.path.join(CLEAN_DIR, script), *args], capture_output=True, text=True)
+    return proc.returncode, proc.stdout + proc.stderr, time.perf_counter() - t0
+
+
+def run(targets=None, force: bool = False, jobs: int = os.cpu_count() or 1, dry_run: bool = False) -> bool:
+    """Bring targets (default: every stage) up to date; returns False if a stage failed."""
+    deps = dependencies()
+    targets = list(targets or STAGES)
+    unknown = [t for t in targets if t not in STAGES]
+    if unknown:
+        raise ValueError(f"Unknown stage(s) {unknown}; choose from {list(STAGES)}")
+    order = _closure(targets, deps)
+    state = _load_state()
+    done, stale, failed, running = set(), set(), set(), {}
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        while True:
+            progressed = True
+            while progressed:
+                progressed = False
+                for name in order:
+                    if name in done or name in failed or name in running or not deps[name] <= done | failed:
+                        continue
+                    progressed = True
+                    if deps[name] & failed:
+                        print(f"[skipped] {name}: upstream failed")
+                        failed.add(name)
+                        continue
+                    if dry_run and (deps[name] - set(STAGES[name].after)) & stale:
+                        print(f"[would run] {name}")  # an input is about to change
+                        stale.add(name)
+                        done.add(name)
+                        continue
+                    try:
+                        key = stage_hash(name, state)
+                    except FileNotFoundError as e:
+                        print(f"[failed] {e}")
+                        failed.add(name)
+                        continue
+                    # Every CSV output is published with an Arrow copy (panel_store.py)
+                    current = (state["stages"].get(name) == key
+                               and all(os.path.exists(p) and os.path.exists(arrow_path(p))
+                                       for p in STAGES[name].outputs))
+                    if current and not (force and name in targets):
+                        print(f"[up to date] {name}")
+                        done.add(name)
+                    elif dry_run:
+                        print(f"[would run] {name}")
+                        stale.add(name)
+                        done.add(name)
+                    else:
+                        for out in STAGES[name].outputs:
+                            os.makedirs(os.path.dirname(out), exist_ok=True)
+                        print(f"[running] {name}")
+                        running[name] = (pool.submit(_run_script, STAGES[name].script, STAGES[name].args), key)
+            if not running:
+                break
+            finished, _ = wait([future for future, _ in running.values()], return_when=FIRST_COMPLETED)
+            for name in [n for n, (future, _) in running.items() if future in finished]:
+                future, key = running.pop(name)
+                code, output, seconds = future.result()
+                if output.strip():
+                    print("\n".join(f"  {name} | {line}" for line in output.rstrip().splitlines()))
+                if code == 0:
+                    print(f"[done] {name} ({seconds:.1f}s)")
+                    state["stages"][name] = key
+                    done.add(name)
+                else:
+                    print(f"[failed] {name} (exit {code})")
+                    failed.add(name)
+                _save_state(state)
+    _save_state(state)
+    return not failed
+
+
+def _write_csv(df, path: str) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    df.to_csv(path, index=False)
+    publish(df, path)
+
+
+def run_session(specs: list = None, artifacts: bool = False) -> dict:
+    """
+    Every stage in this process, handing each stage's frames to the next in memory; returns
+    {sample name: working panel}. Only the working panels are written, plus every intermediate
+    CSV when artifacts is set (the pipeline state is then updated as if each stage had run).
+    """
+    def step(label, fn, *args, **kwargs):
+        t0 = time.perf_counter()
+        out = fn(*args, **kwargs)
+        print(f"[session] {label} ({time.perf_counter() - t0:.1f}s)")
+        return out
+
+    # Each shared extract is loaded once and passed to every script that uses it
+    extracts = step("call_report", lambda: {name: load_call_report(name) for name in CALL_REPORT_NAMES})
+    sophistication = step("sophistication_index_merge", sophistication_index_merge.build)
+    frames = {
+        'ffr': step("ffr_clean", ffr_clean.build),
+        'bank_credit': step("bank_credit", bank_credit.build, *[extracts[n] for n in bank_credit.SOURCES]),
+        'deposit_interest_rate': step("deposit_interest_rate", deposit_interest_rate.build,
+                                      *[extracts[n] for n in deposit_interest_rate.SOURCES], verbose=True),
+        'controls': step("control", control.build_panel, extracts),
+        'instruments': step("instruments", instruments.build_panel, sophistication['index']),
+    }
+    if artifacts:
+        for key, frame in sophistication.items():
+            _write_csv(frame, sophistication_index_merge.OUTPUTS[key])
+        _write_csv(frames['ffr'], ffr_clean.OUTPUT_CSV)
+        _write_csv(frames['instruments'], instruments.OUTPUT_CSV)
+        for module, key in ((bank_credit, 'bank_credit'), (deposit_interest_rate, 'deposit_interest_rate'),
+                            (control, 'controls')):
+            os.makedirs(os.path.dirname(module.OUTPUT_CSV), exist_ok=True)
+            write_output(frames[key], module.OUTPUT_CSV)
+
+    inputs = {key: as_read(frame) for key, frame in frames.items()}
+    shared = step("working_panel_merge (shared)", build_shared, inputs)
+    panels = {}
+    for spec in specs or [SampleSpec()]:
+        panels[spec.name] = build_sample(shared, inputs['ffr'], spec)
+        _write_csv(panels[spec.name], spec.output_csv)
+
+    if artifacts:
+        state = _load_state()
+        for name in STAGES:
+            if all(os.path.exists(p) for p in STAGES[name].inputs + STAGES[name].outputs):
+                state["stages"][name] = stage_hash(name, state)
+        _save_state(state)
+    return panels
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Rebuild the clean-stage outputs that are out of date.")
+    ap.add_argument("stages", nargs="*", help=f"Stages to bring up to date (default: all). One of {list(STAGES)}.")
+    ap.add_argument("--force", action="store_true", help="Rerun the named stages (all if none) even if up to date.")
+    ap.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="Stages to run at once.")
+    ap.add_argument("--dry-run", action="store_true", help="Only report which stages would run.")
+    ap.add_argument("--session", action="store_true",
+                    help="Run every stage in this process, passing frames in memory; writes only the working panel.")
+    ap.add_argument("--artifacts", action="store_true", help="With --session, also write the intermediate CSVs.")
+    ap.add_argument("--spec", help="With --session, the sample variants to build (see working_panel_merge.py).")
+    args = ap.parse_args()
+    unknown = [s for s in args.stages if s not in STAGES]
+    if unknown:
+        ap.error(f"unknown stage(s) {unknown}")
+    if args.session:
+        if args.stages or args.force or args.dry_run:
+            ap.error("--session always runs every stage; it takes no stage names, --force or --dry-run")
+        run_session(load_specs(args.spec) if args.spec else None, artifacts=args.artifacts)
+        return
+    if args.artifacts or args.spec:
+        ap.error("--artifacts and --spec apply to --session only")
+    sys.exit(0 if run(args.stages, force=args.force, jobs=args.jobs, dry_run=args.dry_run) else 1)
+
+
+if __name__ == "__main__":
+    main()
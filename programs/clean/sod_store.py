@@ -0,0 +1,168 @@
+"""
+YEAR-partitioned columnar store of the FDIC Summary of Deposits (SOD) branch file.
+
+How to run:
+  python programs/clean/sod_store.py           # (re)build data/cache/sod if SOD.csv changed
+  python programs/clean/sod_store.py --force
+
+ingest_sod() parses data/raw/SOD.csv once, in chunks, and writes one Parquet file per SOD YEAR.
+Identifiers and deposits are typed on the way in: integer RSSDID and county FIPS (STCNTYBR), and
+float DEPSUMBR and DEPDOM. Every other column keeps the type read_csv infers. Downstream scripts
+then read only the years and columns they need:
+
+    sod = read_sod(['YEAR', 'RSSDID', 'DEPSUMBR', 'STCNTYBR'])              # all years
+    sod = read_sod(['RSSDID', 'METROBR'], years=[2021])                     # one partition
+    sod = read_sod(['RSSDID', 'DEPSUMBR'], filters=[('RSSDID', 'in', ids)]) # pushed into Parquet
+
+manifest.json records the size, mtime and SHA-256 of the CSV that was ingested, plus the row
+count and a content hash of each YEAR partition. An unchanged file is detected from size and
+mtime alone, and any change to its contents rebuilds the store. Rows come back in CSV order
+within each year, with years ascending.
+
+A rebuild is written to a directory of its own next to the store and renamed into place when
+complete. Processes that ingest at the same time therefore never share files: the last one to
+finish replaces the store, and a crashed build leaves the previous store intact.
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import pandas as pd
+
+SOD_PATH = "data/raw/SOD.csv"
+STORE_DIR = "data/cache/sod"
+CHUNK_ROWS = 500_000
+# Typed on ingest; bump STORE_VERSION when this (or the layout) changes
+DTYPES = {'YEAR': 'Int64', 'RSSDID': 'Int64', 'STCNTYBR': 'Int32', 'DEPSUMBR': 'float64', 'DEPDOM': 'float64'}
+STORE_VERSION = 1
+
+
+def _file_sha(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""): h.update(block)
+    return h.hexdigest()
+
+
+def _read_manifest(store_dir: str):
+    try:
+        with open(os.path.join(store_dir, "manifest.json"), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return manifest if manifest.get("version") == STORE_VERSION else None
+
+
+def _year_paths(store_dir: str, manifest: dict) -> dict:
+    return {int(y): os.path.join(store_dir, f"{y}.parquet") for y in sorted(manifest["years"], key=int)}
+
+
+def _write_year(spill_dir: str, out_path: str) -> int:
+    parts = sorted(os.listdir(spill_dir))
+    df = pd.concat([pd.read_parquet(os.path.join(spill_dir, p)) for p in parts], ignore_index=True)
+    # A column inferred as numbers in one chunk and text in another becomes object; store it as text
+    for col in df.columns[df.dtypes == object]:
+        df[col] = df[col].astype("str")
+    df.to_parquet(out_path, index=False)
+    return len(df)
+
+
+def ingest_sod(sod_path: str = SOD_PATH, store_dir: str = STORE_DIR, force: bool = False) -> dict:
+    """{YEAR: Parquet path}, rebuilding the store first if the SOD file changed."""
+    manifest = None if force else _read_manifest(store_dir)
+    st = os.stat(sod_path)
+    if manifest and (manifest["bytes"], manifest["mtime_ns"]) == (st.st_size, st.st_mtime_ns):
+        return _year_paths(store_dir, manifest)
+    sha = _file_sha(sod_path)
+    if manifest and manifest["sha"] == sha:  # same contents, new mtime
+        manifest.update(bytes=st.st_size, mtime_ns=st.st_mtime_ns)
+        _write_manifest(store_dir, manifest)
+        return _year_paths(store_dir, manifest)
+
+    parent = os.path.dirname(os.path.abspath(store_dir))
+    os.makedirs(parent, exist_ok=True)
+    build_dir = tempfile.mkdtemp(dir=parent, prefix=f".{os.path.basename(store_dir)}-")
+    try:
+        spill = os.path.join(build_dir, "spill")
+        dropped = 0
+        for i, chunk in enumerate(pd.read_csv(sod_path, chunksize=CHUNK_ROWS, dtype=DTYPES)):
+            dropped += int(chunk['YEAR'].isna().sum())
+            for year, part in chunk.groupby('YEAR'):
+                os.makedirs(os.path.join(spill, str(year)), exist_ok=True)
+                part.to_parquet(os.path.join(spill, str(year), f"part-{i:05d}.parquet"), index=False)
+        years = {}
+        for year in sorted(os.listdir(spill) if os.path.isdir(spill) else [], key=int):
+            out = os.path.join(build_dir, f"{year}.parquet")
+            rows = _write_year(os.path.join(spill, year), out)
+            years[year] = {"rows": rows, "sha": _file_sha(out)}
+        shutil.rmtree(spill, ignore_errors=True)
+        manifest = {"version": STORE_VERSION, "bytes": st.st_size, "mtime_ns": st.st_mtime_ns, "sha": sha,
+                    "years": years}
+        _write_manifest(build_dir, manifest)
+        _swap_in(build_dir, store_dir, sha)
+    finally:
+        shutil.rmtree(build_dir, ignore_errors=True)  # only left over if the build failed
+    print(f"Ingested {sod_path}: {sum(y['rows'] for y in years.values()):,} branches in {len(years)} years"
+          f" -> {store_dir}" + (f" ({dropped:,} rows without YEAR dropped)" if dropped else ""))
+    return _year_paths(store_dir, manifest)
+
+
+def _write_manifest(store_dir: str, manifest: dict) -> None:
+    fd, tmp = tempfile.mkstemp(dir=store_dir, prefix=".manifest-", suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp, os.path.join(store_dir, "manifest.json"))
+
+
+def _swap_in(build_dir: str, store_dir: str, sha: str) -> None:
+    """Rename a finished build of the file with hash `sha` over store_dir (not possible in one step for a directory)."""
+    old = build_dir + ".old"
+    try:
+        os.rename(store_dir, old)
+    except FileNotFoundError:
+        old = None
+    try:
+        os.rename(build_dir, store_dir)
+    except OSError:
+        # Fine if another process renamed its build of the same file into place first
+        if (_read_manifest(store_dir) or {}).get("sha") != sha:
+            raise
+    if old:
+        shutil.rmtree(old, ignore_errors=True)
+
+
+def year_hashes(sod_path: str = SOD_PATH, store_dir: str = STORE_DIR) -> dict:
+    """{YEAR: content hash of that year's partition}, ingesting first if needed."""
+    ingest_sod(sod_path, store_dir)
+    return {int(y): v["sha"] for y, v in _read_manifest(store_dir)["years"].items()}
+
+
+def read_sod(columns: list = None, years: list = None, filters: list = None,
+             sod_path: str = SOD_PATH, store_dir: str = STORE_DIR) -> pd.DataFrame:
+    """
+    SOD branch rows for `years` (default: all), reading only `columns` (default: all). `filters`
+    is passed to the Parquet reader, e.g. [('RSSDID', 'in', ids)].
+    """
+    paths = ingest_sod(sod_path, store_dir)
+    chosen = [y for y in paths if years is None or y in set(years)]
+    frames = [pd.read_parquet(paths[y], columns=columns, filters=filters) for y in chosen]
+    if not frames:
+        return pd.DataFrame(columns=columns if columns is not None else list(DTYPES))
+    return pd.concat(frames, ignore_index=True)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Ingest the SOD branch file into a YEAR-partitioned Parquet store.")
+    ap.add_argument("--sod", default=SOD_PATH)
+    ap.add_argument("--store", default=STORE_DIR)
+    ap.add_argument("--force", action="store_true", help="Rebuild even if the file looks unchanged.")
+    args = ap.parse_args()
+    for year, path in ingest_sod(args.sod, args.store, force=args.force).items():
+        print(f"  {year}: {path}")
+
+
+if __name__ == "__main__":
+    main()
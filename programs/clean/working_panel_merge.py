@@ -7,10 +7,25 @@ Sources and citations:
 - Bank-level variables and BKCLASS: FFIEC Call Report data. BKCLASS codes
   'N' (National), 'NM' (State nonmember), 'SM' (State member) denote commercial banks.
 - Regional shares and instruments: constructed from FDIC Summary of Deposits (SOD).
+
+How to run:
+  python programs/clean/working_panel_merge.py                 # baseline sample -> working_panel.csv
+  python programs/clean/working_panel_merge.py --spec programs/clean/sample_variants.json
+
+--spec takes a JSON list of sample definitions (fields of SampleSpec; omitted fields keep the
+baseline value). The inputs are merged once into a shared frame. Each sample then computes its
+own masks and quantile bounds from that frame and writes its own working panel.
 """
+import argparse
+import json
+from typing import NamedTuple
+
 import pandas as pd
 import numpy as np
 
+from panel_cube import PanelCube
+from panel_store import publish
+
 # File paths
 PROC_DIR = "data/processed"
 WORK_DIR = "data/working"
@@ -20,6 +35,7 @@ INSTRUMENTS_CSV = f"{PROC_DIR}/instruments.csv"
 FFR_CSV = f"{PROC_DIR}/ffr_quarterly.csv"
 CONTROLS_CSV = f"{PROC_DIR}/controls.csv"
 OUTPUT_CSV = f"{WORK_DIR}/working_panel.csv"
+CONTROL_COLUMNS = ['rssd9001', 'rssd9999', 'metro_dummy', 'log_median_hh_income_z']
 
 # Constants
 ASSET_LARGE_THRESHOLD = 10_000_000
@@ -30,18 +46,102 @@ COMMERCIAL_BKCLASS = {'N', 'NM', 'SM'}
 DATE_START = "2022-01-01"
 DATE_END = "2023-9-30"
 
-def main() -> None:
-    # Load inputs
-    deposit_interest_rate = pd.read_csv(DEPOSIT_INTEREST_RATE_CSV)
-    bank_credit = pd.read_csv(BANK_CREDIT_CSV)
-    instruments = pd.read_csv(INSTRUMENTS_CSV)
-    controls = pd.read_csv(
-        CONTROLS_CSV,
-        usecols=[
-            'rssd9001', 'rssd9999',
-            'metro_dummy', 'log_median_hh_income_z'
-        ]
-    )  # needed control fields
+# Deposit and loan growth variables winsorized (and, in the robust panel, dropped) at the quantiles
+WINSOR_VARS = [
+    'd_average_deposit',
+    'd_average_interest_bearing_deposit',
+    'd_core_deposit',
+    'd_total_loans',
+    'd_total_loans_not_for_sale',
+    'd_single_family_loans',
+    'd_multifamily_loans',
+    'd_C&I',
+]
+
+# Running sums per bank (missing changes count as 0) -> output column
+CUMULATIVE_VARS = {
+    'd_interest_rate_on_deposit': 'cum_d_interest_rate_on_deposit',
+    'd_interest_rate_on_interest_bearing_deposit': 'cum_d_interest_rate_on_interest_bearing_deposit',
+    'd_average_deposit': 'cum_d_average_deposit',
+    'd_average_interest_bearing_deposit': 'cum_d_average_interest_bearing_deposit',
+    'd_core_deposit': 'cum_d_core_deposit',
+}
+
+
+class SampleSpec(NamedTuple):
+    """One sample definition; the defaults are the baseline working panel."""
+    name: str = "baseline"
+    date_start: str = DATE_START
+    date_end: str = DATE_END
+    bkclass: tuple = tuple(sorted(COMMERCIAL_BKCLASS))   # None: every charter class
+    asset_min: float = None                              # ASSET bounds (inclusive); None: no bound
+    asset_max: float = None
+    rate_q_low: float = OUTLIER_Q_LOW                    # rate-series outlier quantiles
+    rate_q_high: float = OUTLIER_Q_HIGH
+    winsor_q_low: float = OUTLIER_Q_LOW                  # growth-variable winsor quantiles
+    winsor_q_high: float = OUTLIER_Q_HIGH
+    drop_winsor_outliers: bool = True                    # robust panel: drop rows outside the winsor bounds
+    z_limit: float = Z_LIMIT
+    output: str = None                                   # default: working_panel[_<name>].csv
+
+    @property
+    def output_csv(self) -> str:
+        if self.output:
+            return self.output
+        return OUTPUT_CSV if self.name == "baseline" else f"{WORK_DIR}/working_panel_{self.name}.csv"
+
+
+def load_specs(path: str) -> list:
+    """Sample variants from a JSON list of objects; each overrides SampleSpec defaults by field name."""
+    with open(path, "r", encoding="utf-8") as f:
+        entries = json.load(f)
+    specs = []
+    for entry in entries:
+        unknown = set(entry) - set(SampleSpec._fields)
+        if unknown:
+            raise ValueError(f"{path}: unknown sample field(s) {sorted(unknown)}; expected {SampleSpec._fields}")
+        if entry.get('bkclass') is not None:
+            entry = {**entry, 'bkclass': tuple(entry['bkclass'])}
+        specs.append(SampleSpec(**entry))
+    names = [spec.name for spec in specs]
+    if len(set(names)) != len(names):
+        raise ValueError(f"{path}: duplicate sample names {names}")
+    return specs
+
+
+def as_read(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    A frame handed over in memory, typed as read_csv would return its CSV: dates become
+    'YYYY-MM-DD' text and nullable integers become int64 (float64 where missing), so the merges,
+    date-window comparisons and output formatting below match the CSV route.
+    """
+    out = {}
+    for col in df.columns:
+        s = df[col]
+        if pd.api.types.is_datetime64_any_dtype(s):
+            out[col] = s.dt.strftime('%Y-%m-%d')
+        elif isinstance(s.dtype, pd.Int64Dtype):
+            out[col] = s.to_numpy(dtype='float64', na_value=np.nan) if s.hasnans else s.to_numpy(dtype='int64')
+    return df.assign(**out) if out else df
+
+
+def load_inputs() -> dict:
+    """The processed inputs from their CSVs, keyed as build_shared() expects."""
+    return {
+        'deposit_interest_rate': pd.read_csv(DEPOSIT_INTEREST_RATE_CSV),
+        'bank_credit': pd.read_csv(BANK_CREDIT_CSV),
+        'instruments': pd.read_csv(INSTRUMENTS_CSV),
+        'controls': pd.read_csv(CONTROLS_CSV, usecols=CONTROL_COLUMNS),
+        'ffr': pd.read_csv(FFR_CSV),
+    }
+
+
+def build_shared(inputs: dict) -> pd.DataFrame:
+    """Every merge and per-bank transform that does not depend on the sample definition."""
+    deposit_interest_rate = inputs['deposit_interest_rate']
+    bank_credit = inputs['bank_credit']
+    instruments = inputs['instruments']
+    controls = inputs['controls'][CONTROL_COLUMNS]  # needed control fields
 
     # Merge core inputs
     df = deposit_interest_rate.merge(
@@ -50,20 +150,13 @@ def main() -> None:
     instruments = instruments[
         ['RSSDID', 'sophistication_index_z', 'ASSET', 'BKCLASS',
          'hhi_z', 'branch_density_z', 'NE', 'MA', 'EC', 'WC', 'SA', 'ES', 'WS', 'MT', 'PC']
-    ]
-    instruments.rename(columns={'RSSDID': 'rssd9001'}, inplace=True)
+    ].rename(columns={'RSSDID': 'rssd9001'})
     df = df.merge(instruments, on=['rssd9001'], how='left')
     df = df.merge(controls, on=['rssd9001', 'rssd9999'], how='left')
     # Harmonize identifiers
     df.rename(columns={'rssd9001': 'Bank ID', 'rssd9999': 'Date'}, inplace=True)
     df.drop(columns=['rssd9050', 'rssdfininstfilingtype'], inplace=True)
 
-    # Build masks up-front (avoid sequential clipping)
-    mask_rates_present = (
-        ~df['interest_rate_on_deposit'].isna()
-        & ~df['interest_rate_on_interest_bearing_deposit'].isna()
-    )
-
     # Set missing deltas to zero (true zeros or missing changes)
     df['d_multifamily_loans'] = df['d_multifamily_loans'].fillna(0)
     df['d_single_family_loans'] = df['d_single_family_loans'].fillna(0)
@@ -77,37 +170,63 @@ def main() -> None:
     df['small_buz_lending_flag_asof'] = np.where(last_flag.fillna(0) == 1, 1, 0)
     df.drop(columns=['small_buz_lending_flag'], inplace=True)
 
-    # Require instrument availability (mask only for now)
-    mask_instrument_available = ~df['sophistication_index_z'].isna()
+    # BKCLASS stays on the shared frame for the per-sample charter mask (see FFIEC Call Report
+    # documentation for BKCLASS codes) and is dropped from each output
 
-    # Commercial bank flag based on BKCLASS
-    # See FFIEC Call Report documentation for BKCLASS codes.
-    df['is_commercial_bank'] = np.where(df['BKCLASS'].isin(COMMERCIAL_BKCLASS), 1, 0)
-    df.drop(columns=['BKCLASS'], inplace=True)
-    mask_commercial_bank = df['is_commercial_bank'] == 1
-    
     # Generate lag-1 for all control variables (from controls.csv)
     control_variables = [c for c in controls.columns if c not in ['rssd9001', 'rssd9999']]
     control_variables = [c for c in control_variables if c in df.columns]
     if len(control_variables) > 0:
-        lagged_controls = df.groupby('Bank ID')[control_variables].shift(1)
-        lagged_controls.columns = [f"lag1_{c}" for c in control_variables]
+        # Previous calendar quarter for the same bank (NaN across a missing quarter)
+        cube = PanelCube.from_frame(df, id_col='Bank ID', date_col='Date')
+        if cube.n_repeated:
+            # e.g. one instrument row per SOD YEAR; each lags to its counterpart a quarter earlier
+            print('Rows repeating a (Bank ID, Date): ', cube.n_repeated)
+        lagged_controls = pd.DataFrame(
+            {f"lag1_{c}": cube.lag(df[c]) for c in control_variables}, index=df.index
+        )
         df = pd.concat([df, lagged_controls], axis=1)
-    
+    return df
+
+
+def build_sample(shared: pd.DataFrame, ffr: pd.DataFrame, spec: SampleSpec) -> pd.DataFrame:
+    """Mask, winsorize and finish one sample from the shared frame (which is left unchanged)."""
+    df = shared
+    print(f'--- Sample {spec.name!r} -> {spec.output_csv}')
+
+    # Build masks up-front (avoid sequential clipping)
+    mask_rates_present = (
+        ~df['interest_rate_on_deposit'].isna()
+        & ~df['interest_rate_on_interest_bearing_deposit'].isna()
+    )
+
+    # Require instrument availability (mask only for now)
+    mask_instrument_available = ~df['sophistication_index_z'].isna()
+
+    # Charter filter on BKCLASS (baseline: commercial banks; None keeps every charter)
+    mask_bkclass = df['BKCLASS'].isin(spec.bkclass) if spec.bkclass is not None else pd.Series(True, index=df.index)
+
+    # Bank size bounds on ASSET
+    mask_asset = pd.Series(True, index=df.index)
+    if spec.asset_min is not None:
+        mask_asset &= df['ASSET'] >= spec.asset_min
+    if spec.asset_max is not None:
+        mask_asset &= df['ASSET'] <= spec.asset_max
+
     # Policy window mask (do not filter yet)
-    mask_policy_window = (df['Date'] >= DATE_START) & (df['Date'] <= DATE_END)
+    mask_policy_window = (df['Date'] >= spec.date_start) & (df['Date'] <= spec.date_end)
     
     # Base mask used to compute quantiles and for reporting
-    base_mask = mask_rates_present & mask_instrument_available & mask_commercial_bank & mask_policy_window
+    base_mask = mask_rates_present & mask_instrument_available & mask_bkclass & mask_asset & mask_policy_window
     
     # Count before winsorizing
     print('Bank-quarter before winsorizing: ', int(base_mask.sum()))
     
-    # Drop outliers in rate series using 0.5% / 99.5% thresholds
-    low_dep = df.loc[base_mask, 'interest_rate_on_deposit'].quantile(OUTLIER_Q_LOW)
-    high_dep = df.loc[base_mask, 'interest_rate_on_deposit'].quantile(OUTLIER_Q_HIGH)
-    low_ib = df.loc[base_mask, 'interest_rate_on_interest_bearing_deposit'].quantile(OUTLIER_Q_LOW)
-    high_ib = df.loc[base_mask, 'interest_rate_on_interest_bearing_deposit'].quantile(OUTLIER_Q_HIGH)
+    # Drop outliers in rate series using the sample's thresholds (baseline 0.5% / 99.5%)
+    low_dep = df.loc[base_mask, 'interest_rate_on_deposit'].quantile(spec.rate_q_low)
+    high_dep = df.loc[base_mask, 'interest_rate_on_deposit'].quantile(spec.rate_q_high)
+    low_ib = df.loc[base_mask, 'interest_rate_on_interest_bearing_deposit'].quantile(spec.rate_q_low)
+    high_ib = df.loc[base_mask, 'interest_rate_on_interest_bearing_deposit'].quantile(spec.rate_q_high)
     mask_rate_range = (
         (df['interest_rate_on_deposit'] >= low_dep) & (df['interest_rate_on_deposit'] <= high_dep) &
         (df['interest_rate_on_interest_bearing_deposit'] >= low_ib) & (df['interest_rate_on_interest_bearing_deposit'] <= high_ib)
@@ -124,73 +243,58 @@ def main() -> None:
         (df.loc[base_mask, 'interest_rate_on_interest_bearing_deposit'] > high_ib)
     )
     union_outside = dep_outside | ib_outside
-    print('Outliers at 0.5–99.5% - interest_rate_on_deposit:', int(dep_outside.sum()))
-    print('Outliers at 0.5–99.5% - interest_rate_on_interest_bearing_deposit:', int(ib_outside.sum()))
+    band = f"{spec.rate_q_low * 100:g}–{spec.rate_q_high * 100:g}%"
+    print(f'Outliers at {band} - interest_rate_on_deposit:', int(dep_outside.sum()))
+    print(f'Outliers at {band} - interest_rate_on_interest_bearing_deposit:', int(ib_outside.sum()))
     print('Rows dropped due to rate-series filter (union):', int(union_outside.sum()))
 
-    # Winsorize deposit and loan growth variables at 0.5% / 99.5%
+    # Winsorize deposit and loan growth variables at the sample's quantiles (baseline 0.5% / 99.5%)
     # Robust panel: also DROP rows outside these ranges (stricter than baseline)
-    winsor_vars = [
-        'd_average_deposit',
-        'd_average_interest_bearing_deposit',
-        'd_core_deposit',
-        'd_total_loans',
-        'd_total_loans_not_for_sale',
-        'd_single_family_loans',
-        'd_multifamily_loans',
-        'd_C&I',
-    ]
     bounds = {}
-    for col in winsor_vars:
+    for col in WINSOR_VARS:
         if col in df.columns:
             series_in_sample = df.loc[base_mask, col].dropna()
             if series_in_sample.empty:
                 continue
-            low_q = series_in_sample.quantile(0.005)
-            high_q = series_in_sample.quantile(0.995)
+            low_q = series_in_sample.quantile(spec.winsor_q_low)
+            high_q = series_in_sample.quantile(spec.winsor_q_high)
             bounds[col] = (low_q, high_q)
     # Build robust drop mask BEFORE clipping, so outliers are actually excluded
     robust_winsor_mask = pd.Series(True, index=df.index)
-    for col, (low_q, high_q) in bounds.items():
-        robust_winsor_mask &= df[col].between(low_q, high_q)
+    if spec.drop_winsor_outliers:
+        for col, (low_q, high_q) in bounds.items():
+            robust_winsor_mask &= df[col].between(low_q, high_q)
     print('Rows dropped due to robust winsor filter:', int((base_mask & ~robust_winsor_mask).sum()))
-    # Now clip values to bounds (for remaining rows)
-    for col, (low_q, high_q) in bounds.items():
-        df[col] = df[col].clip(lower=low_q, upper=high_q)
 
-    # Keep z-scores strictly within [-Z_LIMIT, Z_LIMIT]
+    # Keep z-scores strictly within [-z_limit, z_limit]
     mask_z_scores = (
-        df['sophistication_index_z'].between(-Z_LIMIT, Z_LIMIT) &
-        df['hhi_z'].between(-Z_LIMIT, Z_LIMIT) &
-        df['branch_density_z'].between(-Z_LIMIT, Z_LIMIT)
+        df['sophistication_index_z'].between(-spec.z_limit, spec.z_limit) &
+        df['hhi_z'].between(-spec.z_limit, spec.z_limit) &
+        df['branch_density_z'].between(-spec.z_limit, spec.z_limit)
     )
-    
-    # Apply all masks at once
+
+    # Apply all masks at once; the shared frame is never modified, so the sample is a copy
     all_masks = base_mask & mask_rate_range & mask_z_scores & robust_winsor_mask
     df = df[all_masks].copy()
-    df.drop(columns=['is_commercial_bank'], inplace=True)
+    df.drop(columns=['BKCLASS'], inplace=True)
 
-    # Bank-level flag: 1 if the bank is present in the first quarter of the sample
-    first_quarter_date = df['Date'].min()
-    df['in_first_quarter'] = (df.groupby('Bank ID')['Date'].transform('min') == first_quarter_date).astype(int)
+    # Now clip values to bounds (for remaining rows)
+    for col, (low_q, high_q) in bounds.items():
+        df[col] = df[col].clip(lower=low_q, upper=high_q)
 
-    # Cumulative changes in bank deposit rates, analogous to cum_d_ffr, only for banks in first quarter
+    # Bank-level flag: 1 if the bank is present in the first quarter of the sample
     df.sort_values(['Bank ID', 'Date'], inplace=True)
-    cum_dep = df.groupby('Bank ID')['d_interest_rate_on_deposit'].apply(lambda s: s.fillna(0).cumsum())
-    cum_ib = df.groupby('Bank ID')['d_interest_rate_on_interest_bearing_deposit'].apply(lambda s: s.fillna(0).cumsum())
-    df['cum_d_interest_rate_on_deposit'] = np.where(df['in_first_quarter'] == 1, cum_dep, np.nan)
-    df['cum_d_interest_rate_on_interest_bearing_deposit'] = np.where(df['in_first_quarter'] == 1, cum_ib, np.nan)
-    
-    # Cumulative changes in deposit quantities (levels expressed as cumulative growth)
-    cum_avg_dep = df.groupby('Bank ID')['d_average_deposit'].apply(lambda s: s.fillna(0).cumsum())
-    cum_avg_ib = df.groupby('Bank ID')['d_average_interest_bearing_deposit'].apply(lambda s: s.fillna(0).cumsum())
-    cum_core_dep = df.groupby('Bank ID')['d_core_deposit'].apply(lambda s: s.fillna(0).cumsum())
-    df['cum_d_average_deposit'] = np.where(df['in_first_quarter'] == 1, cum_avg_dep, np.nan)
-    df['cum_d_average_interest_bearing_deposit'] = np.where(df['in_first_quarter'] == 1, cum_avg_ib, np.nan)
-    df['cum_d_core_deposit'] = np.where(df['in_first_quarter'] == 1, cum_core_dep, np.nan)
+    cube = PanelCube.from_frame(df, id_col='Bank ID', date_col='Date')
+    in_first_quarter = cube.in_quarter(0)
+    df['in_first_quarter'] = in_first_quarter.astype(int)
+
+    # Cumulative changes in bank deposit rates, analogous to cum_d_ffr, and in deposit quantities
+    # (levels expressed as cumulative growth), only for banks in first quarter; one pass over all columns
+    cums = cube.cumsum(df[list(CUMULATIVE_VARS)], rows=in_first_quarter)
+    for j, col in enumerate(CUMULATIVE_VARS.values()):
+        df[col] = cums[:, j]
 
     # Merge FFR and keep policy window
-    ffr = pd.read_csv(FFR_CSV)
     df = df.merge(ffr, on=['Date'], how='left')
 
     # Large bank indicator (size threshold)
@@ -200,9 +304,23 @@ def main() -> None:
     print('Bank-quarter after winsorizing: ', len(df))
     print('Large bank: ', len(df[df['large_bank'] == 1]))
     print('Small bank: ', len(df[df['large_bank'] == 0]))
+    return df
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Build the working panel(s).")
+    ap.add_argument("--spec", help="JSON list of sample variants (see SampleSpec); default: the baseline sample only. "
+                                   "Inputs are merged once and every variant is written in the same run.")
+    args = ap.parse_args()
+    specs = load_specs(args.spec) if args.spec else [SampleSpec()]
 
-    # Save
-    df.to_csv(OUTPUT_CSV, index=False)
+    inputs = load_inputs()
+    shared = build_shared(inputs)
+    for spec in specs:
+        # Save (CSV for Stata, Arrow for the Python analysis scripts; see panel_store.py)
+        df = build_sample(shared, inputs['ffr'], spec)
+        df.to_csv(spec.output_csv, index=False)
+        publish(df, spec.output_csv)
 
 
 if __name__ == "__main__":
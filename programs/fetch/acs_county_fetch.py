@@ -14,7 +14,7 @@ Outputs (columns):
 
 How to run:
   # 1) Install deps
-  pip install pandas requests
+  pip install pandas requests pyarrow
 
   # 2) (Optional) export a Census API key
   #    Get a free key: https://api.census.gov/data/key_signup.html
@@ -26,18 +26,47 @@ How to run:
   #    Or restrict to your counties via a CSV with a column named "fips" (5-digit):
   python acs_county_fetch.py --filter-county-list county_list.csv --out data/raw/ACS_filtered.csv
 
+  #    States are fetched concurrently over one pooled session; tune the pool and the
+  #    shared request rate, or point the fetcher at a local stand-in server:
+  python acs_county_fetch.py --workers 8 --rps 10
+  python acs_county_fetch.py --workers 1                      # serial requests
+  python acs_county_fetch.py --per-state                      # skip the nationwide request
+  python acs_county_fetch.py --base-url http://127.0.0.1:8000/data/{year}/acs/acs5
+
+  #    Responses are cached under data/cache/http (see http_cache.py); rebuild from the
+  #    cache alone, or bypass it:
+  python acs_county_fetch.py --offline
+  python acs_county_fetch.py --no-cache
+
+  #    Tract level (~85k tracts): one tract:* request per state and variable batch, run
+  #    concurrently; each finished state is written to data/raw/ACS_tracts_<year>/<state>.parquet
+  #    and a rerun only fetches the states that are missing:
+  python acs_county_fetch.py --geo tract
+
 Notes:
   - Uses *only* B tables to avoid S-table naming headaches.
   - Year defaults to 2021 (the 2017–2021 ACS 5-year). Change with --year if you must.
   - All FIPS fields are strings; leading zeros preserved.
+  - Counties are requested nationwide (`for=county:*`) in batches of at most 50 variables
+    (the Census cap), joined on state+county. Per-state requests are only used for a batch
+    whose nationwide request fails.
+  - A state whose tract:* request fails is re-fetched county by county.
+  - All workers share one rate limiter; a 429 (with or without Retry-After) pauses every
+    worker, not just the one that was throttled.
 """
 
 import argparse
+import json
 import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+
+from http_cache import CacheMiss, HTTPCache, add_cache_args, cache_from_args
 
 
 # -----------------------------
@@ -46,6 +75,12 @@ import requests
 DEFAULT_YEAR = 2021  # ACS 5-year vintage aligned with 2017–2021
 BASE_URL_TMPL = "https://api.census.gov/data/{year}/acs/acs5"
 
+# Concurrency defaults (Census throttles bursts; keep the shared rate modest)
+DEFAULT_WORKERS = 8
+DEFAULT_RPS = 10.0
+RETRY_STATUS = (429, 500, 502, 503, 504)
+MAX_VARS_PER_REQUEST = 50  # Census API cap on get= variables per request (NAME counts)
+
 # Variables we need (B tables for stability)
 ACS_VARS = [
     # Income
@@ -80,50 +115,272 @@ STATE_FIPS = [
 # -----------------------------
 # Helpers
 # -----------------------------
-def _request_with_retries(url: str, params: dict, max_retries: int = 5, backoff: float = 1.0):
-    """Simple retry wrapper for 429/5xx responses."""
+class RateLimiter:
+    """Thread-safe limiter shared by all workers: at most `rps` requests per second.
+
+    `pause(seconds)` blocks every worker until the pause has elapsed, which is how a
+    429 from Census is turned into a global back-off instead of a per-thread one.
+    """
+
+    def __init__(self, rps: float = DEFAULT_RPS):
+        self.interval = 1.0 / rps if rps and rps > 0 else 0.0
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def acquire(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        delay = slot - now
+        if delay > 0:
+            time.sleep(delay)
+
+    def pause(self, seconds: float) -> None:
+        with self._lock:
+            self._next = max(self._next, time.monotonic() + seconds)
+
+
+def make_session(pool_size: int = DEFAULT_WORKERS) -> requests.Session:
+    """One keep-alive session with a connection pool sized to the worker count."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def _retry_after(r: requests.Response, default: float) -> float:
+    try:
+        return max(float(r.headers.get("Retry-After", "")), 0.0)
+    except ValueError:
+        return default
+
+
+def _request_with_retries(url: str, params: dict, max_retries: int = 5, backoff: float = 1.0,
+                          session: requests.Session = None, limiter: RateLimiter = None, headers: dict = None):
+    """Simple retry wrapper for 429/5xx responses (a 304 to a conditional request is returned)."""
+    get = session.get if session is not None else requests.get
     for attempt in range(max_retries):
-        r = requests.get(url, params=params, timeout=60)
-        if r.status_code == 200:
+        if limiter is not None:
+            limiter.acquire()
+        r = get(url, params=params, headers=headers, timeout=60)
+        if r.status_code in (200, 304):
             return r
-        if r.status_code in (429, 500, 502, 503, 504):
-            time.sleep(backoff * (2 ** attempt))
+        if r.status_code in RETRY_STATUS:
+            wait = backoff * (2 ** attempt)
+            if r.status_code == 429:
+                wait = _retry_after(r, wait)
+            if limiter is not None:
+                limiter.pause(wait)
+            else:
+                time.sleep(wait)
             continue
         r.raise_for_status()
     r.raise_for_status()
     return r
 
 
-def fetch_state_counties(year: int, state_fips: str, api_key: str = "") -> pd.DataFrame:
+def plan_variable_batches(variables=ACS_VARS, max_vars: int = MAX_VARS_PER_REQUEST) -> list:
     """
-    Fetch all counties for a given state FIPS from ACS 5-year and return as DataFrame.
+    Split `variables` into get= lists within the Census cap. NAME rides in the first batch
+    and counts against its limit; every batch is later joined back on state+county.
     """
-    base_url = BASE_URL_TMPL.format(year=year)
+    variables = [v for v in variables if v != "NAME"]
+    batches, current = [], ["NAME"]
+    for v in variables:
+        if len(current) >= max_vars:
+            batches.append(current)
+            current = []
+        current.append(v)
+    batches.append(current)
+    return batches
+
+
+GEO_WIDTHS = {"state": 2, "county": 3, "tract": 6}
+
+
+def _query_geo(year: int, get_vars: list, geo_for: str, geo_in: str = None, api_key: str = "",
+               session: requests.Session = None, limiter: RateLimiter = None,
+               base_url_tmpl: str = BASE_URL_TMPL, cache: HTTPCache = None) -> pd.DataFrame:
+    """One ACS request: `get_vars` for geography `geo_for`, optionally within `geo_in`."""
+    base_url = base_url_tmpl.format(year=year)
     params = {
-        "get": ",".join(["NAME"] + ACS_VARS),
-        "for": "county:*",
-        "in": f"state:{state_fips}",
+        "get": ",".join(get_vars),
+        "for": geo_for,
     }
+    if geo_in:
+        params["in"] = geo_in
     if api_key:
         params["key"] = api_key
 
-    r = _request_with_retries(base_url, params)
-    data = r.json()
+    if cache is not None:
+        body = cache.get_bytes(base_url, params, lambda h: _request_with_retries(
+            base_url, params, session=session, limiter=limiter, headers=h))
+        data = json.loads(body)
+    else:
+        data = _request_with_retries(base_url, params, session=session, limiter=limiter).json()
     header = data[0]
     rows = data[1:]
     df = pd.DataFrame(rows, columns=header)
 
     # Ensure string types for FIPS components
-    df["state"] = df["state"].astype(str).str.zfill(2)
-    df["county"] = df["county"].astype(str).str.zfill(3)
+    for col, width in GEO_WIDTHS.items():
+        if col in df.columns:
+            df[col] = df[col].astype(str).str.zfill(width)
 
     # Cast numeric columns
-    for v in ACS_VARS:
-        df[v] = pd.to_numeric(df[v], errors="coerce")
+    for v in get_vars:
+        if v != "NAME":
+            df[v] = pd.to_numeric(df[v], errors="coerce")
 
     return df
 
 
+def _query_counties(year: int, get_vars: list, state_fips: str = None, api_key: str = "",
+                    session: requests.Session = None, limiter: RateLimiter = None,
+                    base_url_tmpl: str = BASE_URL_TMPL, cache: HTTPCache = None) -> pd.DataFrame:
+    """One ACS request: `get_vars` for all counties nationwide, or within one state."""
+    geo_in = f"state:{state_fips}" if state_fips else None
+    return _query_geo(year, get_vars, "county:*", geo_in, api_key, session, limiter, base_url_tmpl, cache)
+
+
+def _join_batches(frames: list, keys=("state", "county")) -> pd.DataFrame:
+    out = frames[0]
+    for f in frames[1:]:
+        out = out.merge(f, on=list(keys), how="outer")
+    return out
+
+
+def fetch_state_counties(year: int, state_fips: str, api_key: str = "",
+                         session: requests.Session = None, limiter: RateLimiter = None,
+                         base_url_tmpl: str = BASE_URL_TMPL, variables=ACS_VARS,
+                         cache: HTTPCache = None) -> pd.DataFrame:
+    """
+    Fetch all counties for a given state FIPS from ACS 5-year and return as DataFrame.
+    """
+    frames = [
+        _query_counties(year, batch, state_fips, api_key, session, limiter, base_url_tmpl, cache)
+        for batch in plan_variable_batches(variables)
+    ]
+    return _join_batches(frames)
+
+
+def fetch_counties(year: int, states=STATE_FIPS, api_key: str = "", workers: int = DEFAULT_WORKERS,
+                   rps: float = DEFAULT_RPS, base_url_tmpl: str = BASE_URL_TMPL,
+                   variables=ACS_VARS, national: bool = True, cache: HTTPCache = None) -> pd.DataFrame:
+    """
+    Query planner: one nationwide `county:*` request per variable batch, run concurrently
+    over a shared pooled session and rate limiter. A batch whose national request fails is
+    re-fetched state by state; batches are joined on state+county and restricted to `states`.
+    """
+    batches = plan_variable_batches(variables)
+    states = list(states)
+    workers = max(1, workers)
+    limiter = RateLimiter(rps)
+    per_batch = {}
+    with make_session(workers) as session, ThreadPoolExecutor(max_workers=workers) as pool:
+        fallback = list(range(len(batches)))
+        if national:
+            futures = {
+                pool.submit(_query_counties, year, batch, None, api_key, session, limiter, base_url_tmpl, cache): i
+                for i, batch in enumerate(batches)
+            }
+            fallback = []
+            for fut in as_completed(futures):
+                i = futures[fut]
+                try:
+                    per_batch[i] = fut.result()
+                    print(f"  batch {i + 1}/{len(batches)}: national, {len(per_batch[i]):,} counties", flush=True)
+                except (requests.RequestException, ValueError, CacheMiss) as e:
+                    print(f"  batch {i + 1}/{len(batches)}: national request failed ({e}); per-state fallback",
+                          flush=True)
+                    fallback.append(i)
+
+        # Per-state requests only for batches without a national result
+        futures = {
+            pool.submit(_query_counties, year, batches[i], st, api_key, session, limiter, base_url_tmpl, cache): (i, st)
+            for i in fallback for st in states
+        }
+        state_frames = {i: [] for i in fallback}
+        for n, fut in enumerate(as_completed(futures), start=1):
+            i, st = futures[fut]
+            state_frames[i].append(fut.result())
+            print(f"  batch {i + 1} state {st}: done ({n}/{len(futures)})", flush=True)
+        for i in fallback:
+            per_batch[i] = pd.concat(state_frames[i], ignore_index=True)
+
+    raw = _join_batches([per_batch[i] for i in range(len(batches))])
+    return raw[raw["state"].isin(states)].reset_index(drop=True)
+
+
+def fetch_state_tracts(year: int, state_fips: str, api_key: str = "",
+                       session: requests.Session = None, limiter: RateLimiter = None,
+                       base_url_tmpl: str = BASE_URL_TMPL, variables=ACS_VARS,
+                       cache: HTTPCache = None) -> pd.DataFrame:
+    """
+    All tracts of one state: a tract:* request per variable batch, falling back to one
+    request per county (and batch) if the state-wide query fails.
+    """
+    batches = plan_variable_batches(variables)
+    args = (api_key, session, limiter, base_url_tmpl, cache)
+    try:
+        frames = [_query_geo(year, b, "tract:*", f"state:{state_fips}", *args) for b in batches]
+    except (requests.RequestException, ValueError, CacheMiss) as e:
+        print(f"  state {state_fips}: tract request failed ({e}); per-county fallback", flush=True)
+        counties = _query_counties(year, ["NAME"], state_fips, *args)["county"]
+        frames = [
+            pd.concat([_query_geo(year, b, "tract:*", f"state:{state_fips} county:{c}", *args) for c in counties],
+                      ignore_index=True)
+            for b in batches
+        ]
+    return _join_batches(frames, keys=("state", "county", "tract"))
+
+
+def _tract_partition(out_dir: str, state_fips: str) -> str:
+    return os.path.join(out_dir, f"{state_fips}.parquet")
+
+
+def fetch_tracts(year: int, out_dir: str, states=STATE_FIPS, api_key: str = "", workers: int = DEFAULT_WORKERS,
+                 rps: float = DEFAULT_RPS, base_url_tmpl: str = BASE_URL_TMPL, variables=ACS_VARS,
+                 cache: HTTPCache = None) -> list:
+    """
+    Fetch tract features state by state over the shared pool, writing each finished state to
+    its own Parquet partition in `out_dir`. States whose partition already exists are skipped,
+    so an interrupted run resumes where it stopped. Returns the partition paths.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    pending = [st for st in states if not os.path.exists(_tract_partition(out_dir, st))]
+    if len(pending) < len(states):
+        print(f"Resuming: {len(states) - len(pending)} of {len(states)} states already written", flush=True)
+    limiter = RateLimiter(rps)
+    workers = max(1, min(workers, len(pending) or 1))
+    with make_session(workers) as session, ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(fetch_state_tracts, year, st, api_key, session, limiter, base_url_tmpl, variables, cache): st
+            for st in pending
+        }
+        failed = []
+        for n, fut in enumerate(as_completed(futures), start=1):
+            st = futures[fut]
+            try:
+                features = compute_tract_features(fut.result())
+            except Exception as e:
+                # Keep writing the other states; a rerun picks up the failures
+                print(f"  state {st}: failed ({e})", flush=True)
+                failed.append(st)
+                continue
+            path = _tract_partition(out_dir, st)
+            # "_"-prefixed, so pd.read_parquet(out_dir) skips a temp file left by an interrupted run
+            tmp = os.path.join(out_dir, f"_{os.path.basename(path)}.tmp")
+            features.to_parquet(tmp, index=False)
+            os.replace(tmp, path)
+            print(f"  state {st}: {len(features):,} tracts ({n}/{len(pending)})", flush=True)
+    if failed:
+        raise RuntimeError(f"Tract fetch failed for states {sorted(failed)}; rerun to resume.")
+    return [_tract_partition(out_dir, st) for st in states]
+
+
 def compute_features(df: pd.DataFrame) -> pd.DataFrame:
     """
     From raw ACS columns, compute clean features and return tidy frame.
@@ -156,20 +413,44 @@ def compute_features(df: pd.DataFrame) -> pd.DataFrame:
     return out
 
 
+def compute_tract_features(df: pd.DataFrame) -> pd.DataFrame:
+    """compute_features plus the 6-digit tract code and 11-digit tract GEOID."""
+    out = compute_features(df)
+    out.insert(2, "tract", df["tract"].to_numpy())
+    out.insert(0, "geoid", out["fips"] + out["tract"])
+    return out.sort_values("geoid").reset_index(drop=True)
+
+
 def main():
     ap = argparse.ArgumentParser(description="Fetch ACS 5-year county features for depositor sophistication proxies.")
     ap.add_argument("--year", type=int, default=DEFAULT_YEAR, help="ACS year (default: 2021, i.e., 2017–2021 5-year).")
     ap.add_argument("--out", type=str, default=os.path.join("data", "raw", "ACS.csv"), help="Output CSV path.")
+    ap.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="Concurrent state requests (1 = serial).")
+    ap.add_argument("--rps", type=float, default=DEFAULT_RPS, help="Shared request rate limit (requests/second).")
+    ap.add_argument("--base-url", type=str, default=BASE_URL_TMPL,
+                    help="API URL template with {year}; point at a local stand-in server for testing.")
+    ap.add_argument("--per-state", action="store_true",
+                    help="Skip the nationwide request and query each state directly.")
+    ap.add_argument("--geo", choices=["county", "tract"], default="county",
+                    help="Geography: county CSV (default) or tract-level Parquet partitions.")
+    ap.add_argument("--tract-dir", type=str, default="",
+                    help="Tract partition directory (default: data/raw/ACS_tracts_<year>).")
+    add_cache_args(ap)
     args = ap.parse_args()
 
     api_key = os.environ.get("CENSUS_API_KEY", "").strip()
 
-    # Fetch all states and concat
-    frames = []
-    for st in STATE_FIPS:
-        df_state = fetch_state_counties(args.year, st, api_key=api_key)
-        frames.append(df_state)
-    raw = pd.concat(frames, ignore_index=True)
+    if args.geo == "tract":
+        out_dir = args.tract_dir or os.path.join("data", "raw", f"ACS_tracts_{args.year}")
+        paths = fetch_tracts(args.year, out_dir, STATE_FIPS, api_key=api_key, workers=args.workers,
+                             rps=args.rps, base_url_tmpl=args.base_url, cache=cache_from_args(args))
+        print(f"Saved {len(paths)} state partitions to {out_dir} (read with pd.read_parquet(out_dir))")
+        return
+
+    # Nationwide batched requests, falling back to per-state queries on failure
+    raw = fetch_counties(args.year, STATE_FIPS, api_key=api_key, workers=args.workers,
+                         rps=args.rps, base_url_tmpl=args.base_url, national=not args.per_state,
+                         cache=cache_from_args(args))
 
     features = compute_features(raw)
 
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+bench_fetch.py
+Offline throughput benchmarks for the ACS, HMDA and IRS fetchers against mock_server.py.
+
+Each scenario runs a fetcher end to end against an in-process mock server and reports
+wall time, requests, injected errors (each one costs a retry), rows and bytes served,
+rows/sec and MB/sec. Cache scenarios run the same fetch twice through a fresh response
+cache: the cold pass fills it, the warm pass should make no requests at all.
+
+How to run:
+  python programs/fetch/bench_fetch.py
+  python programs/fetch/bench_fetch.py --latency 0.05 --error-rate 0.05 --hmda-rows 200000
+  python programs/fetch/bench_fetch.py --only hmda --json results/bench_fetch.json
+
+Numbers are reproducible for a given set of flags: responses are deterministic and
+fault injection is seeded.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from mock_server import MockConfig, start_server
+
+import acs_county_fetch as acs
+import hmda_county_fetch as hmda
+import irs_county_fetch as irs
+from http_cache import HTTPCache
+
+
+def _measure(name, stats, fn):
+    stats.reset()
+    t0 = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):  # fetcher progress lines
+        fn()
+    secs = time.perf_counter() - t0
+    s = stats.snapshot()
+    row = {
+        "scenario": name, "seconds": round(secs, 3), "requests": s["requests"], "retries": s["errors"],
+        "rows": s["rows"], "bytes": s["bytes"],
+        "rows_per_sec": round(s["rows"] / secs, 1) if secs > 0 else None,
+        "mb_per_sec": round(s["bytes"] / secs / 1e6, 2) if secs > 0 else None,
+    }
+    print(f"{name:<34} {row['seconds']:>8.2f}s {row['requests']:>6} req {row['retries']:>4} retry "
+          f"{row['rows']:>10,} rows {row['rows_per_sec'] or 0:>12,.0f} rows/s {row['mb_per_sec'] or 0:>8.2f} MB/s",
+          flush=True)
+    return row
+
+
+def bench_acs(base, stats, args, tmp):
+    url = base + "/data/{year}/acs/acs5"
+    rows = [
+        _measure("acs national (batched)", stats,
+                 lambda: acs.fetch_counties(2021, acs.STATE_FIPS, workers=args.workers, rps=0, base_url_tmpl=url)),
+        _measure("acs per-state", stats,
+                 lambda: acs.fetch_counties(2021, acs.STATE_FIPS, workers=args.workers, rps=0, base_url_tmpl=url,
+                                            national=False)),
+        _measure("acs per-state serial", stats,
+                 lambda: acs.fetch_counties(2021, acs.STATE_FIPS, workers=1, rps=0, base_url_tmpl=url,
+                                            national=False)),
+    ]
+    cache = HTTPCache(os.path.join(tmp, "acs_cache"))
+    for label in ("cold", "warm"):
+        rows.append(_measure(f"acs national cache {label}", stats,
+                             lambda: acs.fetch_counties(2021, acs.STATE_FIPS, workers=args.workers, rps=0,
+                                                        base_url_tmpl=url, cache=cache)))
+    rows.append(_measure("acs tracts", stats,
+                         lambda: acs.fetch_tracts(2021, os.path.join(tmp, "tracts"), acs.STATE_FIPS,
+                                                  workers=args.workers, rps=0, base_url_tmpl=url)))
+    return rows
+
+
+def _hmda_partitions(jobs, workers, engine):
+    """Run every partition; a failure is raised rather than timed as a short run."""
+    for _, _, error in hmda.iter_partitions(jobs, workers, engine):
+        if error is not None:
+            raise error
+
+
+def bench_hmda(base, stats, args, tmp):
+    hmda.DB_API_CSV = base + "/v2/data-browser-api/view/csv"
+    os.environ["HMDA_API_URL"] = hmda.DB_API_CSV
+    os.environ["FETCH_NO_CACHE"] = "1"
+    states = hmda.STATE_ABBR[:args.hmda_states]
+    jobs = [(2021, st) for st in states]
+    rows = [
+        _measure(f"hmda arrow x{len(states)} states", stats,
+                 lambda: _hmda_partitions(jobs, 1, "arrow")),
+        _measure(f"hmda pandas x{len(states)} states", stats,
+                 lambda: _hmda_partitions(jobs, 1, "pandas")),
+        _measure(f"hmda arrow x{len(states)} on {args.workers} procs", stats,
+                 lambda: _hmda_partitions(jobs, args.workers, "arrow")),
+    ]
+    del os.environ["FETCH_NO_CACHE"]
+    os.environ["FETCH_CACHE_DIR"] = os.path.join(tmp, "hmda_cache")
+    for label in ("cold", "warm"):
+        rows.append(_measure(f"hmda arrow cache {label}", stats,
+                             lambda: _hmda_partitions(jobs, 1, "arrow")))
+    return rows
+
+
+def bench_irs(base, stats, args, tmp):
+    irs.IRS_COUNTY_TMPL = base + "/pub/irs-soi/{yy}incyallnoagi.csv"
+    irs.IRS_ZIP_TMPL = base + "/pub/irs-soi/{yy}zpallnoagi.csv"
+    years = list(range(2012, 2022))
+    rows = [
+        _measure(f"irs county x{len(years)} years", stats,
+                 lambda: irs.irs_panel(years, "county", None, None, args.workers)),
+        _measure(f"irs county x{len(years)} serial", stats,
+                 lambda: irs.irs_panel(years, "county", None, None, 1)),
+    ]
+    cache = HTTPCache(os.path.join(tmp, "irs_cache"))
+    for label in ("cold", "warm"):
+        rows.append(_measure(f"irs county cache {label}", stats,
+                             lambda: irs.irs_panel(years, "county", None, cache, args.workers)))
+    return rows
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark the fetchers against a local mock server.")
+    ap.add_argument("--only", choices=["acs", "hmda", "irs"], action="append", help="Run only these fetchers.")
+    ap.add_argument("--latency", type=float, default=0.02, help="Mock response latency (seconds).")
+    ap.add_argument("--error-rate", type=float, default=0.0, help="Share of requests failing with 429/503.")
+    ap.add_argument("--chunk-size", type=int, default=64 * 1024, help="Mock streaming chunk size (bytes).")
+    ap.add_argument("--hmda-rows", type=int, default=100_000, help="Synthetic LAR rows per (year, state).")
+    ap.add_argument("--hmda-states", type=int, default=8, help="States per HMDA scenario.")
+    ap.add_argument("--workers", type=int, default=8)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--json", default="", help="Also write the results as JSON here.")
+    args = ap.parse_args()
+
+    cfg = MockConfig(args.latency, args.error_rate, args.chunk_size, hmda_rows=args.hmda_rows, seed=args.seed)
+    server, stats, base = start_server(cfg)
+    tmp = tempfile.mkdtemp(prefix="bench_fetch_")
+    benches = {"acs": bench_acs, "hmda": bench_hmda, "irs": bench_irs}
+    results = []
+    try:
+        for name in args.only or list(benches):
+            print(f"--- {name} ---", flush=True)
+            results += benches[name](base, stats, args, tmp)
+    finally:
+        server.shutdown()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    if args.json:
+        os.makedirs(os.path.dirname(os.path.abspath(args.json)), exist_ok=True)
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"config": vars(args), "results": results}, f, indent=1)
+        print(f"Saved {len(results)} results to {args.json}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
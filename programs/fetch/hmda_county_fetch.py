@@ -16,18 +16,43 @@ Filters:
   Exclude business_or_commercial_purpose = 1
   Keep Single Family (1–4 Units) via derived_dwelling_category
   Keep first-lien only (lien_status = 1)
+
+API responses are cached on disk per (year, state) via http_cache.py, so a rebuild after
+changing a filter or derived column needs no network. Configure with the FETCH_* variables
+documented there (e.g. FETCH_OFFLINE=1, FETCH_NO_CACHE=1).
+
+Partitions are reduced by a streaming Arrow reader: string columns arrive dictionary-encoded,
+predicates are evaluated once per dictionary entry and gathered by integer code, and county
+totals are kept in running accumulators, so memory stays flat however many years/states
+are added. `--engine pandas` uses the original chunked pandas filter instead. Dependencies:
+  pip install pandas requests pyarrow
+
+Parallel mode spreads (year, state) partitions over a process pool; each worker streams,
+filters and reduces its partition to county counts and returns only those aggregates:
+  python programs/fetch/hmda_county_fetch.py --workers 8
+
+Every finished (year, state) aggregate is checkpointed under data/cache/hmda_checkpoints
+with a manifest.json; a restarted run skips finished partitions. Checkpoints are discarded
+automatically when the filter code changes, or explicitly with --restart.
 """
 
-import io, time
+import argparse, csv, hashlib, inspect, json, os, time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from typing import Iterable, List
-import pandas as pd, requests
+import numpy as np, pandas as pd, requests
+import pyarrow as pa, pyarrow.compute as pc, pyarrow.csv as pacsv
+
+from http_cache import HTTPCache, default_cache
 
 # Years and output
 YEARS = [2020, 2021]
 OUTPUT_CSV = "data/raw/HMDA.csv"
 
+CHECKPOINT_DIR = "data/cache/hmda_checkpoints"
+
 # API endpoint
-DB_API_CSV = "https://ffiec.cfpb.gov/v2/data-browser-api/view/csv"  # HMDA Data Browser API
+# HMDA Data Browser API (HMDA_API_URL points the fetcher at a local stand-in, see mock_server.py)
+DB_API_CSV = os.environ.get("HMDA_API_URL", "https://ffiec.cfpb.gov/v2/data-browser-api/view/csv")
 
 # US state/territory postal abbreviations used by HMDA API
 STATE_ABBR = [
@@ -47,46 +72,72 @@ DWELLING_OK = {
     "Single Family (1-4 Units):Site-Built",
     "Single Family (1-4 Units):Manufactured",
 }
+# Fallback for files without derived_dwelling_category
+TOTAL_UNITS_OK = ["1", "2", "3", "4"]
 
-def iter_api(year: int, state: str) -> Iterable[pd.DataFrame]:
-    """Stream filtered HMDA rows via API for a given year/state."""
-    params = {
-        "years": str(year),
-        "states": state,
-        "actions_taken": "1",
-        "loan_purposes": "1,31,32",
-        "lien_status": "1",
-    }
+# Arrow reader: only the columns the filters need, categoricals dictionary-encoded
+ARROW_BLOCK_SIZE = 32 << 20
+DICT = pa.dictionary(pa.int32(), pa.string())
+ARROW_TYPES = {
+    "state_code": DICT, "county_code": DICT, "derived_dwelling_category": DICT,
+    "action_taken": pa.int16(), "loan_purpose": pa.int16(), "lien_status": pa.int16(),
+    "open-end_line_of_credit": pa.int16(), "reverse_mortgage": pa.int16(),
+    "business_or_commercial_purpose": pa.int16(),
+    "total_units": DICT,  # read only when derived_dwelling_category is absent
+}
+
+def _api_get(params: dict, headers: dict = None) -> requests.Response:
     # Retry a few times in case the API is slow or transiently unavailable
     for attempt in range(3):
         try:
-            r = requests.get(DB_API_CSV, params=params, stream=True, timeout=300)
+            r = requests.get(DB_API_CSV, params=params, headers=headers, stream=True, timeout=300)
             r.raise_for_status()
-            break
+            return r
         except Exception:
             if attempt == 2:
                 raise
             time.sleep(2 * (attempt + 1))
-    # Stream to pandas to avoid loading entire file in memory
+
+def _open_source(year: int, state: str, cache: HTTPCache = None):
+    """File-like CSV body for a year/state: the cached file, or the raw HTTP stream."""
+    params = {
+        "years": str(year),
+        "states": state,
+        "actions_taken": "1",
+        "loan_purposes": "1,31,32",
+        "lien_status": "1",
+    }
+    if cache is not None:
+        # Response is spooled to the cache once, then read back in chunks from disk
+        return open(cache.fetch(DB_API_CSV, params, lambda h: _api_get(params, h)), "rb")
+    # Stream to the reader to avoid loading entire file in memory
+    r = _api_get(params)
     r.raw.decode_content = True
-    buf = r.raw
-    for ch in pd.read_csv(
-        buf,
-        low_memory=False,
-        chunksize=250_000,
-        usecols=USECOLS,
-        dtype={
-            "state_code":"string","county_code":"string","census_tract":"string","action_taken":"Int64",
-            "loan_purpose":"Int64","reverse_mortgage":"Int64",
-            "business_or_commercial_purpose":"Int64","derived_dwelling_category":"string","lien_status":"Int64",
-            "occupancy_type":"Int64","total_units":"string","activity_year":"Int64",
-        },
-    ):
-        # Normalize HMDA header variations
-        if "open-end_line_of_credit" in ch.columns and "open_end_line_of_credit" not in ch.columns:
-            ch = ch.rename(columns={"open-end_line_of_credit": "open_end_line_of_credit"})
-        yield ch
-    r.close()
+    return r.raw
+
+def iter_api(year: int, state: str, cache: HTTPCache = None) -> Iterable[pd.DataFrame]:
+    """Stream filtered HMDA rows via API (or the response cache) for a given year/state."""
+    buf = _open_source(year, state, cache)
+    try:
+        for ch in pd.read_csv(
+            buf,
+            low_memory=False,
+            chunksize=250_000,
+            usecols=USECOLS,
+            dtype={
+                "state_code":"string","county_code":"string","census_tract":"string","action_taken":"Int64",
+                "loan_purpose":"Int64","reverse_mortgage":"Int64",
+                "business_or_commercial_purpose":"Int64","derived_dwelling_category":"string","lien_status":"Int64",
+                "occupancy_type":"Int64","total_units":"string","activity_year":"Int64",
+            },
+        ):
+            # Normalize HMDA header variations
+            if "open-end_line_of_credit" in ch.columns and "open_end_line_of_credit" not in ch.columns:
+                ch = ch.rename(columns={"open-end_line_of_credit": "open_end_line_of_credit"})
+            yield ch
+    finally:
+        # Also runs when the caller stops early and the generator is closed
+        buf.close()
 
 def filter_and_count(df: pd.DataFrame) -> pd.DataFrame:
     """Apply filters, aggregate to county-year, and compute refi share."""
@@ -99,7 +150,7 @@ def filter_and_count(df: pd.DataFrame) -> pd.DataFrame:
     if "derived_dwelling_category" in df.columns:
         df = df[df.derived_dwelling_category.isin(DWELLING_OK)]
     else:
-        df = df[df.total_units.isin(["1","2","3","4"])]
+        df = df[df.total_units.isin(TOTAL_UNITS_OK)]
 
     # First lien only
     if "lien_status" in df.columns:
@@ -125,28 +176,247 @@ def filter_and_count(df: pd.DataFrame) -> pd.DataFrame:
     out = out.rename(columns={"activity_year":"year"})
     return out
 
-def process_year(year: int) -> pd.DataFrame:
-    frames: List[pd.DataFrame] = []
-    for st in STATE_ABBR:
-        print(f"  {st}: fetching ...", flush=True)
-        chunk_count = 0
-        row_count = 0
-        for ch in iter_api(year, st):
+COUNTY_KEY = ["year","fips5","state_fips","county_fips"]
+
+def _eq(arr, value) -> np.ndarray:
+    return pc.fill_null(pc.equal(arr, value), False).to_numpy(zero_copy_only=False)
+
+def _codes_in(arr: pa.DictionaryArray, allowed) -> np.ndarray:
+    """Membership test evaluated on the dictionary, then gathered by integer code (nulls False)."""
+    ok = np.append(pc.is_in(arr.dictionary, value_set=pa.array(sorted(allowed), pa.string()))
+                   .to_numpy(zero_copy_only=False), False)
+    codes = pc.fill_null(arr.indices, len(arr.dictionary)).to_numpy(zero_copy_only=False)
+    return ok[codes]
+
+def keep_mask(batch: pa.RecordBatch) -> np.ndarray:
+    """filter_and_count's predicates as one boolean mask over an Arrow batch."""
+    col, names = batch.column, batch.schema.names
+    mask = _eq(col("action_taken"), 1)
+    # Exclusion flags apply only if the file has them; a missing open-end flag is kept,
+    # missing typed flags are dropped
+    if "open-end_line_of_credit" in names:
+        mask &= ~pc.fill_null(pc.equal(col("open-end_line_of_credit"), 1), False).to_numpy(zero_copy_only=False)
+    for flag in ("reverse_mortgage", "business_or_commercial_purpose"):
+        if flag in names:
+            mask &= pc.fill_null(pc.not_equal(col(flag), 1), False).to_numpy(zero_copy_only=False)
+    if "derived_dwelling_category" in names:
+        mask &= _codes_in(col("derived_dwelling_category"), DWELLING_OK)
+    else:
+        mask &= _codes_in(col("total_units"), TOTAL_UNITS_OK)
+    if "lien_status" in names:
+        mask &= _eq(col("lien_status"), 1)
+    mask &= pc.fill_null(pc.is_in(col("loan_purpose"), value_set=pa.array([1, 31, 32], pa.int16())), False) \
+        .to_numpy(zero_copy_only=False)
+    return mask
+
+class CountyAccumulator:
+    """Running orig/refi totals per county, updated one Arrow batch at a time."""
+
+    def __init__(self, year: int):
+        self.year = year
+        self.totals = {}
+
+    def add(self, batch: pa.RecordBatch) -> None:
+        mask = keep_mask(batch)
+        st, ct = batch.column("state_code"), batch.column("county_code")
+        si = pc.fill_null(st.indices, -1).to_numpy(zero_copy_only=False)
+        ci = pc.fill_null(ct.indices, -1).to_numpy(zero_copy_only=False)
+        mask &= (si >= 0) & (ci >= 0)
+        if not mask.any():
+            return
+        refi = pc.fill_null(pc.is_in(batch.column("loan_purpose"), value_set=pa.array([31, 32], pa.int16())), False) \
+            .to_numpy(zero_copy_only=False)[mask]
+        n_ct = len(ct.dictionary)
+        keys, inv = np.unique(si[mask].astype(np.int64) * n_ct + ci[mask], return_inverse=True)
+        orig = np.bincount(inv)
+        refis = np.bincount(inv, weights=refi).astype(np.int64)
+        sd, cd = st.dictionary.to_pylist(), ct.dictionary.to_pylist()
+        for k, o, r in zip(keys.tolist(), orig.tolist(), refis.tolist()):
+            tot = self.totals.setdefault((sd[k // n_ct].zfill(2), cd[k % n_ct].zfill(3)), [0, 0])
+            tot[0] += o
+            tot[1] += r
+
+    def to_frame(self) -> pd.DataFrame:
+        keys = sorted(self.totals)
+        sf = pd.array([k[0] for k in keys], dtype="string")
+        cf = pd.array([k[1] for k in keys], dtype="string")
+        return pd.DataFrame({
+            "year": pd.array([self.year] * len(keys), dtype="Int64"),
+            "fips5": sf + cf,
+            "state_fips": sf,
+            "county_fips": cf,
+            "orig_total": np.array([self.totals[k][0] for k in keys], dtype=np.int64),
+            "refi_total": np.array([self.totals[k][1] for k in keys], dtype=np.int64),
+        })
+
+def iter_arrow(year: int, state: str, cache: HTTPCache = None) -> Iterable[pa.RecordBatch]:
+    """Stream a year/state as Arrow record batches with dictionary-encoded categoricals."""
+    buf = _open_source(year, state, cache)
+    try:
+        # The header decides which optional columns keep_mask can use, as in filter_and_count
+        header = next(csv.reader([buf.readline().decode("utf-8-sig")]))
+        wanted = [c for c in ARROW_TYPES if c in header
+                  and (c != "total_units" or "derived_dwelling_category" not in header)]
+        reader = pacsv.open_csv(
+            buf,
+            read_options=pacsv.ReadOptions(block_size=ARROW_BLOCK_SIZE, column_names=header),
+            convert_options=pacsv.ConvertOptions(include_columns=wanted, column_types=ARROW_TYPES,
+                                                strings_can_be_null=True),
+        )
+        for batch in reader:
+            yield batch
+    finally:
+        buf.close()
+
+def process_partition(year: int, state: str, cache: HTTPCache = None, engine: str = "arrow") -> pd.DataFrame:
+    """Stream one (year, state), filter each chunk and reduce to county orig/refi totals."""
+    print(f"  {year} {state}: fetching ...", flush=True)
+    chunk_count = 0
+    row_count = 0
+    if engine == "arrow":
+        acc = CountyAccumulator(year)
+        for batch in iter_arrow(year, state, cache):
             chunk_count += 1
-            row_count += len(ch)
-            frames.append(filter_and_count(ch))
-            if chunk_count % 5 == 0:
-                print(f"  {st}: {row_count:,} rows so far ({chunk_count} chunks)", flush=True)
-        print(f"  {st}: done, {row_count:,} rows", flush=True)
-    yr = pd.concat(frames, ignore_index=True)
-    return yr
-
-def run():
-    per_year = []
-    for y in YEARS:
-        print(f"Processing HMDA via API for {y} ...")
-        per_year.append(process_year(y))
-    df = pd.concat(per_year, ignore_index=True)
+            row_count += batch.num_rows
+            acc.add(batch)
+        print(f"  {year} {state}: done, {row_count:,} rows ({chunk_count} batches)", flush=True)
+        return acc.to_frame()
+
+    frames: List[pd.DataFrame] = []
+    for ch in iter_api(year, state, cache):
+        chunk_count += 1
+        row_count += len(ch)
+        frames.append(filter_and_count(ch))
+        if chunk_count % 5 == 0:
+            print(f"  {year} {state}: {row_count:,} rows so far ({chunk_count} chunks)", flush=True)
+    print(f"  {year} {state}: done, {row_count:,} rows", flush=True)
+    if not frames:
+        return pd.DataFrame(columns=COUNTY_KEY + ["orig_total","refi_total"])
+    return (
+        pd.concat(frames, ignore_index=True)
+        .groupby(COUNTY_KEY, as_index=False)[["orig_total","refi_total"]]
+        .sum()
+    )
+
+# Per-process cache handle (HTTPCache holds a lock, so each worker builds its own)
+_worker_cache = None
+
+def _init_worker():
+    global _worker_cache
+    _worker_cache = default_cache()
+
+def _partition_job(year: int, state: str, engine: str) -> pd.DataFrame:
+    return process_partition(year, state, _worker_cache, engine)
+
+def iter_partitions(jobs, workers: int = 1, engine: str = "arrow"):
+    """
+    Yield ((year, state), county totals, error) as partitions finish, serially or on a process
+    pool. A failed partition comes back with its exception instead of totals; partitions not
+    started by then are cancelled, while those already running still finish and are yielded.
+    """
+    if workers <= 1:
+        cache = default_cache()
+        for y, st in jobs:
+            try:
+                part = process_partition(y, st, cache, engine)
+            except Exception as e:
+                yield (y, st), None, e
+                return
+            yield (y, st), part, None
+        return
+    pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker)
+    try:
+        futures = {pool.submit(_partition_job, y, st, engine): (y, st) for y, st in jobs}
+        for fut in as_completed(futures):
+            if fut.cancelled():
+                continue
+            try:
+                part = fut.result()
+            except Exception as e:
+                for other in futures:  # those not started yet; as_completed then skips past them
+                    other.cancel()
+                yield futures[fut], None, e
+                continue
+            yield futures[fut], part, None
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+def _filter_signature() -> str:
+    """Hash of the request and filter definitions; checkpoints from other code are stale."""
+    src = inspect.getsource(_open_source) + inspect.getsource(filter_and_count) + inspect.getsource(keep_mask)
+    src += repr(sorted(DWELLING_OK)) + repr(USECOLS)
+    return hashlib.sha256(src.encode("utf-8")).hexdigest()
+
+class Checkpoints:
+    """Completed (year, state) county aggregates on disk, indexed by manifest.json."""
+
+    def __init__(self, root: str = CHECKPOINT_DIR, restart: bool = False):
+        self.root = root
+        self.manifest_path = os.path.join(root, "manifest.json")
+        self.signature = _filter_signature()
+        self.done = {}
+        os.makedirs(root, exist_ok=True)
+        if restart or not os.path.exists(self.manifest_path):
+            return
+        with open(self.manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("signature") != self.signature:
+            print("Checkpoints were built with different filters; starting over.", flush=True)
+            return
+        self.done = manifest.get("partitions", {})
+
+    def _path(self, year: int, state: str) -> str:
+        return os.path.join(self.root, f"{year}_{state}.csv")
+
+    def has(self, year: int, state: str) -> bool:
+        return f"{year}_{state}" in self.done and os.path.exists(self._path(year, state))
+
+    def load(self, year: int, state: str) -> pd.DataFrame:
+        return pd.read_csv(
+            self._path(year, state),
+            dtype={"fips5":"string","state_fips":"string","county_fips":"string",
+                   "year":"Int64","orig_total":"int64","refi_total":"int64"},
+        )
+
+    def save(self, year: int, state: str, part: pd.DataFrame) -> None:
+        path = self._path(year, state)
+        part.to_csv(path + ".tmp", index=False)
+        os.replace(path + ".tmp", path)
+        self.done[f"{year}_{state}"] = {
+            "file": os.path.basename(path), "rows": len(part), "completed_at": time.time(),
+        }
+        with open(self.manifest_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"signature": self.signature, "partitions": self.done}, f, indent=1)
+        os.replace(self.manifest_path + ".tmp", self.manifest_path)
+
+def run(workers: int = 1, checkpoints: Checkpoints = None, engine: str = "arrow"):
+    jobs = [(y, st) for y in YEARS for st in STATE_ABBR]
+    frames: List[pd.DataFrame] = []
+    pending = []
+    for y, st in jobs:
+        if checkpoints is not None and checkpoints.has(y, st):
+            frames.append(checkpoints.load(y, st))
+        else:
+            pending.append((y, st))
+    if len(pending) < len(jobs):
+        print(f"Resuming: {len(jobs) - len(pending)} of {len(jobs)} partitions already checkpointed")
+
+    print(f"Processing HMDA via API for {YEARS} ({len(pending)} partitions, {workers} process(es)) ...")
+    failed = []
+    for (y, st), part, error in iter_partitions(pending, workers, engine):
+        if error is not None:
+            # Keep saving partitions that are still running; a rerun resumes from the checkpoints
+            print(f"Failed {y} {st} ({error})", flush=True)
+            failed.append((y, st))
+            continue
+        if checkpoints is not None:
+            checkpoints.save(y, st, part)
+        frames.append(part)
+        print(f"Finished {y} {st} ({len(frames)}/{len(jobs)})", flush=True)
+    if failed:
+        raise RuntimeError(f"HMDA partitions failed for (year, state) {sorted(failed)}; "
+                           f"{len(jobs) - len(frames) - len(failed)} others not run. Rerun to resume.")
+    df = pd.concat(frames, ignore_index=True)
 
     # Final aggregation across chunks: ensure unique (year, fips5)
     agg = (
@@ -175,4 +445,14 @@ def run():
     print(f"Saved: {OUTPUT_CSV} ({len(w):,} rows)")
 
 if __name__ == "__main__":
-    run()
+    ap = argparse.ArgumentParser(description="Build county-level HMDA refinance share.")
+    ap.add_argument("--workers", type=int, default=1,
+                    help="Processes for (year, state) partitions (1 = serial; 0 = all cores).")
+    ap.add_argument("--engine", choices=["arrow","pandas"], default="arrow",
+                    help="Streaming Arrow reducer (default) or the chunked pandas filter.")
+    ap.add_argument("--checkpoint-dir", default=CHECKPOINT_DIR, help="Where finished partitions are kept.")
+    ap.add_argument("--restart", action="store_true", help="Ignore existing checkpoints.")
+    ap.add_argument("--no-checkpoint", action="store_true", help="Do not read or write checkpoints.")
+    args = ap.parse_args()
+    ckpt = None if args.no_checkpoint else Checkpoints(args.checkpoint_dir, restart=args.restart)
+    run(args.workers if args.workers > 0 else (os.cpu_count() or 1), ckpt, args.engine)
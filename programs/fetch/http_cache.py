@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+http_cache.py
+Persistent on-disk HTTP response cache shared by the ACS, HMDA and IRS fetchers.
+
+Each response body is stored under data/cache/http/ in a file named after the SHA-256
+of the request (URL + sorted query params, API keys excluded), with a small JSON
+sidecar holding the URL, ETag / Last-Modified, fetch time, size and last access.
+
+  - Fresh entries (younger than the TTL) are served from disk with no network.
+  - Stale entries are revalidated with If-None-Match / If-Modified-Since; a 304 keeps
+    the stored body and resets its age.
+  - The cache is bounded in bytes; least-recently-used entries are evicted on write.
+  - Offline mode serves whatever is cached regardless of age and never touches the
+    network (a miss raises CacheMiss).
+
+Environment defaults (overridable on each fetcher's command line):
+  FETCH_CACHE_DIR      cache directory (default: data/cache/http)
+  FETCH_CACHE_TTL      freshness in hours (default: 720, i.e. 30 days)
+  FETCH_CACHE_MAX_GB   size bound in GB (default: 20)
+  FETCH_OFFLINE=1      offline mode
+  FETCH_NO_CACHE=1     bypass the cache entirely
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from urllib.parse import urlencode
+
+DEFAULT_CACHE_DIR = os.path.join("data", "cache", "http")
+DEFAULT_TTL_HOURS = 720.0
+DEFAULT_MAX_GB = 20.0
+
+# Query params that carry credentials: never part of the key, never written to disk
+SECRET_PARAMS = {"key", "api_key", "token"}
+
+
+class CacheMiss(RuntimeError):
+    """Raised in offline mode when a request has no cached response."""
+
+
+def _env_flag(name: str) -> bool:
+    return os.environ.get(name, "").strip().lower() in ("1", "true", "yes")
+
+
+def cache_key(url: str, params: dict = None) -> str:
+    """SHA-256 over the URL and sorted, non-secret query params."""
+    items = sorted((k, str(v)) for k, v in (params or {}).items() if k not in SECRET_PARAMS)
+    return hashlib.sha256(f"{url}?{urlencode(items)}".encode("utf-8")).hexdigest()
+
+
+class HTTPCache:
+    def __init__(self, root: str = DEFAULT_CACHE_DIR, ttl_hours: float = DEFAULT_TTL_HOURS,
+                 max_gb: float = DEFAULT_MAX_GB, offline: bool = False):
+        self.root = root
+        self.ttl = ttl_hours * 3600.0
+        self.max_bytes = int(max_gb * 1024 ** 3)
+        self.offline = offline
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    # -- paths / metadata --------------------------------------------------
+    def _body(self, key: str) -> str:
+        return os.path.join(self.root, key + ".body")
+
+    def _meta_path(self, key: str) -> str:
+        return os.path.join(self.root, key + ".json")
+
+    def _read_meta(self, key: str):
+        try:
+            with open(self._meta_path(key), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return meta if os.path.exists(self._body(key)) else None
+
+    def _write_meta(self, key: str, meta: dict) -> None:
+        tmp = f"{self._meta_path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(tmp, self._meta_path(key))
+
+    def _touch(self, key: str, meta: dict, **updates) -> None:
+        meta.update(updates, last_access=time.time())
+        self._write_meta(key, meta)
+
+    # -- public API --------------------------------------------------------
+    def fetch(self, url: str, params: dict = None, request=None) -> str:
+        """
+        Return the path of the cached body for (url, params), downloading if needed.
+
+        `request(headers)` performs the actual GET (with the caller's own session, retry
+        and rate-limit policy) and returns a streaming requests.Response. It is sent the
+        conditional headers when an entry is stale; a 304 response reuses the stored body.
+        """
+        key = cache_key(url, params)
+        meta = self._read_meta(key)
+        now = time.time()
+
+        if meta is not None and (self.offline or now - meta["fetched_at"] < self.ttl):
+            self._touch(key, meta)
+            return self._body(key)
+        if self.offline:
+            raise CacheMiss(f"Offline and not cached: {url} ({key[:12]})")
+
+        headers = {}
+        if meta is not None:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+        r = request(headers)
+        try:
+            if r.status_code == 304 and meta is not None:
+                self._touch(key, meta, fetched_at=now)
+                return self._body(key)
+            r.raise_for_status()
+            tmp = f"{self._body(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+            size = 0
+            with open(tmp, "wb") as f:
+                for block in r.iter_content(chunk_size=1 << 20):
+                    f.write(block)
+                    size += len(block)
+            os.replace(tmp, self._body(key))
+        finally:
+            r.close()
+
+        self._write_meta(key, {
+            "url": url,
+            "params": {k: str(v) for k, v in (params or {}).items() if k not in SECRET_PARAMS},
+            "etag": r.headers.get("ETag"),
+            "last_modified": r.headers.get("Last-Modified"),
+            "fetched_at": now,
+            "last_access": now,
+            "size": size,
+        })
+        self.evict(keep=key)
+        return self._body(key)
+
+    def lookup(self, url: str, params: dict = None):
+        """Path of the stored body for (url, params) regardless of age, or None."""
+        key = cache_key(url, params)
+        return self._body(key) if self._read_meta(key) is not None else None
+
+    def get_bytes(self, url: str, params: dict = None, request=None) -> bytes:
+        with open(self.fetch(url, params, request), "rb") as f:
+            return f.read()
+
+    def evict(self, keep: str = None) -> None:
+        """Drop least-recently-used entries until the cache fits in `max_bytes` (never `keep`)."""
+        with self._lock:
+            entries = []
+            for name in os.listdir(self.root):
+                if not name.endswith(".json"):
+                    continue
+                key = name[:-5]
+                meta = self._read_meta(key)
+                if meta is not None and key != keep:
+                    entries.append((meta.get("last_access", 0.0), meta.get("size", 0), key))
+            total = sum(size for _, size, _ in entries)
+            kept = self._read_meta(keep) if keep else None
+            total += kept.get("size", 0) if kept else 0
+            for _, size, key in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                for path in (self._meta_path(key), self._body(key)):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                total -= size
+
+
+def add_cache_args(ap) -> None:
+    """Register the shared --cache-dir / --cache-ttl / --cache-max-gb / --offline / --no-cache flags."""
+    ap.add_argument("--cache-dir", default=os.environ.get("FETCH_CACHE_DIR", DEFAULT_CACHE_DIR),
+                    help="HTTP response cache directory.")
+    ap.add_argument("--cache-ttl", type=float, default=float(os.environ.get("FETCH_CACHE_TTL", DEFAULT_TTL_HOURS)),
+                    help="Hours before a cached response is revalidated.")
+    ap.add_argument("--cache-max-gb", type=float, default=float(os.environ.get("FETCH_CACHE_MAX_GB", DEFAULT_MAX_GB)),
+                    help="Cache size bound in GB (LRU eviction).")
+    ap.add_argument("--offline", action="store_true", default=_env_flag("FETCH_OFFLINE"),
+                    help="Serve only cached responses; never touch the network.")
+    ap.add_argument("--no-cache", action="store_true", default=_env_flag("FETCH_NO_CACHE"),
+                    help="Bypass the response cache.")
+
+
+def cache_from_args(args):
+    if args.no_cache:
+        return None
+    return HTTPCache(args.cache_dir, args.cache_ttl, args.cache_max_gb, args.offline)
+
+
+def default_cache():
+    """Cache configured from the FETCH_* environment variables (None if FETCH_NO_CACHE)."""
+    if _env_flag("FETCH_NO_CACHE"):
+        return None
+    return HTTPCache(
+        os.environ.get("FETCH_CACHE_DIR", DEFAULT_CACHE_DIR),
+        float(os.environ.get("FETCH_CACHE_TTL", DEFAULT_TTL_HOURS)),
+        float(os.environ.get("FETCH_CACHE_MAX_GB", DEFAULT_MAX_GB)),
+        _env_flag("FETCH_OFFLINE"),
+    )
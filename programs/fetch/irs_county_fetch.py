@@ -7,36 +7,110 @@ Build county-level “market participation” proxies from IRS SOI:
 Default: COUNTY 2021 (no-AGI) direct. Optional: ZIP 2021 (no-AGI) + HUD ZIP→County crosswalk.
 
 Usage:
-  pip install pandas requests
+  pip install pandas requests scipy
   # COUNTY (no crosswalk)
   python programs/irs_county_fetch.py --mode county --out data/processed/irs.csv
   # ZIP (needs HUD crosswalk CSV with ZIP, COUNTY, TOT_RATIO or RES_RATIO)
   python programs/irs_county_fetch.py --mode zip --crosswalk hud_zip_county.csv --out data/processed/irs.csv
+  # Rebuild from the on-disk response cache only (see http_cache.py)
+  python programs/irs_county_fetch.py --offline
+  # Panel: one long county×year table, years fetched and decoded concurrently
+  python programs/irs_county_fetch.py --years 2011-2021 --out data/raw/IRS_panel.csv
+  python programs/irs_county_fetch.py --mode zip --crosswalk hud_zip_county.csv --years 2019,2021
+
+ZIP mode compiles the crosswalk once per (file, ratio column) into a sparse ZIP×county
+allocation matrix cached under data/cache/irs_alloc; every measure is then allocated with
+one sparse product instead of a merge + groupby.
+
+Files are decoded as a stream in row chunks holding only the needed columns; header
+spellings are resolved to columns once per file schema (memoized) and reused for every chunk.
 """
-import argparse, io, os, sys, warnings
-import pandas as pd, requests
+import argparse, hashlib, io, os, sys, warnings
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import numpy as np, pandas as pd, requests
+import scipy.sparse as sp
+
+from http_cache import add_cache_args, cache_from_args
 
-IRS_COUNTY_2021 = "https://www.irs.gov/pub/irs-soi/21incyallnoagi.csv"
-IRS_ZIP_2021    = "https://www.irs.gov/pub/irs-soi/21zpallnoagi.csv"
+# IRS_SOI_BASE_URL points the fetcher at a local stand-in (see mock_server.py)
+IRS_SOI_BASE    = os.environ.get("IRS_SOI_BASE_URL", "https://www.irs.gov/pub/irs-soi")
+IRS_COUNTY_TMPL = IRS_SOI_BASE + "/{yy}incyallnoagi.csv"
+IRS_ZIP_TMPL    = IRS_SOI_BASE + "/{yy}zpallnoagi.csv"
+IRS_COUNTY_2021 = IRS_COUNTY_TMPL.format(yy="21")
+IRS_ZIP_2021    = IRS_ZIP_TMPL.format(yy="21")
+ALLOC_CACHE_DIR = os.path.join("data", "cache", "irs_alloc")
+CHUNK_ROWS = 200_000
 
-def _get(url):
+# Fields read per mode, with the header spellings each may appear under
+SCHEMA = {
+    "county": {
+        "N1": ["N1"], "N00300": ["N00300"], "N00600": ["N00600"],
+        "STATEFIPS": ["STATEFIPS","STATE"], "COUNTYFIPS": ["COUNTYFIPS","COUNTY"],
+        "COUNTYNAME": ["COUNTYNAME","COUNTY_NAME","NAME"], "STATEABBR": ["STATEABBR","STABBR","STATE_NAME"],
+    },
+    "zip": {"ZIPCODE": ["ZIPCODE"], "N1": ["N1"], "N00300": ["N00300"], "N00600": ["N00600"]},
+}
+
+def _download(url, headers=None):
     for _ in range(5):
-        r = requests.get(url, timeout=60)
-        if r.status_code == 200: return r.content
+        r = requests.get(url, headers=headers, stream=True, timeout=60)
+        if r.status_code in (200,304): return r
         if r.status_code in (429,500,502,503,504): continue
         r.raise_for_status()
     raise RuntimeError(f"Fetch failed: {url}")
 
-def _find(df, names):
-    lo = {c.lower(): c for c in df.columns}
+def _get(url, cache=None):
+    if cache is not None: return cache.get_bytes(url, None, lambda h: _download(url, h))
+    return _download(url).content
+
+def _open_stream(url, cache=None):
+    if cache is not None: return open(cache.fetch(url, None, lambda h: _download(url, h)), "rb")
+    r = _download(url); r.raw.decode_content = True
+    return r.raw
+
+def _squash(name):
+    return name.lower().replace(" ","").replace("_","")
+
+@lru_cache(maxsize=None)
+def _find_cols(columns, names):
+    lo = {c.lower(): c for c in columns}
     for n in names:
         if n.lower() in lo: return lo[n.lower()]
-    squash = {c.lower().replace(" ","").replace("_",""): c for c in df.columns}
+    squash = {_squash(c): c for c in columns}
     for n in names:
-        k = n.lower().replace(" ","").replace("_","")
+        k = _squash(n)
         if k in squash: return squash[k]
     return None
 
+def _find(df, names):
+    return _find_cols(tuple(df.columns), tuple(names))
+
+@lru_cache(maxsize=None)
+def _wanted(mode):
+    return frozenset(_squash(n) for names in SCHEMA[mode].values() for n in names)
+
+def read_irs_chunks(url, mode, cache=None):
+    """Stream-decode an IRS SOI CSV in row chunks that hold only the columns `mode` needs."""
+    wanted = _wanted(mode)
+    f = _open_stream(url, cache)
+    try:
+        yield from pd.read_csv(f, encoding="latin1", usecols=lambda c: _squash(c.strip()) in wanted,
+                               dtype=str, chunksize=CHUNK_ROWS)
+    finally:
+        f.close()
+
+def year_url(year, mode):
+    return (IRS_COUNTY_TMPL if mode == "county" else IRS_ZIP_TMPL).format(yy=f"{year % 100:02d}")
+
+def parse_years(spec):
+    """'2011-2021' or '2019,2021' -> sorted list of years."""
+    years = set()
+    for part in spec.split(","):
+        lo, _, hi = part.strip().partition("-")
+        years.update(range(int(lo), int(hi or lo) + 1))
+    return sorted(years)
+
 def _need(df, cols, ctx):
     miss = [c for c in cols if _find(df,[c]) is None]
     if miss: raise ValueError(f"Missing {miss} in {ctx}. Got: {list(df.columns)[:15]} ...")
@@ -62,46 +136,145 @@ def county_shares(df):
     })
     return out[out["county_fips"]!="000"].reset_index(drop=True)
 
+class ZipCountyAllocator:
+    """Crosswalk as a sparse ZIP×county matrix of allocation ratios (rows: zips, cols: counties)."""
+    def __init__(self, zips, counties, rows, cols, ratios):
+        self.zips, self.counties = np.asarray(zips), np.asarray(counties)
+        self.rows, self.cols, self.ratios = rows, cols, ratios
+        shape = (len(self.zips), len(self.counties))
+        # Duplicate (zip, county) pairs are summed, as the merge + groupby did
+        self.matrix = sp.csr_matrix((np.nan_to_num(ratios), (rows, cols)), shape=shape)
+        self.pattern = sp.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=shape)
+        self._zip_pos = pd.Index(self.zips)
+
+    @classmethod
+    def from_crosswalk(cls, xwalk, ratio="TOT_RATIO"):
+        _need(xwalk, ["ZIP","COUNTY",ratio], f"HUD ZIP→County crosswalk (ratio={ratio})")
+        z = xwalk[_find(xwalk,["ZIP"])].astype(str).str.zfill(5)
+        c = xwalk[_find(xwalk,["COUNTY"])].astype(str).str.zfill(5)
+        r = xwalk[_find(xwalk,[ratio])].astype(float).to_numpy()
+        zips, rows = np.unique(z.to_numpy(dtype=str), return_inverse=True)
+        counties, cols = np.unique(c.to_numpy(dtype=str), return_inverse=True)
+        return cls(zips, counties, rows, cols, r)
+
+    @classmethod
+    def cached(cls, crosswalk_path, ratio="TOT_RATIO", cache_dir=ALLOC_CACHE_DIR):
+        """Load the compiled matrix for (crosswalk file contents, ratio), building it on first use."""
+        h = hashlib.sha256()
+        with open(crosswalk_path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""): h.update(block)
+        path = os.path.join(cache_dir, f"{h.hexdigest()[:16]}_{ratio}.npz")
+        if os.path.exists(path):
+            z = np.load(path, allow_pickle=False)
+            return cls(z["zips"], z["counties"], z["rows"], z["cols"], z["ratios"])
+        a = cls.from_crosswalk(pd.read_csv(crosswalk_path, dtype=str), ratio)
+        os.makedirs(cache_dir, exist_ok=True)
+        np.savez(path + ".tmp.npz", zips=a.zips, counties=a.counties, rows=a.rows, cols=a.cols, ratios=a.ratios)
+        os.replace(path + ".tmp.npz", path)
+        return a
+
+    def allocate_many(self, blocks):
+        """
+        Allocate several ZIP-level blocks [(zip_codes, values n_rows × k), ...] (e.g. one per
+        year) to counties in a single sparse product. Returns [(counties, county × k totals)]
+        per block, keeping counties reached by at least one crosswalk pair whose ZIP appears
+        in that block (the inner-merge semantics).
+        """
+        xs, present = [], np.zeros((len(self.zips), len(blocks)))
+        for j, (zip_codes, values) in enumerate(blocks):
+            pos = self._zip_pos.get_indexer(pd.Index(zip_codes))
+            hit = pos >= 0
+            x = np.zeros((len(self.zips), values.shape[1]))
+            np.add.at(x, pos[hit], np.asarray(values, dtype=float)[hit])
+            present[np.unique(pos[hit]), j] = 1.0
+            xs.append(x)
+        tot = self.matrix.T @ np.hstack(xs)
+        reached = (self.pattern.T @ present) > 0
+        out, c0 = [], 0
+        for j, x in enumerate(xs):
+            k = x.shape[1]
+            out.append((self.counties[reached[:, j]], tot[reached[:, j], c0:c0 + k]))
+            c0 += k
+        return out
+
+    def allocate(self, zip_codes, values):
+        return self.allocate_many([(zip_codes, values)])[0]
+
+def _zip_block(df_zip):
+    _need(df_zip, ["ZIPCODE","N1","N00300","N00600"], "IRS ZIP no-AGI")
+    zips = df_zip[_find(df_zip,["ZIPCODE"])].astype(str).str.zfill(5).to_numpy()
+    vals = np.column_stack([
+        pd.to_numeric(df_zip[_find(df_zip,[col])], errors="coerce").fillna(0.0).to_numpy()
+        for col in ("N1","N00300","N00600")
+    ])
+    return zips, vals
+
 def zip_to_county(df_zip, xwalk, ratio="TOT_RATIO"):
-    _need(df_zip, ["ZIPCODE","N1","N00300","N00600"], "IRS ZIP 2021 no-AGI")
-    _need(xwalk, ["ZIP","COUNTY",ratio], f"HUD ZIP→County crosswalk (ratio={ratio})")
-    df_zip["_zip"]=df_zip[_find(df_zip,["ZIPCODE"])].astype(str).str.zfill(5)
-    for col in ("N1","N00300","N00600"):
-        df_zip[f"_{col}"]=pd.to_numeric(df_zip[_find(df_zip,[col])], errors="coerce").fillna(0.0)
-    xwalk = xwalk.copy()
-    xwalk["_zip"]=xwalk[_find(xwalk,["ZIP"])].astype(str).str.zfill(5)
-    xwalk["_county"]=xwalk[_find(xwalk,["COUNTY"])].astype(str).str.zfill(5)
-    rcol=_find(xwalk,[ratio]); xwalk[rcol]=xwalk[rcol].astype(float)
-    m = df_zip.merge(xwalk[["_zip","_county",rcol]], on="_zip", how="inner")
-    for col in ("_N1","_N00300","_N00600"):
-        m[col+"_alloc"]=m[col]*m[rcol]
-    g = m.groupby("_county",as_index=False)[["_N1_alloc","_N00300_alloc","_N00600_alloc"]].sum()
-    g["fips"]=g["_county"]; g["state_fips"]=g["fips"].str[:2]; g["county_fips"]=g["fips"].str[2:]
-    g.rename(columns={"_N1_alloc":"returns_total","_N00300_alloc":"interest","_N00600_alloc":"dividends"},inplace=True)
+    alloc = xwalk if isinstance(xwalk, ZipCountyAllocator) else ZipCountyAllocator.from_crosswalk(xwalk, ratio)
+    return _county_frame(*alloc.allocate(*_zip_block(df_zip)))
+
+def _county_frame(counties, tot):
+    g = pd.DataFrame({"fips": counties.astype(str), "returns_total": tot[:,0], "interest": tot[:,1], "dividends": tot[:,2]})
+    g["state_fips"]=g["fips"].str[:2]; g["county_fips"]=g["fips"].str[2:]
     g["share_dividend"]=(g["dividends"]/g["returns_total"]).where(g["returns_total"]>0)
     g["share_interest"]=(g["interest"]/g["returns_total"]).where(g["returns_total"]>0)
     return g[["fips","state_fips","county_fips","returns_total","share_dividend","share_interest"]]
 
+def county_year(year, cache=None):
+    """County shares for one year, decoded chunk by chunk."""
+    frames = [county_shares(ch) for ch in read_irs_chunks(year_url(year, "county"), "county", cache)]
+    out = pd.concat(frames, ignore_index=True)
+    out.insert(0, "year", year)
+    print(f"  {year}: {len(out):,} counties", flush=True)
+    return out
+
+def zip_year_block(year, cache=None):
+    """(zips, N1/N00300/N00600 values) for one year, decoded chunk by chunk."""
+    blocks = [_zip_block(ch) for ch in read_irs_chunks(year_url(year, "zip"), "zip", cache)]
+    print(f"  {year}: {sum(len(z) for z, _ in blocks):,} ZIP rows", flush=True)
+    return np.concatenate([z for z, _ in blocks]), np.vstack([v for _, v in blocks])
+
+def irs_panel(years, mode="county", alloc=None, cache=None, workers=4):
+    """Long county×year table; years are fetched and decoded concurrently."""
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(years)))) as pool:
+        if mode == "county":
+            return pd.concat(pool.map(lambda y: county_year(y, cache), years), ignore_index=True)
+        blocks = list(pool.map(lambda y: zip_year_block(y, cache), years))
+    frames = []
+    for y, (counties, tot) in zip(years, alloc.allocate_many(blocks)):
+        g = _county_frame(counties, tot)
+        g.insert(0, "year", y)
+        frames.append(g)
+    return pd.concat(frames, ignore_index=True)
+
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--mode", choices=["county","zip"], default="county")
     ap.add_argument("--crosswalk", default="", help="HUD ZIP→County CSV (needed if --mode zip)")
     ap.add_argument("--ratio-column", default="TOT_RATIO", help="TOT_RATIO or RES_RATIO")
     ap.add_argument("--out", default="data/raw/irs.csv")
+    ap.add_argument("--years", default="", help="Year range/list (e.g. 2011-2021) for a long county×year table")
+    ap.add_argument("--workers", type=int, default=4, help="Years fetched concurrently with --years")
+    add_cache_args(ap)
     args = ap.parse_args()
+    cache = cache_from_args(args)
     warnings.simplefilter("ignore", category=pd.errors.PerformanceWarning)
     # Ensure output directory exists
     out_dir = os.path.dirname(args.out)
     if out_dir:
         os.makedirs(out_dir, exist_ok=True)
 
-    if args.mode=="county":
-        raw = pd.read_csv(io.BytesIO(_get(IRS_COUNTY_2021)), encoding="latin1")
+    if args.years:
+        if args.mode=="zip" and not args.crosswalk: sys.exit("ERROR: --crosswalk required for --mode zip")
+        xw  = ZipCountyAllocator.cached(args.crosswalk, args.ratio_column) if args.mode=="zip" else None
+        out = irs_panel(parse_years(args.years), args.mode, xw, cache, args.workers)
+    elif args.mode=="county":
+        raw = pd.read_csv(io.BytesIO(_get(IRS_COUNTY_2021, cache)), encoding="latin1")
         out = county_shares(raw)
     else:
         if not args.crosswalk: sys.exit("ERROR: --crosswalk required for --mode zip")
-        raw = pd.read_csv(io.BytesIO(_get(IRS_ZIP_2021)), encoding="latin1")
-        xw  = pd.read_csv(args.crosswalk, dtype=str)
+        raw = pd.read_csv(io.BytesIO(_get(IRS_ZIP_2021, cache)), encoding="latin1")
+        xw  = ZipCountyAllocator.cached(args.crosswalk, args.ratio_column)
         out = zip_to_county(raw, xw, ratio=args.ratio_column)
 
     out.to_csv(args.out, index=False)
@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+"""
+mock_server.py
+Local stand-in for the Census ACS, HMDA Data Browser and IRS SOI endpoints, so the fetchers
+can be regression-tested and benchmarked without touching the network.
+
+Routes (same paths and query params as the real services):
+  /data/{year}/acs/acs5?get=...&for=county:*|tract:*[&in=state:XX[ county:YYY]]   JSON
+  /v2/data-browser-api/view/csv?years=...&states=...                              CSV
+  /pub/irs-soi/{yy}incyallnoagi.csv, /pub/irs-soi/{yy}zpallnoagi.csv               CSV
+  /_stats                                                                          JSON counters
+
+Responses are synthetic and deterministic (seeded by the request), or replayed from a
+recorded response cache (--replay-dir, the http_cache.py layout) when a matching entry
+exists. Bodies are sent with chunked transfer encoding in --chunk-size pieces.
+
+Fault injection: --latency delays every response; --error-rate makes that share of requests
+fail with 429 (Retry-After: 0) or 503 before any body is sent.
+
+How to run:
+  python programs/fetch/mock_server.py --port 8000 --latency 0.05 --error-rate 0.05
+  # then, in another shell:
+  python programs/fetch/acs_county_fetch.py --no-cache --base-url http://127.0.0.1:8000/data/{year}/acs/acs5
+  HMDA_API_URL=http://127.0.0.1:8000/v2/data-browser-api/view/csv python programs/fetch/hmda_county_fetch.py
+  IRS_SOI_BASE_URL=http://127.0.0.1:8000/pub/irs-soi python programs/fetch/irs_county_fetch.py --no-cache
+
+For benchmarks see bench_fetch.py, which starts this server in-process.
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from http_cache import SECRET_PARAMS, HTTPCache
+
+# Real endpoints, used to look up recorded responses in --replay-dir
+REAL_ACS = "https://api.census.gov"
+REAL_HMDA = "https://ffiec.cfpb.gov/v2/data-browser-api/view/csv"
+REAL_IRS = "https://www.irs.gov"
+
+ACS_PATH = re.compile(r"^/data/(\d{4})/acs/acs5$")
+HMDA_PATH = "/v2/data-browser-api/view/csv"
+IRS_PATH = re.compile(r"^/pub/irs-soi/(\d{2})(incy|zp)allnoagi\.csv$")
+
+# Same geography the fetchers iterate over (kept literal so the server has no pandas dependency)
+STATE_FIPS = [
+    "01","02","04","05","06","08","09","10","11","12","13","15","16","17","18","19",
+    "20","21","22","23","24","25","26","27","28","29","30","31","32","33","34","35",
+    "36","37","38","39","40","41","42","44","45","46","47","48","49","50","51","53",
+    "54","55","56","72"
+]
+
+HMDA_HEADER = [
+    "activity_year","lei","state_code","county_code","census_tract","action_taken","loan_purpose",
+    "open-end_line_of_credit","reverse_mortgage","business_or_commercial_purpose",
+    "derived_dwelling_category","lien_status","occupancy_type","total_units","loan_amount",
+]
+DWELLINGS = [
+    "Single Family (1-4 Units):Site-Built", "Single Family (1-4 Units):Site-Built",
+    "Single Family (1-4 Units):Manufactured", "Multifamily:Site-Built",
+]
+
+
+def _rng(*parts) -> random.Random:
+    return random.Random(int(hashlib.sha256(repr(parts).encode()).hexdigest()[:16], 16))
+
+
+class MockConfig:
+    def __init__(self, latency=0.0, error_rate=0.0, chunk_size=64 * 1024, counties_per_state=20,
+                 tracts_per_county=5, hmda_rows=50_000, zips_per_state=200, replay_dir="", seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.chunk_size = chunk_size
+        self.counties_per_state = counties_per_state
+        self.tracts_per_county = tracts_per_county
+        self.hmda_rows = hmda_rows
+        self.zips_per_state = zips_per_state
+        self.replay = HTTPCache(replay_dir) if replay_dir else None
+        self.faults = random.Random(seed)
+
+
+class MockStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0
+            self.errors = 0
+            self.bytes = 0
+            self.rows = 0
+            self.replayed = 0
+
+    def add(self, **counts):
+        with self._lock:
+            for k, v in counts.items():
+                setattr(self, k, getattr(self, k) + v)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {k: getattr(self, k) for k in ("requests", "errors", "bytes", "rows", "replayed")}
+
+
+# -----------------------------
+# Synthetic bodies
+# -----------------------------
+def _counties(cfg: MockConfig, state: str) -> list:
+    return [f"{2 * i + 1:03d}" for i in range(cfg.counties_per_state)]
+
+
+def acs_body(cfg: MockConfig, year: int, query: dict):
+    get_vars = query["get"][0].split(",")
+    geo_for = query["for"][0].split(":")[0]
+    geo_in = dict(part.split(":") for part in query.get("in", [""])[0].split() if ":" in part)
+    states = [geo_in["state"]] if geo_in.get("state", "*") != "*" else STATE_FIPS
+    geo_cols = ["state", "county"] + (["tract"] if geo_for == "tract" else [])
+    rows = [get_vars + geo_cols]
+    for st in states:
+        counties = [geo_in["county"]] if "county" in geo_in else _counties(cfg, st)
+        for ct in counties:
+            tracts = [f"{100 * (i + 1):06d}" for i in range(cfg.tracts_per_county)] if geo_for == "tract" else [None]
+            for tr in tracts:
+                rng = _rng(year, st, ct, tr)
+                values = {v: str(rng.randint(50, 50_000)) for v in get_vars}
+                values["NAME"] = f"Tract {tr}, County {ct}, State {st}" if tr else f"County {ct}, State {st}"
+                rows.append([values[v] for v in get_vars] + [st, ct] + ([tr] if tr else []))
+    return json.dumps(rows).encode("utf-8"), len(rows) - 1, "application/json"
+
+
+def hmda_body(cfg: MockConfig, query: dict):
+    year = query.get("years", ["2021"])[0]
+    state = query.get("states", ["AL"])[0]
+    st = state if state in STATE_FIPS else _rng("state", state).choice(STATE_FIPS)
+    rng = _rng("hmda", year, state)
+    counties = _counties(cfg, st)
+    lines = [",".join(HMDA_HEADER)]
+    for _ in range(cfg.hmda_rows):
+        ct = rng.choice(counties)
+        lines.append(",".join([
+            year, "LEI0000000000", st, st + ct, f"{st}{ct}{rng.randint(100, 999900):06d}", "1",
+            rng.choice(("1", "31", "32", "1")), rng.choice(("2", "2", "1", "1111")), rng.choice(("2", "2", "1")),
+            rng.choice(("2", "2", "1")), rng.choice(DWELLINGS), "1", "1", "1", str(rng.randint(50, 900) * 1000),
+        ]))
+    return ("\n".join(lines) + "\n").encode("latin1"), cfg.hmda_rows, "text/csv"
+
+
+def irs_body(cfg: MockConfig, yy: str, kind: str):
+    rng = _rng("irs", yy, kind)
+    if kind == "incy":
+        lines = ["STATEFIPS,STATE,COUNTYFIPS,COUNTYNAME,AGI_STUB,N1,MARS1,N00300,A00300,N00600,A00600"]
+        for st in STATE_FIPS:
+            for ct in ["000"] + _counties(cfg, st):
+                n1 = rng.randint(1_000, 500_000)
+                lines.append(f"{int(st)},S{st},{int(ct)},County {ct},0,{n1},{n1 // 2},"
+                             f"{int(n1 * rng.uniform(.2, .6))},{n1 * 3},{int(n1 * rng.uniform(.05, .3))},{n1 * 5}")
+    else:
+        lines = ["STATEFIPS,STATE,ZIPCODE,AGI_STUB,N1,MARS1,N00300,A00300,N00600,A00600"]
+        for i, st in enumerate(STATE_FIPS):
+            for z in range(cfg.zips_per_state):
+                n1 = rng.randint(100, 40_000)
+                lines.append(f"{int(st)},S{st},{1000 + i * 1000 + z},0,{n1},{n1 // 2},"
+                             f"{int(n1 * rng.uniform(.2, .6))},{n1 * 3},{int(n1 * rng.uniform(.05, .3))},{n1 * 5}")
+    return ("\n".join(lines) + "\n").encode("latin1"), len(lines) - 1, "text/csv"
+
+
+# -----------------------------
+# Server
+# -----------------------------
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    cfg: MockConfig = None
+    stats: MockStats = None
+
+    def log_message(self, *args):
+        pass
+
+    def _replay(self, real_url: str, query: dict):
+        if self.cfg.replay is None:
+            return None
+        params = {k: v[0] for k, v in query.items() if k not in SECRET_PARAMS}
+        path = self.cfg.replay.lookup(real_url, params or None)
+        if path is None:
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        self.stats.add(requests=1)
+        if url.path == "/_stats":
+            return self._send(200, json.dumps(self.stats.snapshot()).encode(), "application/json")
+
+        if self.cfg.latency:
+            time.sleep(self.cfg.latency)
+        with self.stats._lock:
+            fail = self.cfg.faults.random() < self.cfg.error_rate
+            status = self.cfg.faults.choice((429, 503))
+        if fail:
+            self.stats.add(errors=1)
+            return self._send(status, b"", "text/plain", {"Retry-After": "0"} if status == 429 else None)
+
+        m_acs, m_irs = ACS_PATH.match(url.path), IRS_PATH.match(url.path)
+        if m_acs:
+            real = REAL_ACS + url.path
+            build = lambda: acs_body(self.cfg, int(m_acs.group(1)), query)
+        elif url.path == HMDA_PATH:
+            real = REAL_HMDA
+            build = lambda: hmda_body(self.cfg, query)
+        elif m_irs:
+            real = REAL_IRS + url.path
+            build = lambda: irs_body(self.cfg, m_irs.group(1), m_irs.group(2))
+        else:
+            return self._send(404, b"not found", "text/plain")
+
+        body = self._replay(real, query)
+        if body is not None:
+            self.stats.add(replayed=1)
+            ctype = "application/json" if m_acs else "text/csv"
+        else:
+            body, rows, ctype = build()
+            self.stats.add(rows=rows)
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        if self.headers.get("If-None-Match") == etag:
+            return self._send(304, b"", ctype, {"ETag": etag})
+        self._send(200, body, ctype, {"ETag": etag})
+
+    def _send(self, status: int, body: bytes, ctype: str, headers: dict = None):
+        self.send_response(status)
+        self.send_header("Content-Type", ctype)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        step = max(1, self.cfg.chunk_size)
+        for i in range(0, len(body), step):
+            piece = body[i:i + step]
+            self.wfile.write(f"{len(piece):X}\r\n".encode() + piece + b"\r\n")
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+        self.stats.add(bytes=len(body))
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients dropping pooled connections (e.g. a worker pool shutting down) is normal
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def start_server(cfg: MockConfig, host: str = "127.0.0.1", port: int = 0):
+    """Start the mock server on a daemon thread; returns (server, stats, base URL)."""
+    stats = MockStats()
+    handler = type("BoundMockHandler", (MockHandler,), {"cfg": cfg, "stats": stats})
+    server = MockServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, stats, f"http://{host}:{server.server_address[1]}"
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Local stand-in for the ACS, HMDA and IRS endpoints.")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8000)
+    ap.add_argument("--latency", type=float, default=0.0, help="Seconds before each response.")
+    ap.add_argument("--error-rate", type=float, default=0.0, help="Share of requests failing with 429/503.")
+    ap.add_argument("--chunk-size", type=int, default=64 * 1024, help="Bytes per streamed chunk.")
+    ap.add_argument("--counties-per-state", type=int, default=20)
+    ap.add_argument("--tracts-per-county", type=int, default=5)
+    ap.add_argument("--hmda-rows", type=int, default=50_000, help="Synthetic LAR rows per (year, state).")
+    ap.add_argument("--replay-dir", default="", help="Serve recorded responses from this http_cache directory.")
+    ap.add_argument("--seed", type=int, default=0, help="Seed for fault injection.")
+    args = ap.parse_args()
+
+    cfg = MockConfig(args.latency, args.error_rate, args.chunk_size, args.counties_per_state,
+                     args.tracts_per_county, args.hmda_rows, replay_dir=args.replay_dir, seed=args.seed)
+    server, _, base = start_server(cfg, args.host, args.port)
+    print(f"Mock server on {base} (Ctrl-C to stop)", flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()